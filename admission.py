@@ -0,0 +1,206 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+# Weight in the queue of a request, whatever its size: a flood of tiny
+# requests cannot queue without bound either.
+MIN_WEIGHT = 1024
+
+
+class Overloaded(Exception):
+    """
+    Raised when a conversion is not admitted: `status` is 429 when the queue
+    is full ("queue_full"), 503 when it waited longer than the maximum wait
+    ("timeout"). `retry_after` is an estimate, in seconds, of the time it
+    takes to work through the current queue.
+    """
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(f"Server overloaded ({reason}): retry in {retry_after} seconds")
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('size', 'small', 'weight', 'wake', 'admitted')
+
+    def __init__(self, size, small, wake):
+        self.size = size
+        self.small = small
+        self.weight = max(size, MIN_WEIGHT)
+        self.wake = wake
+        self.admitted = False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionControl:
+    """
+    Admission control for conversions, from threads (`slot`) and coroutines
+    (`async_slot`) alike.
+
+    At most `slots` conversions run at once; the others wait in a queue of at
+    most `max_queue_bytes` of input (each request weighs at least
+    MIN_WEIGHT), and a request arriving at a full queue is rejected at once.
+    Documents of up to `small_bytes` characters have their own lane: they
+    are admitted before any large document waiting, and large documents
+    never take the last slot, so a burst of large pages cannot starve small
+    interactive requests. A request that waits longer than `max_wait`
+    seconds (None: no limit) gives up.
+    """
+
+    def __init__(self, slots, max_queue_bytes=32 * 1024 * 1024, small_bytes=64 * 1024, max_wait=10.0,
+                 clock=time.monotonic):
+        self.slots = max(1, slots)
+        self.large_slots = max(1, self.slots - 1)
+        self.max_queue_bytes = max_queue_bytes
+        self.small_bytes = small_bytes
+        self.max_wait = max_wait
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._queues = {True: deque(), False: deque()}  # small -> waiters
+        self.running = 0
+        self.running_large = 0
+        self.queued_bytes = 0
+        self.admitted = 0
+        self.rejections = {'queue_full': 0, 'timeout': 0, 'too_large': 0}
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        self._rate = None  # Characters per second of one slot, averaged
+
+    def _can_start(self, small):
+        return self.running < self.slots and (small or self.running_large < self.large_slots)
+
+    def _start(self, small):
+        self.running += 1
+        self.running_large += not small
+
+    def _dispatch(self):
+        for small in (True, False):
+            queue = self._queues[small]
+            while queue and self._can_start(small):
+                waiter = queue.popleft()
+                self.queued_bytes -= waiter.weight
+                self._start(small)
+                waiter.admitted = True
+                waiter.wake()
+
+    def _retry_after(self):
+        # Seconds to convert everything queued or running at the observed rate
+        if not self._rate:
+            return 1
+        seconds = self.queued_bytes / (self._rate * self.slots)
+        limit = self.max_wait if self.max_wait else 60
+        return max(1, min(math.ceil(seconds), math.ceil(limit)))
+
+    def _enqueue(self, size, wake):
+        """
+        Starts a conversion of `size` characters at once (returns None) or
+        queues it (returns its waiter). Raises Overloaded if the queue is full.
+        """
+        waiter = _Waiter(size, size <= self.small_bytes, wake)
+        with self._lock:
+            if self._can_start(waiter.small) and not self._queues[waiter.small]:
+                self._start(waiter.small)
+                return None
+            if self.queued_bytes and self.queued_bytes + waiter.weight > self.max_queue_bytes:
+                self.rejections['queue_full'] += 1
+                raise Overloaded(429, 'queue_full', self._retry_after())
+            self._queues[waiter.small].append(waiter)
+            self.queued_bytes += waiter.weight
+        return waiter
+
+    def _withdraw(self, waiter):
+        """Takes a waiter out of the queue; True if it was admitted meanwhile."""
+        with self._lock:
+            if waiter.admitted:
+                return True
+            self._queues[waiter.small].remove(waiter)
+            self.queued_bytes -= waiter.weight
+            return False
+
+    def _time_out(self, waiter):
+        if self._withdraw(waiter):
+            return
+        with self._lock:
+            self.rejections['timeout'] += 1
+            raise Overloaded(503, 'timeout', self._retry_after())
+
+    def _admitted(self, queued_at):
+        waited = self.clock() - queued_at
+        with self._lock:
+            self.admitted += 1
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return self.clock()
+
+    def _release(self, size, started=None):
+        seconds = None if started is None else self.clock() - started
+        with self._lock:
+            self.running -= 1
+            self.running_large -= size > self.small_bytes
+            if size and seconds:
+                rate = size / seconds
+                self._rate = rate if self._rate is None else 0.8 * self._rate + 0.2 * rate
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, size):
+        """Holds a conversion slot for `size` characters, waiting for one if needed."""
+        queued_at = self.clock()
+        event = threading.Event()
+        waiter = self._enqueue(size, event.set)
+        if waiter is not None and not event.wait(self.max_wait):
+            self._time_out(waiter)
+        started = self._admitted(queued_at)
+        try:
+            yield
+        finally:
+            self._release(size, started)
+
+    @asynccontextmanager
+    async def async_slot(self, size):
+        """Like `slot`, waiting on the event loop rather than in a thread."""
+        queued_at = self.clock()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enqueue(size, lambda: loop.call_soon_threadsafe(_resolve, future))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            except asyncio.TimeoutError:
+                self._time_out(waiter)
+            except asyncio.CancelledError:
+                if self._withdraw(waiter):
+                    self._release(size)
+                raise
+        started = self._admitted(queued_at)
+        try:
+            yield
+        finally:
+            self._release(size, started)
+
+    def reject_too_large(self):
+        with self._lock:
+            self.rejections['too_large'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'running': self.running,
+                'queued': {'small': len(self._queues[True]), 'large': len(self._queues[False])},
+                'queued_bytes': self.queued_bytes,
+                'max_queue_bytes': self.max_queue_bytes,
+                'admitted': self.admitted,
+                'rejections': dict(self.rejections),
+                'wait_seconds_total': self.wait_seconds_total,
+                'max_wait_seconds': self.max_wait_seconds,
+            }
@@ -1,13 +1,41 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Request, Response, request, render_template, jsonify, make_response, stream_with_context
 from flask_cors import CORS  # Import flask-cors
 import re
+import codecs
+import io
+import json
+from array import array
 from enum import Enum
-import sys
+import bisect
+import contextvars
+import multiprocessing
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+from contextlib import ExitStack, contextmanager
+import os
+import queue
+import threading
+import uuid
 import requests as http_requests
 from datetime import datetime
 
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import cached_property
 import mwparserfromhell
-from mwparserfromhell.nodes import Tag
+from mwparserfromhell.nodes import Tag, Template, Text
+
+from admission import AdmissionControl, Overloaded
+from compression import REQUEST_ENCODINGS, DecompressingStream, compress, negotiate
+from conversion_cache import ConversionCache, DocumentStore, FragmentMemo, SingleFlight
+from engine import ConversionAborted, ConversionBudget, ConversionEngine, ConversionError, ConversionTimeout
+from instrumentation import (
+    Metrics, format_prometheus, instrumented, phase, profile_samples, record_markup, run_profiled,
+)
+from last_updated import UNAVAILABLE, LastUpdatedCache, read_static_date
+from link_classification import LinkKind, load_link_classifier
+from prerendered import PrerenderedPages
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -21,20 +49,22 @@ CSP_POLICY = (
     "font-src 'self' https://tools-static.wmflabs.org data:"
 )
 
+def _fetch_last_updated_date():
+    resp = http_requests.get(
+        "https://api.github.com/repos/indictechcom/translatable-wikitext-converter/commits",
+        timeout=5,
+    )
+    data = resp.json()
+    if data and isinstance(data, list) and len(data) > 0:
+        raw = data[0]["commit"]["committer"]["date"]
+        dt = datetime.strptime(raw, "%Y-%m-%dT%H:%M:%SZ")
+        return dt.strftime("%B %-d, %Y")
+    return None
+
+last_updated_cache = LastUpdatedCache(_fetch_last_updated_date, static_value=read_static_date())
+
 def get_last_updated_date():
-    try:
-        resp = http_requests.get(
-            "https://api.github.com/repos/indictechcom/translatable-wikitext-converter/commits",
-            timeout=5,
-        )
-        data = resp.json()
-        if data and isinstance(data, list) and len(data) > 0:
-            raw = data[0]["commit"]["committer"]["date"]
-            dt = datetime.strptime(raw, "%Y-%m-%dT%H:%M:%SZ")
-            return dt.strftime("%B %-d, %Y")
-    except Exception:
-        pass
-    return "Unavailable"
+    return last_updated_cache.get()
 
 @app.after_request
 def set_security_headers(response):
@@ -75,6 +105,7 @@ def is_emoji_unicode(char):
     # Add more ranges as needed for full coverage
     return False
 
+@instrumented
 def _wrap_in_translate(text):
     """
     Wraps the given text with <translate> tags.
@@ -85,25 +116,17 @@ def _wrap_in_translate(text):
     if not text or not text.strip():
         return text
 
-    # Find the first and last non-whitespace characters
-    first_char_index = -1
-    last_char_index = -1
-    for i, char in enumerate(text):
-        if char not in (' ', '\n', '\t', '\r', '\f', '\v'): # Check for common whitespace characters
-            if first_char_index == -1:
-                first_char_index = i
-            last_char_index = i
-
-    # If no non-whitespace characters are found (should be caught by text.strip() check, but for robustness)
-    if first_char_index == -1:
-        return text
+    # Find the first and last characters that are not common whitespace
+    content = text.lstrip(' \n\t\r\f\v')
+    first_char_index = len(text) - len(content)
+    content = content.rstrip(' \n\t\r\f\v')
 
     leading_whitespace = text[:first_char_index]
-    content = text[first_char_index : last_char_index + 1]
-    trailing_whitespace = text[last_char_index + 1 :]
+    trailing_whitespace = text[first_char_index + len(content):]
 
     return f"{leading_whitespace}<translate>{content}</translate>{trailing_whitespace}"
 
+@instrumented
 def process_syntax_highlight(text):
     """
     Processes <syntaxhighlight> tags in the wikitext.
@@ -124,40 +147,115 @@ def process_syntax_highlight(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+# --- Shared parsing ---
+# With the "shared" parser, a table is parsed once with mwparserfromhell: the
+# nested tables and templates of its cells are part of that parse. While a
+# cell is converted, their nodes are offered to the handlers, which use them
+# instead of parsing the same text again, and the converted cell is stored as
+# a text node rather than parsed once more. The "fragment" parser parses every
+# table and template on its own.
+parsers = ('shared', 'fragment')
+_active_parser = contextvars.ContextVar('parser', default='shared')
+# Text -> parsed nodes with that text, for the cell being converted.
+_parsed_nodes = contextvars.ContextVar('parsed_nodes', default=None)
+
+def _take_parsed_node(text):
+    nodes = _parsed_nodes.get()
+    if nodes:
+        same = nodes.get(text)
+        if same:
+            return same.pop()
+    return None
+
+def _collect_parsed_nodes(nodes, found):
+    # The tables and templates the scanner may hand to a handler: those of
+    # the cell itself and of the tags (e.g. <div>) whose content it scans.
+    for node in nodes:
+        if isinstance(node, Template) or (isinstance(node, Tag) and node.tag == 'table'):
+            found.setdefault(str(node), []).append(node)
+        elif isinstance(node, Tag) and node.contents is not None:
+            _collect_parsed_nodes(node.contents.nodes, found)
+    return found
+
+def _convert_cell(contents, start=None):
+    # `start`: the offset of the cell's content in the text whose units are
+    # collected, if they are
+    cell_content = str(contents)
+    if _active_parser.get() != 'shared':
+        return _convert_cell_content(cell_content, start)
+    token = _parsed_nodes.set(_collect_parsed_nodes(contents.nodes, {}))
+    try:
+        return Text(_convert_cell_content(cell_content, start))
+    finally:
+        _parsed_nodes.reset(token)
+
+def _convert_cell_content(cell_content, start):
+    units = _active_units.get()
+    if start is None or units is None:
+        return _convert_fragment(cell_content)
+    out = []
+    with units.cell(start, cell_content, out):
+        _convert_fragment(cell_content, out)
+    return ''.join(out)
+
+def _content_offset(node, text):
+    # Offset of the contents of the tag `node` in its text
+    if node.wiki_markup:
+        closing = node.closing_wiki_markup or ''
+    elif node.self_closing or node.implicit:
+        closing = ''
+    else:
+        closing = f'</{node.closing_tag}>'
+    return len(text) - len(closing) - len(str(node.contents))
+
+@instrumented
 def process_table(text):
     """
     Processes table blocks in the wikitext using mwparserfromhell.
     It identifies cells (td, th) and wraps their content in <translate> tags,
     handling nested structures and pipes correctly.
     """
-    try:
-        wikicode = mwparserfromhell.parse(text)
-    except Exception as e:
-        print(f"Error parsing table: {e}")
-        return text
+    table = _take_parsed_node(text)
+    if table is not None:
+        wikicode = table
+    else:
+        try:
+            wikicode = mwparserfromhell.parse(text)
+        except Exception as e:
+            print(f"Error parsing table: {e}")
+            return text
 
-    if not wikicode.nodes:
-        return text
+        if not wikicode.nodes:
+            return text
 
-    table = wikicode.nodes[0]
-    if not isinstance(table, Tag):
-        return text
+        table = wikicode.nodes[0]
+        if not isinstance(table, Tag):
+            return text
+
+    # When the units of the conversion are collected, each cell is converted
+    # knowing the offset of its content in the text.
+    units = _active_units.get()
 
-    def process_cells(nodes):
+    def process_cells(nodes, offset=None):
         for node in nodes:
+            text = str(node) if offset is not None else None
             if isinstance(node, Tag):
+                start = None if offset is None else offset + _content_offset(node, text)
                 if node.tag in ('td', 'th'):
-                    cell_content = str(node.contents)
-                    if cell_content.strip():
-                         node.contents = convert_to_translatable_wikitext(cell_content)
+                    if str(node.contents).strip():
+                         node.contents = _convert_cell(node.contents, start)
                 elif node.tag == 'tr':
-                    process_cells(node.contents.nodes)
+                    process_cells(node.contents.nodes, start)
+            if offset is not None:
+                offset += len(text)
     
     if hasattr(table, 'contents'):
-        process_cells(table.contents.nodes)
+        offset = None if units is None else units.part_start + _content_offset(table, str(table))
+        process_cells(table.contents.nodes, offset)
 
     return str(wikicode)
 
+@instrumented
 def process_blockquote(text):
     """
     Processes blockquote tags in the wikitext.
@@ -177,6 +275,7 @@ def process_blockquote(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+@instrumented
 def process_poem_tag(text):
     """
     Processes <poem> tags in the wikitext.
@@ -196,6 +295,7 @@ def process_poem_tag(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+@instrumented
 def process_formatting_tag(text, tag_name="center"):
     """
     Processes formatting tags like <center> or <big> by keeping the structural 
@@ -222,6 +322,7 @@ def process_formatting_tag(text, tag_name="center"):
     processed_content = convert_to_translatable_wikitext(content)
     return f"{prefix}{processed_content}{suffix}"
 
+@instrumented
 def process_code_tag(text, tvar_code_id=0):
     """
     Processes <code> tags in the wikitext.
@@ -242,6 +343,7 @@ def process_code_tag(text, tvar_code_id=0):
     wrapped_content = f'<tvar name="code{tvar_code_id}">{prefix}{content}{suffix}</tvar>'
     return wrapped_content
 
+@instrumented
 def process_div(text):
     """
     Processes <div> tags in the wikitext.
@@ -261,6 +363,7 @@ def process_div(text):
     processed_content = convert_to_translatable_wikitext(content)
     return f"{prefix}{processed_content}{suffix}"
 
+@instrumented
 def process_hiero(text):
     """
     Processes <hiero> tags in the wikitext.
@@ -280,6 +383,7 @@ def process_hiero(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+@instrumented
 def process_sub_sup(text):
     """
     Processes <sub> and <sup> tags in the wikitext.
@@ -300,6 +404,7 @@ def process_sub_sup(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+@instrumented
 def process_math(text):
     """
     Processes <math> tags in the wikitext.
@@ -308,6 +413,7 @@ def process_math(text):
     assert(text.startswith('<math>') and text.endswith('</math>')), "Invalid math tag"
     return text
 
+@instrumented
 def process_small_tag(text):
     """
     Processes <small> tags in the wikitext.
@@ -327,6 +433,7 @@ def process_small_tag(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+@instrumented
 def process_existing_translate(text):
     """
     Processes existing <translate> tags in the wikitext.
@@ -344,6 +451,7 @@ def process_existing_translate(text):
     # Process the content through the converter (it will add translate tags as needed)
     return convert_to_translatable_wikitext(content)
 
+@instrumented
 def process_nowiki(text):
     """
     Processes <nowiki> tags in the wikitext.
@@ -363,6 +471,7 @@ def process_nowiki(text):
     wrapped_content = _wrap_in_translate(content)
     return f"{prefix}{wrapped_content}{suffix}"
 
+@instrumented
 def process_item(text):
     """
     Processes list items in the wikitext.
@@ -393,20 +502,26 @@ class double_brackets_types(Enum):
     special = 5
     invalid_file = 6
 
+# Namespaces and interwiki prefixes of the wiki, loaded once (see WIKI_CONFIG)
+link_classifier = load_link_classifier()
+
+# Results of the link and template handlers for fragments seen before by this
+# process (see FRAGMENT_MEMO_ENTRIES)
+fragment_memo = FragmentMemo(int(os.environ.get('FRAGMENT_MEMO_ENTRIES', 4096)))
+
+# Define keywords that should NOT be translated when found as file parameters
+NON_TRANSLATABLE_KEYWORDS = frozenset({
+    'left', 'right', 'centre', 'center', 'thumb', 'frameless', 'border', 'none', 
+    'upright', 'baseline', 'middle', 'sub', 'super', 'text-top', 'text-bottom', '{{dirstart}}', '{{dirend}}'
+})
+NON_TRANSLATABLE_KEYWORDS_PREFIXES = ('link=', 'upright=', 'alt=')
+NOT_INLINE_KEYWORDS = frozenset({
+    'left', 'right', 'centre', 'center', 'thumb', 'frameless', 'border', 'none', '{{dirstart}}', '{{dirend}}'
+})
+pixel_regex = re.compile(r'\d+(?:x\d+)?px')  # Matches pixel values like "100px" or "100x50px)"
+
+@instrumented
 def _process_file(s, tvar_inline_icon_id=0): 
-    # Define keywords that should NOT be translated when found as parameters
-    NON_TRANSLATABLE_KEYWORDS = {
-        'left', 'right', 'centre', 'center', 'thumb', 'frameless', 'border', 'none', 
-        'upright', 'baseline', 'middle', 'sub', 'super', 'text-top', 'text-bottom', '{{dirstart}}', '{{dirend}}'
-    }
-    NON_TRANSLATABLE_KEYWORDS_PREFIXES = {
-        'link=', 'upright=', 'alt='
-    }
-    NOT_INLINE_KEYWORDS = {
-        'left', 'right', 'centre', 'center', 'thumb', 'frameless', 'border', 'none', '{{dirstart}}', '{{dirend}}'
-    }
-    file_aliases = ['File:', 'file:', 'Image:', 'image:']
-
     tokens = []
     
     inner_content = s[2:-2]  # Remove the leading [[ and trailing ]]
@@ -415,8 +530,8 @@ def _process_file(s, tvar_inline_icon_id=0):
     
     # The first token shall start with a file alias
     # e.g., "File:Example.jpg" or "Image:Example.png"
-    if not tokens or not tokens[0].startswith(tuple(file_aliases)):
-        return line, double_brackets_types.invalid_file
+    if not tokens or link_classifier.classify(tokens[0]) is not LinkKind.file:
+        return s, double_brackets_types.invalid_file
     
     # The first token is a file link
     filename = tokens[0].split(':', 1)[1] if ':' in tokens[0] else tokens[0]
@@ -448,7 +563,7 @@ def _process_file(s, tvar_inline_icon_id=0):
             elif token not in NON_TRANSLATABLE_KEYWORDS:
                 is_inline_icon = False
                 break
-            elif any(token.startswith(prefix) for prefix in NON_TRANSLATABLE_KEYWORDS_PREFIXES):
+            elif token.startswith(NON_TRANSLATABLE_KEYWORDS_PREFIXES):
                 is_inline_icon = False
                 break
         
@@ -467,7 +582,6 @@ def _process_file(s, tvar_inline_icon_id=0):
     # We substitute any occurrences of "Image:" with "File:"
     output_parts.append(tokens[0])
 
-    pixel_regex = re.compile(r'\d+(?:x\d+)?px')  # Matches pixel values like "100px" or "100x50px)"
     for token in tokens[1:]:
         # Check for 'alt='
         if token.startswith('alt='):
@@ -477,7 +591,7 @@ def _process_file(s, tvar_inline_icon_id=0):
         elif token in NON_TRANSLATABLE_KEYWORDS:
             output_parts.append(token)
         # If the token starts with a known non-translatable prefix, keep it as is
-        elif any(token.startswith(prefix) for prefix in NON_TRANSLATABLE_KEYWORDS_PREFIXES):
+        elif token.startswith(NON_TRANSLATABLE_KEYWORDS_PREFIXES):
             output_parts.append(token)
         # If the token is a pixel value, keep it as is
         elif pixel_regex.match(token):
@@ -490,14 +604,15 @@ def _process_file(s, tvar_inline_icon_id=0):
     returnline = '[[' + '|'.join(output_parts) + ']]' 
     return returnline, double_brackets_types.not_inline_icon_file
     
+@instrumented
+@fragment_memo.memoize(numbered=True)
 def process_double_brackets(text, tvar_id=0):
     """
     Processes internal links in the wikitext.
     Wraps content in <translate> tags or adds MyLanguage prefix for normal links.
     """
     if not (text.startswith("[[") and text.endswith("]]")):
-        print(f"Input >{text}< must be wrapped in double brackets [[ ]]")
-        sys.exit(1)
+        raise ConversionAborted('malformed', f"Input >{text}< must be wrapped in double brackets [[ ]]")
     
     if '<tvar' in text:
         return text, double_brackets_types.wikilink
@@ -516,45 +631,18 @@ def process_double_brackets(text, tvar_id=0):
             parts = [s[:first], s[first + 1:]]    
 
 
-    category_aliases = ['Category:', 'category:', 'Cat:', 'cat:']
-    file_aliases = ['File:', 'file:', 'Image:', 'image:']
-    skip_namespaces = category_aliases + file_aliases + ['Special:', 'User:', 'User talk:']
-
-    # Known internal MediaWiki namespace prefixes — anything else with a colon is an interwiki link
-    internal_namespaces = {
-        'Talk:', 'talk:', 'User:', 'user:', 'User talk:', 'user talk:',
-        'Project:', 'project:', 'Project talk:', 'project talk:',
-        'File:', 'file:', 'File talk:', 'file talk:',
-        'MediaWiki:', 'mediawiki:', 'MediaWiki talk:', 'mediawiki talk:',
-        'Template:', 'template:', 'Template talk:', 'template talk:',
-        'Help:', 'help:', 'Help talk:', 'help talk:',
-        'Category:', 'category:', 'Category talk:', 'category talk:',
-        'Special:', 'special:', 'Media:', 'media:',
-        'Image:', 'image:', 'Image talk:', 'image talk:',
-        'Cat:', 'cat:',
-    }
-    inter_language_prefixes = {
-    'en','fr','de','es','it','pt','nl','pl','ru','ja','zh','ar','hi','bn','ta',
-    'te','ml','kn','mr','gu','pa','or','as','ur','fa','he','ko','vi','th','id',
-    'ms','tr','uk','cs','sv','fi','da','no','nb','nn','el','hu','ro','bg','sr',
-    'hr','sk','sl','et','lv','lt','ca','eu','gl','ga','cy','is','sq','simple',
-}
-
-    ns = None
-    if ':' in parts[0]:
-        ns = parts[0].split(':', 1)[0] + ':'
-
-    if parts[0].startswith(tuple(category_aliases)):
-        cat_name = parts[0].split(':', 1)[1] if ':' in parts[0] else parts[0]
+    kind = link_classifier.classify(parts[0])
+    if kind is LinkKind.category:
+        cat_name = parts[0].split(':', 1)[1]
         return f'[[Category:{cat_name}{{{{#translation:}}}}]]', double_brackets_types.category
-    if parts[0].startswith(tuple(file_aliases)):
+    if kind is LinkKind.file:
         return _process_file(text)
-    if ns in skip_namespaces:
-        return text, double_brackets_types.special if ns == 'Special:' else double_brackets_types.wikilink
-    if ns is not None and ns[:-1].lower() in inter_language_prefixes:
+    if kind is LinkKind.special:
+        return text, double_brackets_types.special
+    if kind is LinkKind.kept or kind is LinkKind.interlanguage:
         return text, double_brackets_types.wikilink
     # Interwiki links: colon-prefixed but not a known internal MediaWiki namespace
-    if ns is not None and ns not in internal_namespaces:
+    if kind is LinkKind.interwiki:
         link_target = capitalise_first_letter(parts[0])
         display_text = parts[0] if len(parts) == 1 else parts[1]
         return f'[[<tvar name="{tvar_id}">{link_target}</tvar>|{display_text}]]', double_brackets_types.wikilink
@@ -566,12 +654,15 @@ def process_double_brackets(text, tvar_id=0):
     return text
 
 
+external_link_pattern = re.compile(r'\[(https?://[^\s]+)\s+([^\]]+)\]')
+
+@instrumented
 def process_external_link(text, tvar_url_id=0):
     """
     Processes external links in the format [http://example.com Description] and ensures
     that only the description part is wrapped in <translate> tags, leaving the URL untouched.
     """
-    match = re.match(r'\[(https?://[^\s]+)\s+([^\]]+)\]', text)
+    match = external_link_pattern.match(text)
 
     if match:
         url_part = match.group(1)
@@ -580,15 +671,58 @@ def process_external_link(text, tvar_url_id=0):
         return f'[<tvar name="url{tvar_url_id}">{url_part}</tvar> {description_part}]'
     return text
 
+# Templates made of plain text only: no markup that mwparserfromhell would
+# turn into nodes (links, tags, entities, style quotes, free URLs, nested
+# templates), and no line starting a list, heading or rule.
+simple_template = re.compile(r"\{\{[^{}\[\]<>&'|\n\0]*[^{}\[\]<>&'|\s\0][^{}\[\]<>&'|\n\0]*\s*(?:\|[^{}\[\]<>&':|\0]*)*\}\}")
+template_line_markup = re.compile(r'\n[=*#:;-]')
+
+def _process_simple_template(text):
+    """
+    Same as `process_template` for a template matching `simple_template`,
+    without parsing it: the parameters are split on "|" and numbered the way
+    mwparserfromhell numbers them.
+    """
+    pieces = text[2:-2].split('|')
+    target = None
+    position = 0
+    for i in range(1, len(pieces)):
+        name, equals, _ = pieces[i].partition('=')
+        if not equals:
+            position += 1
+            name = str(position)
+        if name.strip() == '2':
+            target = i
+    if target is None:
+        return text
+    name, equals, value = pieces[target].partition('=')
+    if not equals:
+        name, value = '', name
+    # What strip_code() makes of plain text
+    value = value.strip('\n')
+    while '\n\n\n' in value:
+        value = value.replace('\n\n\n', '\n\n')
+    pieces[target] = f"{name}{equals}2=<translate>{value}</translate>"
+    return '{{' + '|'.join(pieces) + '}}'
+
+@instrumented
+@fragment_memo.memoize()
 def process_template(text):
     """
     Processes the text to ensure that only the content outside of double curly braces {{ ... }} is wrapped in <translate> tags,
     while preserving the template content inside the braces without translating it.
     """
     assert(text.startswith('{{') and text.endswith('}}')), "Invalid template tag"
-    # Split the template content from the rest of the text
-    code = mwparserfromhell.parse(text)
-    template = code.filter_templates()[0]
+    shared = _active_parser.get() == 'shared'
+    if shared and simple_template.fullmatch(text) and not template_line_markup.search(text):
+        return _process_simple_template(text)
+    code = _take_parsed_node(text) if shared else None
+    if code is not None:
+        template = code
+    else:
+        # Split the template content from the rest of the text
+        code = mwparserfromhell.parse(text)
+        template = code.filter_templates()[0]
 
     if template.has(2):
         param = template.get(2)
@@ -598,13 +732,16 @@ def process_template(text):
 
 
 # --- Section Heading Handler ---
+section_heading_pattern = re.compile(r'^(=+)([^=]+)(=+)$')
+
+@instrumented
 def process_section_heading(text):
     """
     Processes section headings like ==Title== and wraps the entire heading in <translate> tags,
     with the tags on their own lines per MediaWiki translation guidelines.
     """
     # Match ==Title==, ===Subsection===, etc.
-    match = re.match(r'^(=+)([^=]+)(=+)$', text.strip())
+    match = section_heading_pattern.match(text.strip())
     if not match:
         return text
     level = match.group(1)
@@ -612,6 +749,7 @@ def process_section_heading(text):
     # Wrap the entire heading (including == markers) in <translate> tags on their own lines
     return f'<translate>\n{level}{heading_text}{level}\n</translate>'
 
+@instrumented
 def process_raw_url(text):
     """
     Processes raw URLs in the wikitext.
@@ -624,23 +762,24 @@ def process_raw_url(text):
     return text.strip()
 
 
-def _find_balanced_close_tag(wikitext, start, open_tag, close_tag, open_check_chars=None):
+def _find_balanced_close_tag(wikitext, start, open_tag, close_tag, open_check_chars=None, end=None):
     """
     Find the position after the balanced close_tag matching the open_tag at `start`.
     Handles nesting by counting opening and closing occurrences.
     open_check_chars: if given, the character immediately after open_tag must be in
                       this set for a candidate to count as a real opening tag.
-    Returns end position (exclusive) or len(wikitext) as a fallback.
+    end: end of the span being scanned (defaults to the end of the text).
+    Returns end position (exclusive) or `end` as a fallback.
     """
     count = 1
     pos = start + len(open_tag)
     open_len = len(open_tag)
     close_len = len(close_tag)
-    n = len(wikitext)
+    n = len(wikitext) if end is None else end
 
     while pos < n and count > 0:
-        next_open = wikitext.find(open_tag, pos)
-        next_close = wikitext.find(close_tag, pos)
+        next_open = wikitext.find(open_tag, pos, n)
+        next_close = wikitext.find(close_tag, pos, n)
 
         if next_close == -1:
             return n  # Malformed; treat rest of text as part of the tag
@@ -662,8 +801,16 @@ def _find_balanced_close_tag(wikitext, start, open_tag, close_tag, open_check_ch
 #  <tvar> renumbering 
 tvar_name = re.compile(r'<tvar\s+name=(?:"[^"]*"|[^\s">]+)\s*>')
 boundary_pattern = re.compile(r'(\n[ \t]*\n|</?translate>)')
+# A <tvar> whatever its name, and its value
+tvar_element = re.compile(r'<tvar\s+name=(?:"[^"]*"|[^\s">]+)\s*>(.*?)</tvar>', re.DOTALL)
 
-def renumber_tvars_per_unit(text):
+# Either a translation unit boundary (group 1) or a <tvar> opening tag
+unit_token = re.compile(r'(\n[ \t]*\n|</?translate>)|<tvar\s+name=(?:"[^"]*"|[^\s">]+)\s*>')
+
+class _TvarAcrossBoundary(Exception):
+    pass
+
+def _renumber_tvars_per_piece(text):
     out = []
     for piece in boundary_pattern.split(text):
         if boundary_pattern.fullmatch(piece):
@@ -676,431 +823,1727 @@ def renumber_tvars_per_unit(text):
         out.append(tvar_name.sub(_repl, piece))
     return ''.join(out)
 
+def renumber_tvars_per_unit(text):
+    """
+    Numbers the <tvar>s of every translation unit from 1, in a single pass
+    over the text. A <tvar> tag that would contain a boundary (a newline or
+    a tag in its name) is only matched within each unit, so such text goes
+    through the boundaries and the units separately instead.
+    """
+    if '<tvar' not in text:
+        return text
+    counter = 0
+
+    def _repl(match):
+        nonlocal counter
+        if match.group(1) is not None:
+            counter = 0
+            return match.group(1)
+        tag = match.group()
+        if '\n' in tag or '<' in tag[1:]:
+            raise _TvarAcrossBoundary
+        counter += 1
+        return f'<tvar name="{counter}">'
+
+    try:
+        return unit_token.sub(_repl, text)
+    except _TvarAcrossBoundary:
+        return _renumber_tvars_per_piece(text)
+
 
 # --- Main Tokenisation Logic ---
+# The scanner splits a span of the text into (text, handler) parts, held in a
+# `SpanTable` as offsets into the text. Each construct it recognises is
+# described by a rule: a function that is tried at position `curr` and, when
+# the construct starts there, adds the pending text and the construct itself
+# to `parts` and returns the position right after it. Rules return None when
+# they do not apply. `text_length` is the end of the span: rules never look
+# past it.
+#
+# Containers whose content is converted in turn (<div>, <center>, <big>,
+# existing <translate> blocks and list items) are not copied out and
+# re-converted later: their content is scanned right away, as a span of the
+# same text, into a `Container` part. A conversion is thus tokenized once,
+# into a tree, and its <tvar>s are renumbered once at the end. The `kind` of
+# a container is the kind of the translation units within it (list items),
+# or None when they keep the kind they would have outside it.
+
+heading_line = re.compile(r'^(=+)[^=]+(=+)$')
+non_space = re.compile(r'\S')
+
+Container = namedtuple('Container', ['prefix', 'children', 'suffix', 'kind'], defaults=(None,))
+
+# Handlers of the parts in a SpanTable, by code.
+part_handlers = []
+_handler_codes = {}
+
+def _handler_code(handler):
+    code = _handler_codes.get(handler)
+    if code is None:
+        code = _handler_codes[handler] = len(part_handlers)
+        part_handlers.append(handler)
+    return code
+
+class SpanTable:
+    """
+    The parts of a span of `text`, as columns: part i covers
+    text[starts[i]:ends[i]] and is rendered by part_handlers[codes[i]]. A part
+    that is a Container has it in `nodes`. The text of a part is only cut out
+    when the part is read, e.g. by its handler.
+
+    Iterating gives (part, handler) pairs, a part being its text or its
+    Container.
+    """
+    __slots__ = ('text', 'starts', 'ends', 'codes', 'nodes')
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = array('q')
+        self.ends = array('q')
+        self.codes = array('B')
+        self.nodes = {}
+
+    def add(self, start, end, handler):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.codes.append(_handler_code(handler))
+
+    def add_node(self, start, end, node, handler):
+        self.nodes[len(self.codes)] = node
+        self.add(start, end, handler)
+
+    def handler(self, i):
+        return part_handlers[self.codes[i]]
+
+    def part_text(self, i):
+        return self.text[self.starts[i]:self.ends[i]]
+
+    def size(self):
+        # Characters of text parts, as _parts_size counts them
+        return sum(self.ends[i] - self.starts[i] for i in range(len(self.codes)) if i not in self.nodes)
+
+    def head(self, count):
+        """Returns a table of the first `count` parts."""
+        head = SpanTable(self.text)
+        head.starts = self.starts[:count]
+        head.ends = self.ends[:count]
+        head.codes = self.codes[:count]
+        head.nodes = {i: node for i, node in self.nodes.items() if i < count}
+        return head
+
+    def extend(self, other, first, last):
+        """Appends parts `first` to `last` - 1 of `other`, a table of the same text."""
+        offset = len(self.codes) - first
+        for i, node in other.nodes.items():
+            if first <= i < last:
+                self.nodes[i + offset] = node
+        self.starts.extend(other.starts[first:last])
+        self.ends.extend(other.ends[first:last])
+        self.codes.extend(other.codes[first:last])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        for i in range(len(self.codes)):
+            node = self.nodes.get(i)
+            yield (self.part_text(i) if node is None else node), self.handler(i)
+
+    def __eq__(self, other):
+        if not isinstance(other, (SpanTable, list)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f'SpanTable({list(self)!r})'
+
+@instrumented
+def _passthrough(text):
+    return text
 
-def convert_to_translatable_wikitext(wikitext):
+@instrumented
+def _process_center_tag(text):
+    return process_formatting_tag(text, "center")
+
+@instrumented
+def _process_big_tag(text):
+    return process_formatting_tag(text, "big")
+
+def _scan_span(wikitext, start, end):
+    return tokenizers[_active_tokenizer.get()](wikitext, start, end)
+
+def _flush_text(last, curr, parts):
+    if last < curr:
+        parts.add(last, curr, _wrap_in_translate)
+
+def _find_close(wikitext, close_tag, curr, text_length):
+    """
+    Returns the position after the first `close_tag` at or after `curr`.
+    A missing close tag makes the construct run to the end of the span,
+    where its handler rejects it.
+    """
+    end = wikitext.find(close_tag, curr, text_length)
+    return text_length if end == -1 else end + len(close_tag)
+
+def _scan_section_heading(wikitext, curr, last, text_length, parts):
+    if not wikitext.startswith('=', curr, text_length):
+        return None
+    # Find the end of the line
+    end_line = wikitext.find('\n', curr, text_length)
+    if end_line == -1:
+        end_line = text_length
+    if not heading_line.match(wikitext[curr:end_line].strip()):
+        return None
+    _flush_text(last, curr, parts)
+    parts.add(curr, end_line, process_section_heading)
+    return end_line
+
+def _closed_tag_rule(open_tag, close_tag, handler, container=None):
+    """
+    Builds a rule for a tag that runs from `open_tag` up to the first
+    following `close_tag`. `container(wikitext, start, end)` returns the
+    `Container` for a tag whose content is converted, or None to leave the
+    tag to `handler`.
+    """
+    def rule(wikitext, curr, last, text_length, parts):
+        if not wikitext.startswith(open_tag, curr, text_length):
+            return None
+        end_pattern = _find_close(wikitext, close_tag, curr, text_length)
+        _flush_text(last, curr, parts)
+        node = container(wikitext, curr, end_pattern) if container else None
+        if node is None:
+            parts.add(curr, end_pattern, handler)
+        else:
+            parts.add_node(curr, end_pattern, node, _render_container)
+        return end_pattern
+    return rule
+
+def _content_container(wikitext, prefix, content_start, content_end, suffix):
+    # Empty or whitespace-only content is left to the handler, which keeps it.
+    if content_start >= content_end or not non_space.search(wikitext, content_start, content_end):
+        return None
+    return Container(prefix, _scan_span(wikitext, content_start, content_end), suffix)
+
+def _formatting_tag_container(tag_name):
+    # Same split as process_formatting_tag
+    open_tag = f"<{tag_name}>"
+    close_tag = f"</{tag_name}>"
+
+    def container(wikitext, start, end):
+        if not wikitext.endswith(close_tag, start, end):
+            return None
+        return _content_container(wikitext, open_tag, start + len(open_tag), end - len(close_tag), close_tag)
+    return container
+
+def _existing_translate_container(wikitext, start, end):
+    # Same split as process_existing_translate: the old tags are dropped
+    if not wikitext.endswith('</translate>', start, end):
+        return None
+    return _content_container(wikitext, '', start + len('<translate>'), end - len('</translate>'), '')
+
+def _literal_rule(*literals):
+    """
+    Builds a rule for fixed strings (e.g. <br>) that are kept as they are.
+    """
+    def rule(wikitext, curr, last, text_length, parts):
+        for literal in literals:
+            if wikitext.startswith(literal, curr, text_length):
+                end_pattern = curr + len(literal)
+                _flush_text(last, curr, parts)
+                parts.add(curr, end_pattern, _passthrough)
+                return end_pattern
+        return None
+    return rule
+
+def _scan_table(wikitext, curr, last, text_length, parts):
+    # Table block — use balanced matching so nested tables are handled correctly
+    if not wikitext.startswith('{|', curr, text_length):
+        return None
+    end_pattern = _find_balanced_close_tag(wikitext, curr, '{|', '|}', end=text_length)
+    _flush_text(last, curr, parts)
+    parts.add(curr, end_pattern, process_table)
+    return end_pattern
+
+div_open_check_chars = {'>', ' ', '\t', '\n', '/'}
+
+def _scan_div(wikitext, curr, last, text_length, parts):
+    # Div tag — use balanced matching so nested <div>s are handled correctly
+    if not (wikitext.startswith('<div', curr, text_length) and (
+        curr + 4 >= text_length or wikitext[curr + 4] in div_open_check_chars
+    )):
+        return None
+    end_pattern = _find_balanced_close_tag(
+        wikitext, curr, '<div', '</div>',
+        open_check_chars=div_open_check_chars, end=text_length
+    )
+    _flush_text(last, curr, parts)
+    node = None
+    if wikitext.endswith('</div>', curr, end_pattern):
+        # Same split as process_div
+        start_tag_end = wikitext.find('>', curr, end_pattern) + 1
+        node = _content_container(
+            wikitext, wikitext[curr:start_tag_end], start_tag_end, end_pattern - len('</div>'), '</div>'
+        )
+    if node is None:
+        parts.add(curr, end_pattern, process_div)
+    else:
+        parts.add_node(curr, end_pattern, node, _render_container)
+    return end_pattern
+
+def _list_item_container(wikitext, start, end):
+    # Same split as process_item
+    if wikitext.startswith((';', ':'), start, end):
+        offset = start + 1
+    else:
+        marker = wikitext[start]
+        offset = start
+        while offset < end and wikitext[offset] == marker:
+            offset += 1
+        if offset == end:
+            return None
+    match = non_space.search(wikitext, offset, end)
+    if match is None:
+        return None
+    content_end = end
+    while wikitext[content_end - 1].isspace():
+        content_end -= 1
+    return Container(wikitext[start:offset] + ' ', _scan_span(wikitext, match.start(), content_end), '\n', 'list_item')
+
+def _scan_list_items(wikitext, curr, text_length, parts):
+    # Iterate through the list items
+    while wikitext.startswith(('*', '#', ':', ';'), curr, text_length):
+        end_pattern = wikitext.find('\n', curr, text_length)
+        if end_pattern == -1:
+            end_pattern = text_length
+        else :
+            end_pattern += 1 # Include the newline in the part
+        node = _list_item_container(wikitext, curr, end_pattern)
+        if node is None:
+            parts.add(curr, end_pattern, process_item)
+        else:
+            parts.add_node(curr, end_pattern, node, _render_container)
+        curr = end_pattern
+    return curr
+
+def _scan_list(wikitext, curr, last, text_length, parts):
+    if not (wikitext.startswith('\n', curr, text_length) and wikitext.startswith(('*', '#', ':', ';'), curr + 1, text_length)):
+        return None
+    curr += 1 # Discard the newline character
+    parts.add(last, curr, _wrap_in_translate)
+    return _scan_list_items(wikitext, curr, text_length, parts)
+
+def _scan_internal_link(wikitext, curr, last, text_length, parts):
+    if not wikitext.startswith('[[', curr, text_length):
+        return None
+    # Count the number of opening double brackets '[[' and closing ']]' to find the end
+    end_pos = curr + 2
+    bracket_count = 1
+    while end_pos < text_length and bracket_count > 0:
+        if wikitext.startswith('[[', end_pos, text_length):
+            bracket_count += 1
+            end_pos += 2
+        elif wikitext.startswith(']]', end_pos, text_length):
+            bracket_count -= 1
+            end_pos += 2
+        else:
+            end_pos += 1
+    _flush_text(last, curr, parts)
+    if end_pos > curr + 2:  # Ensure we have a valid link
+        parts.add(curr, end_pos, process_double_brackets)
+    return end_pos
+
+def _scan_external_link(wikitext, curr, last, text_length, parts):
+    if not wikitext.startswith('[http', curr, text_length):
+        return None
+    # Find the end of the external link
+    end_pos = wikitext.find(']', curr, text_length)
+    if end_pos == -1:
+        end_pos = text_length
+    else :
+        end_pos += 1 # Include the closing ']' in the part
+    _flush_text(last, curr, parts)
+    parts.add(curr, min(end_pos + 1, text_length), process_external_link)
+    return end_pos
+
+def _scan_template(wikitext, curr, last, text_length, parts):
+    if not wikitext.startswith('{{', curr, text_length):
+        return None
+    # Find the end of the template
+    end_pos = wikitext.find('}}', curr, text_length) + 2
+    if end_pos == 1:
+        end_pos = text_length
+    _flush_text(last, curr, parts)
+    parts.add(curr, end_pos, process_template)
+    return end_pos
+
+def _scan_raw_url(wikitext, curr, last, text_length, parts):
+    if not wikitext.startswith('http', curr, text_length):
+        return None
+    # Find the end of the URL (space or end of string)
+    end_pos = wikitext.find(' ', curr, text_length)
+    if end_pos == -1:
+        end_pos = text_length
+    _flush_text(last, curr, parts)
+    parts.add(curr, end_pos, process_raw_url)
+    return end_pos
+
+def _scan_behaviour_switches(wikitext, curr, last, text_length, parts):
+    """
+    Unlike the other rules, every switch is tried in turn from the position
+    reached by the previous one, and the scanner then skips one character
+    after the last match.
+    """
+    matched = False
+    for switch in behaviour_switches:
+        if wikitext.startswith(switch, curr, text_length):
+            end_pos = curr + len(switch)
+            _flush_text(last, curr, parts)
+            parts.add(curr, end_pos, _passthrough)
+            curr = end_pos
+            last = curr
+            matched = True
+    return curr if matched else None
+
+_scan_existing_translate = _closed_tag_rule(
+    '<translate>', '</translate>', process_existing_translate, _existing_translate_container)
+
+# Rules in the order the scanner tries them at each position, each filed
+# under the character every match of the rule starts with.
+scanner_rules = [
+    ('=', _scan_section_heading),
+    ('<', _closed_tag_rule('<syntaxhighlight', '</syntaxhighlight>', process_syntax_highlight)),
+    # Process content inside existing <translate> tags
+    ('<', _scan_existing_translate),
+    ('<', _literal_rule('<languages/>')),
+    ('<', _literal_rule('<language>')),
+    ('{', _scan_table),
+    ('<', _closed_tag_rule('<blockquote>', '</blockquote>', process_blockquote)),
+    ('<', _closed_tag_rule('<poem', '</poem>', process_poem_tag)),
+    ('<', _closed_tag_rule('<center>', '</center>', _process_center_tag, _formatting_tag_container('center'))),
+    ('<', _closed_tag_rule('<big>', '</big>', _process_big_tag, _formatting_tag_container('big'))),
+    ('<', _closed_tag_rule('<code', '</code>', process_code_tag)),
+    ('<', _scan_div),
+    ('<', _closed_tag_rule('<hiero>', '</hiero>', process_hiero)),
+    ('<', _closed_tag_rule('<sub>', '</sub>', process_sub_sup)),
+    ('<', _closed_tag_rule('<sup>', '</sup>', process_sub_sup)),
+    ('<', _closed_tag_rule('<math>', '</math>', process_math)),
+    ('<', _closed_tag_rule('<small>', '</small>', process_small_tag)),
+    ('<', _closed_tag_rule('<nowiki>', '</nowiki>', process_nowiki)),
+    ('<', _literal_rule('<br>', '<br/>', '<br />')),
+    ('\n', _scan_list),
+    ('[', _scan_internal_link),
+    ('[', _scan_external_link),
+    ('{', _scan_template),
+    ('h', _scan_raw_url),
+]
+
+def _scan_start(wikitext, start, text_length, parts):
+    """
+    Every span is scanned as if it followed a newline, so that a list at its
+    very beginning is recognised.
+    """
+    if wikitext.startswith(('*', '#', ':', ';'), start, text_length):
+        return _scan_list_items(wikitext, start, text_length, parts)
+    return start
+
+def _no_progress(rule, curr, end):
+    # A rule that matched must consume at least one character, otherwise the
+    # scanner would stop advancing through the text.
+    raise ConversionAborted('no_progress', f"{rule.__name__} matched at {curr} but ended at {end}")
+
+def _scan_reference(wikitext, start=0, end=None, matches=None):
+    """
+    Reference scanner: advances one character at a time and tries every rule
+    at every position. Kept as the slow but obviously correct implementation
+    the dispatch scanner is tested against.
+
+    When `matches` is a list, a (start, end, len(parts), skipped) entry is
+    appended to it for every construct recognised; `skipped` is true when the
+    scanner then skips the character at `end` (after a behaviour switch).
+    """
+    parts = SpanTable(wikitext)
+    text_length = len(wikitext) if end is None else end
+    last = curr = _scan_start(wikitext, start, text_length, parts)
+    if matches is not None and curr > start:
+        matches.append((start, curr, len(parts), False))
+
+    budget = _active_budget.get()
+
+    while curr < text_length:
+        if budget is not None:
+            budget.step()
+        for _, rule in scanner_rules:
+            end = rule(wikitext, curr, last, text_length, parts)
+            if end is not None:
+                if end <= curr:
+                    _no_progress(rule, curr, end)
+                if matches is not None:
+                    matches.append((curr, end, len(parts), False))
+                curr = last = end
+                break
+        else:
+            end = _scan_behaviour_switches(wikitext, curr, last, text_length, parts)
+            if end is not None:
+                if matches is not None:
+                    matches.append((curr, end, len(parts), True))
+                curr = last = end
+            curr += 1  # Move to the next character if no pattern matched
+
+    # Add any remaining text after the last processed part
+    _flush_text(last, text_length, parts)
+    return parts
+
+# Matches wherever any rule (or a behaviour switch) could start.
+scanner_trigger = re.compile(r'[=<]|\n[*#:;]|\[\[|\[http|\{[{|]|http|__')
+
+scanner_dispatch = {'_': ()}
+for _first_char, _rule in scanner_rules:
+    scanner_dispatch[_first_char] = scanner_dispatch.get(_first_char, ()) + (_rule,)
+
+# --- Pre-flight classification ---
+# Before a fragment is scanned, one sweep finds the markup families it
+# contains. Plain text is wrapped as it is; otherwise the dispatch scanner
+# only stops where the rules of those families could match.
+
+# Family -> (what every match of its rules contains from the position the
+# rule is tried at, where the dispatch scanner tries the rules). Each
+# pattern consumes one character, so that no family hides another.
+markup_families = {
+    'heading': (r'=(?=[^=\n]+=)', '='),
+    'translate': (r'<(?=translate>)', '<'),
+    'tag': (r'<(?=syntaxhighlight|language|blockquote>|poem|center>|big>|code|div|hiero>|su[bp]>|math>|small>|nowiki>|br(?:>|/>| />))', '<'),
+    'table': (r'\{(?=\|)', r'\{\|'),
+    'template': (r'\{(?=\{)', r'\{\{'),
+    'list': (r'\n(?=[*#:;])', r'\n[*#:;]'),
+    'link': (r'\[(?=\[)', r'\[\['),
+    'external_link': (r'\[(?=http)', r'\[http'),
+    'raw_url': (r'h(?=ttp)', 'http'),
+    'behaviour_switch': (r'_(?=_)', '__'),
+}
+# The family of a match of the classifier is told by its first two
+# characters, or failing that its first one.
+_match_families = {
+    '=': 'heading', '<t': 'translate', '<': 'tag', '{|': 'table', '{{': 'template', '\n': 'list',
+    '[[': 'link', '[h': 'external_link', 'h': 'raw_url', '_': 'behaviour_switch',
+}
+
+# Rules of the families other than "tag", which has every other '<' rule.
+_rule_families = {
+    _scan_section_heading: 'heading',
+    _scan_existing_translate: 'translate',
+    _scan_table: 'table',
+    _scan_template: 'template',
+    _scan_list: 'list',
+    _scan_internal_link: 'link',
+    _scan_external_link: 'external_link',
+    _scan_raw_url: 'raw_url',
+}
+
+@functools.lru_cache(maxsize=None)
+def _markup_classifier(found):
+    # Without groups, which would keep the regex engine from skipping ahead to
+    # the next candidate character.
+    return re.compile('|'.join(detect for family, (detect, _) in markup_families.items() if family not in found))
+
+def classify_markup(wikitext):
+    """
+    Returns the markup families (a frozenset of `markup_families` keys)
+    whose rules could match somewhere in `wikitext`. The text is swept once:
+    each family found is dropped from the pattern for the rest of the sweep.
+    """
+    found = frozenset()
+    pos = 0
+    while len(found) < len(markup_families):
+        match = _markup_classifier(found).search(wikitext, pos)
+        if match is None:
+            break
+        pos = match.start()
+        found |= {_match_families.get(wikitext[pos:pos + 2]) or _match_families[wikitext[pos]]}
+        pos += 1
+    return found
+
+@functools.lru_cache(maxsize=None)
+def _family_scanner(families):
+    """The trigger pattern and dispatch table of the rules of `families`."""
+    dispatch = {'_': ()}
+    for first_char, rule in scanner_rules:
+        if _rule_families.get(rule, 'tag') in families:
+            dispatch[first_char] = dispatch.get(first_char, ()) + (rule,)
+    triggers = dict.fromkeys(markup_families[family][1] for family in markup_families if family in families)
+    return re.compile('|'.join(triggers) or '(?!)'), dispatch
+
+# (trigger, dispatch) of the fragment being converted; nested spans, which
+# lie within it, use the same one.
+_active_scanner = contextvars.ContextVar('scanner', default=None)
+
+def _scan_dispatch(wikitext, start=0, end=None, matches=None):
+    """
+    Dispatch scanner: jumps straight to the next position where a rule could
+    start and only tries the rules filed under that character. Produces the
+    same parts (and `matches`) as `_scan_reference`.
+    """
+    parts = SpanTable(wikitext)
+    text_length = len(wikitext) if end is None else end
+    last = curr = _scan_start(wikitext, start, text_length, parts)
+    if matches is not None and curr > start:
+        matches.append((start, curr, len(parts), False))
+    scanner = _active_scanner.get()
+    trigger, dispatch = (scanner_trigger, scanner_dispatch) if scanner is None else scanner
+    search = trigger.search
+    budget = _active_budget.get()
+
+    while curr < text_length:
+        if budget is not None:
+            budget.step()
+        match = search(wikitext, curr, text_length)
+        if match is None:
+            break
+        curr = match.start()
+        for rule in dispatch[wikitext[curr]]:
+            end = rule(wikitext, curr, last, text_length, parts)
+            if end is not None:
+                if end <= curr:
+                    _no_progress(rule, curr, end)
+                if matches is not None:
+                    matches.append((curr, end, len(parts), False))
+                curr = last = end
+                break
+        else:
+            end = _scan_behaviour_switches(wikitext, curr, last, text_length, parts)
+            if end is not None:
+                if matches is not None:
+                    matches.append((curr, end, len(parts), True))
+                curr = last = end
+            curr += 1
+
+    # Add any remaining text after the last processed part
+    _flush_text(last, text_length, parts)
+    return parts
+
+tokenizers = {
+    'dispatch': _scan_dispatch,
+    'reference': _scan_reference,
+}
+# Tokenizer used by the current conversion; nested spans use the same one.
+_active_tokenizer = contextvars.ContextVar('tokenizer', default='dispatch')
+# ConversionBudget the scanners of the current conversion draw on, if any.
+_active_budget = contextvars.ContextVar('budget', default=None)
+
+@contextmanager
+def _hardened(budget):
+    """
+    Runs a conversion step within `budget` and turns any failure on the input
+    into a ConversionAborted.
+    """
+    token = _active_budget.set(budget)
+    try:
+        yield
+    except ConversionAborted:
+        raise
+    except RecursionError:
+        raise ConversionAborted('nesting', "constructs are nested too deeply") from None
+    except Exception as e:
+        raise ConversionAborted('malformed', f"{type(e).__name__}: {e}") from e
+    finally:
+        _active_budget.reset(token)
+
+def _parts_size(parts):
+    return sum(len(part) for part, _ in parts if isinstance(part, str))
+
+def _join_run(text, run):
+    return ''.join([text[piece[0]:piece[1]] if type(piece) is list else piece for piece in run])
+
+def _prepare_parts(parts, spans=None):
+    """
+    Runs the link handlers, which number their <tvar>s, and merges
+    consecutive parts that are to be wrapped in <translate>. Returns a list
+    of (part, handler) pairs. With `spans`, a list, the (start, end, handler,
+    tvars) each of them was scanned as is appended to it: `tvars` lists the
+    (offset, value) of the <tvar>s of the links merged into a part.
+    """
+    with phase('assign_tvars', parts.size):
+        # Process links; their output replaces the text of the part
+        replaced = {}
+        tvar_id = 0
+        tvar_url_id = 0
+        tvar_code_id = 0
+        for i in range(len(parts)):
+            handler = parts.handler(i)
+            # Handlers for links require a tvar_id
+            if handler == process_double_brackets:
+                new_part, double_brackets_type = handler(parts.part_text(i), tvar_id)
+                if double_brackets_type in [double_brackets_types.wikilink, double_brackets_types.special, double_brackets_types.inline_icon]:
+                    new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
+                else :
+                    new_handler = _passthrough  # No further processing for categories and files
+                replaced[i] = (new_part, new_handler)
+                tvar_id += 1
+            elif handler == process_external_link:
+                new_part = handler(parts.part_text(i), tvar_url_id)
+                new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
+                replaced[i] = (new_part, new_handler)
+                tvar_url_id += 1
+            elif handler == process_code_tag:
+                new_part = handler(parts.part_text(i), tvar_code_id)
+                new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
+                replaced[i] = (new_part, new_handler)
+                tvar_code_id += 1
+
+    with phase('merge', parts.size):
+        # Scan again the parts: merge consecutive parts handled by _wrap_in_translate.
+        # A run holds [start, end] spans of the text and replaced parts; a span
+        # that continues the previous one only moves its end.
+        text = parts.text
+        starts, ends = parts.starts, parts.ends
+        _parts = []
+        run = []
+        run_tvars = []
+        first = 0  # First part of the current run
+        for i in range(len(parts)):
+            part = replaced.get(i)
+            if part is None:
+                handler = parts.handler(i)
+                if handler == _wrap_in_translate:
+                    if run and type(run[-1]) is list and run[-1][1] == starts[i]:
+                        run[-1][1] = ends[i]
+                    else:
+                        run.append([starts[i], ends[i]])
+                    if spans is not None and '<tvar' in parts.part_text(i):
+                        run_tvars.extend((starts[i] + match.start(), match.group(1))
+                                         for match in tvar_element.finditer(parts.part_text(i)))
+                    continue
+                part = parts.nodes.get(i)
+                if part is None:
+                    part = parts.part_text(i)
+            else:
+                part, handler = part
+                if handler == _wrap_in_translate:
+                    run.append(part)
+                    if spans is not None:
+                        run_tvars.extend((starts[i], value) for value in tvar_element.findall(part))
+                    continue
+            if run:
+                _parts.append((_join_run(text, run), _wrap_in_translate))
+                if spans is not None:
+                    spans.append((starts[first], ends[i - 1], _wrap_in_translate, run_tvars))
+                run = []
+                run_tvars = []
+            _parts.append((part, handler))
+            if spans is not None:
+                spans.append((starts[i], ends[i], parts.handler(i), ()))
+            first = i + 1
+        if run:
+            _parts.append((_join_run(text, run), _wrap_in_translate))
+            if spans is not None:
+                spans.append((starts[first], ends[-1], _wrap_in_translate, run_tvars))
+    return _parts
+
+def _render_parts(parts, out=None):
+    """
+    Turns scanned parts into translatable wikitext, without renumbering the
+    <tvar>s. With `out`, a list, the output is appended to it in pieces
+    (containers included) instead of being returned.
+    """
+    units = _active_units.get()
+    if units is not None and units.out is not out:
+        # A conversion within a handler (e.g. of a list item): its units
+        # belong to the handler's part, and so do those of its tables.
+        token = _active_units.set(None)
+        try:
+            return _render_parts(parts, out)
+        finally:
+            _active_units.reset(token)
+    spans = None if units is None else []
+    _parts = _prepare_parts(parts, spans)
+    pieces = [] if out is None else out
+    # Process the parts with their respective handlers
+    with phase('handlers', lambda: _parts_size(_parts)):
+        for i, (part, handler) in enumerate(_parts):
+            if handler == _render_container:
+                handler(part, pieces)
+            elif units is None:
+                pieces.append(handler(part))
+            else:
+                units.part_start = units.base + spans[i][0]
+                pieces.append(handler(part))
+                units.add(part, pieces[-1], spans[i])
+    if out is None:
+        return ''.join(pieces)
+
+@instrumented
+def _render_container(node, out=None):
+    if out is None:
+        return node.prefix + _render_parts(node.children) + node.suffix
+    out.append(node.prefix)
+    units = _active_units.get()
+    if units is not None and units.out is out:
+        with units.within(node.kind):
+            _render_parts(node.children, out)
+    else:
+        _render_parts(node.children, out)
+    out.append(node.suffix)
+
+def _convert_fragment(wikitext, out=None):
+    """
+    Converts a piece of already normalized wikitext that is part of a larger
+    conversion (e.g. a table cell), leaving <tvar> renumbering to the caller.
+    With `out`, a list, the output is appended to it as by `_render_parts`.
+    """
+    if _active_tokenizer.get() != 'dispatch':
+        with phase('tokenize', len(wikitext)):
+            parts = _scan_span(wikitext, 0, len(wikitext))
+        return _render_parts(parts, out)
+    with phase('classify', len(wikitext)):
+        families = classify_markup(wikitext)
+    record_markup(families)
+    if out is None and not families and not wikitext.startswith(('*', '#', ':', ';')):
+        # Plain text: a single translation unit
+        return _wrap_in_translate(wikitext)
+    token = _active_scanner.set(_family_scanner(families))
+    try:
+        with phase('tokenize', len(wikitext)):
+            parts = _scan_span(wikitext, 0, len(wikitext))
+        return _render_parts(parts, out)
+    finally:
+        _active_scanner.reset(token)
+
+def convert_to_translatable_wikitext(wikitext, tokenizer=None, budget=None, parser=None, units=False):
     """
     Converts standard wikitext to translatable wikitext by wrapping
     translatable text with <translate> tags, while preserving and
     correctly handling special wikitext elements.
     This function tokenizes the entire text, not line by line.
+    `tokenizer` selects the scanner ("dispatch" or "reference"); nested
+    spans are scanned with the same one. `parser` selects how tables and
+    templates are parsed ("shared" or "fragment"); both give the same output.
+    With a ConversionBudget, the conversion is hardened: it raises
+    ConversionAborted when the budget runs out or the input cannot be
+    converted, and no other exception.
+    With `units`, returns (converted, units): the converted text and the list
+    of its translation units (see TranslationUnit), in order.
     """
+    if budget is not None:
+        with _hardened(budget):
+            return convert_to_translatable_wikitext(wikitext, tokenizer, parser=parser, units=units)
+    if parser is not None:
+        token = _active_parser.set(parser)
+        try:
+            return convert_to_translatable_wikitext(wikitext, tokenizer, units=units)
+        finally:
+            _active_parser.reset(token)
+    if tokenizer is not None:
+        token = _active_tokenizer.set(tokenizer)
+        try:
+            return convert_to_translatable_wikitext(wikitext, units=units)
+        finally:
+            _active_tokenizer.reset(token)
+    if units:
+        return _convert_to_units(wikitext)
     if not wikitext:
         return ""
-    wikitext = wikitext.replace('\r\n', '\n').replace('\r', '\n')   # <-- add this
-
-    # add an extra newline at the beginning, useful to process items at the beginning of the text
-    wikitext = '\n' + wikitext
-
-    parts = []
-    last = 0
-    curr = 0
-    text_length = len(wikitext)
-
-    while curr < text_length :
-        found = None
-        if wikitext[curr] == '=':
-            # Find the end of the line
-            end_line = wikitext.find('\n', curr)
-            if end_line == -1:
-                end_line = text_length
-            line = wikitext[curr:end_line]
-            if re.match(r'^(=+)[^=]+(=+)$', line.strip()):
-                if last < curr:
-                    parts.append((wikitext[last:curr], _wrap_in_translate))
-                parts.append((line, process_section_heading))
-                curr = end_line
-                last = curr
-                continue
-        # Syntax highlight block
-        pattern = '<syntaxhighlight'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</syntaxhighlight>', curr) + len('</syntaxhighlight>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_syntax_highlight))
-            curr = end_pattern
-            last = curr
-            continue
-        
-        # Process content inside existing <translate> tags
-        pattern = '<translate>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</translate>', curr) + len('</translate>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_existing_translate))
-            curr = end_pattern
-            last = curr
-            continue
+    wikitext = wikitext.replace('\r\n', '\n').replace('\r', '\n')
+
+    # Join the processed parts into a single string and renumber tvars per unit.
+    # Numbering as the pieces are appended gives the same output, but a call
+    # per piece costs more than this one pass, which is skipped without <tvar>s.
+    converted = _convert_fragment(wikitext)
+    with phase('renumber', len(converted)):
+        return renumber_tvars_per_unit(converted)
+
+# --- Translation units ---
+# With `units`, the conversion also describes each translation unit of its
+# output, as the Translate extension splits it (the content of a <translate>
+# block, cut at blank lines). They are collected as the parts of the text are
+# rendered: the span a part was scanned from tells where its units come from,
+# and the handler it was scanned for what kind of units they are. The text
+# wrapped as a whole is cut into units as is, with the <tvar>s its links were
+# given; tables convert their cells knowing where their content starts.
+# Conversions that other handlers run on text of their own (e.g. list items)
+# are not collected: their units are those of the handler's output.
+
+# A translation unit: `kind` is "heading", "paragraph", "list_item",
+# "file_caption" or "table_cell"; [start, end) is the span of the input it
+# comes from (the content of its cell, for a table cell); `text` is its
+# content, as in the output, and `tvars` maps the names of its <tvar>s to
+# their values.
+TranslationUnit = namedtuple('TranslationUnit', ['kind', 'start', 'end', 'text', 'tvars'])
+
+# Kind of the units in the output of a part, by the handler it was scanned
+# for; other parts give units of the kind of their container.
+unit_kinds = {
+    process_section_heading: 'heading',
+    process_item: 'list_item',
+    process_double_brackets: 'file_caption',  # Only files and categories are left on their own
+}
+translate_block = re.compile(r'<translate>(.*?)</translate>', re.DOTALL)
+tvar_value = re.compile(r'<tvar\s+name="([^"]*)"\s*>(.*?)</tvar>', re.DOTALL)
+
+class _UnitCollector:
+
+    def __init__(self, text):
+        self.text = text
+        self.out = []           # The pieces of output being collected
+        self.units = []
+        self.kinds = ['paragraph']
+        self.base = 0           # Offset in the text of the text being rendered
+        self.part_start = 0     # Offset in the text of the part being rendered
+        self.cell_span = None   # Span of the content of the cell being converted
+
+    @contextmanager
+    def within(self, kind):
+        self.kinds.append(kind or self.kinds[-1])
+        try:
+            yield
+        finally:
+            self.kinds.pop()
+
+    @contextmanager
+    def cell(self, start, content, out):
+        """Collects the units of the conversion of a table cell into `out`."""
+        first = len(content) - len(content.lstrip())
+        saved = self.out, self.base, self.cell_span
+        self.out, self.base = out, start
+        self.cell_span = (start + first, start + len(content.rstrip()))
+        try:
+            yield
+        finally:
+            self.out, self.base, self.cell_span = saved
+
+    def _unit(self, kind, span, text, tvars):
+        if self.cell_span is not None:
+            kind, span = 'table_cell', self.cell_span
+        self.units.append(TranslationUnit(kind, span[0], span[1], text, tvars))
+
+    def add(self, part, piece, span):
+        """Collects the units of a part rendered as `piece`."""
+        start, end, scanned_for, tvars = span
+        start, end = self.base + start, self.base + end
+        if scanned_for is process_table:
+            return  # Its cells were collected as they were converted
+        if scanned_for is _wrap_in_translate:
+            self._add_wrapped(part, start, end, [(self.base + offset, value) for offset, value in tvars])
+            return
+        if '<translate>' not in piece:
+            return
+        kind = unit_kinds.get(scanned_for, self.kinds[-1])
+        for block in translate_block.finditer(piece):
+            for text in unit_cut.split(block.group(1)):
+                if text.strip():
+                    text = renumber_tvars_per_unit(text.strip())
+                    self._unit(kind, (start, end), text, dict(tvar_value.findall(text)))
+
+    def _add_wrapped(self, content, start, end, tvars):
+        # Text wrapped as a whole is cut at the same blank lines as its source
+        texts = [text.strip() for text in unit_cut.split(content) if text.strip()]
+        spans = self._source_spans(start, end)
+        if len(spans) != len(texts):
+            spans = [(start, end)] * len(texts)
+        for text, (unit_start, unit_end) in zip(texts, spans):
+            values = [value for offset, value in tvars if unit_start <= offset < unit_end]
+            self._unit(self.kinds[-1], (unit_start, unit_end), renumber_tvars_per_unit(text),
+                       {str(number): value for number, value in enumerate(values, 1)})
+
+    def _source_spans(self, start, end):
+        # The spans of the paragraphs of the text, without surrounding whitespace
+        spans = []
+        for match in re.finditer(r'(?:(?!\n[ \t]*\n).)+', self.text[start:end], re.DOTALL):
+            content = match.group()
+            if content.strip():
+                first = len(content) - len(content.lstrip())
+                spans.append((start + match.start() + first, start + match.start() + len(content.rstrip())))
+        return spans
+
+# Collector of the conversion being rendered, when it is asked for its units
+_active_units = contextvars.ContextVar('units', default=None)
+
+def _convert_to_units(wikitext):
+    if not wikitext:
+        return "", []
+    original = wikitext
+    wikitext = wikitext.replace('\r\n', '\n').replace('\r', '\n')
+    collector = _UnitCollector(wikitext)
+    token = _active_units.set(collector)
+    try:
+        with phase('tokenize', len(wikitext)):
+            parts = _scan_span(wikitext, 0, len(wikitext))
+        _render_parts(parts, collector.out)
+    finally:
+        _active_units.reset(token)
+    converted = ''.join(collector.out)
+    with phase('renumber', len(converted)):
+        converted = renumber_tvars_per_unit(converted)
+    units = collector.units
+    if len(wikitext) != len(original):
+        # Offsets into the input as given: put back the "\r" of every "\r\n"
+        removed = [match.start() - i for i, match in enumerate(re.finditer('\r\n', original))]
+        units = [
+            unit._replace(start=unit.start + bisect.bisect_left(removed, unit.start),
+                          end=unit.end + bisect.bisect_left(removed, unit.end))
+            if unit.start is not None else unit
+            for unit in units
+        ]
+    return converted, units
+
+# --- Streaming conversion ---
+# `iter_convert` converts text that arrives in chunks. The input is cut right
+# after a newline that lies in plain text, outside every construct, so that
+# both sides scan exactly as they would within the whole text. A <translate>
+# run or a translation unit may continue past a cut: `_StreamWriter` keeps it
+# open and holds back only what may still change (trailing whitespace and
+# the <tvar>s of the current unit). The output is therefore the same as that
+# of `convert_to_translatable_wikitext`.
+
+# Rules decide whether a construct starts at a position by looking at most
+# this many characters ahead, so text closer than that to the end of the
+# buffer is not converted until more input arrives.
+STREAM_LOOKAHEAD = 64
+STREAM_READ_SIZE = 64 * 1024
+_wrap_whitespace = ' \n\t\r\f\v'  # What _wrap_in_translate keeps outside the tags
+
+def _find_stream_cut(buffer, matches, limit):
+    """
+    Finds the last position that follows a newline in plain text (between the
+    constructs listed in `matches`) and lies before `limit`. Returns
+    (cut, parts_count, text_start) where the first `parts_count` parts cover
+    the buffer up to `text_start`, or None.
+    """
+    region_end = len(buffer)
+    for i in range(len(matches), -1, -1):
+        region_start, parts_count, skipped = (matches[i - 1][1:] if i else (0, 0, False))
+        # After a behaviour switch the scanner skips a character, so a newline
+        # right there does not behave like one.
+        newline = buffer.rfind('\n', region_start + skipped, min(region_end, limit))
+        if newline != -1:
+            return newline + 1, parts_count, region_start
+        if i:
+            region_end = matches[i - 1][0]
+    return None
+
+class _StreamWriter:
+    """
+    Renders the parts of consecutive pieces of a text and renumbers their
+    <tvar>s as if they had been rendered together.
+    """
 
-        pattern = '<languages/>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = curr + len(pattern)
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], lambda x: x))
-            curr = end_pattern
-            last = curr
+    def __init__(self):
+        self.run_open = False   # "<translate>" written, "</translate>" not yet
+        self.leading = ''       # Whitespace of a run that may not need wrapping
+        self.trailing = ''      # Whitespace that may end up after "</translate>"
+        self.unit = ''          # Output since the last translation unit boundary
+
+    def state(self):
+        return (self.run_open, self.leading, self.trailing, self.unit)
+
+    def restore(self, state):
+        self.run_open, self.leading, self.trailing, self.unit = state
+
+    def _wrap(self, text):
+        if self.run_open:
+            content = text.rstrip(_wrap_whitespace)
+            if not content:
+                self.trailing += text
+                return ''
+            output = self.trailing + content
+            self.trailing = text[len(content):]
+            return output
+        self.leading += text
+        if not text.strip():
+            return ''
+        text, self.leading = self.leading, ''
+        content = text.strip(_wrap_whitespace)
+        first = len(text) - len(text.lstrip(_wrap_whitespace))
+        self.run_open = True
+        self.trailing = text[first + len(content):]
+        return text[:first] + '<translate>' + content
+
+    def _end_run(self):
+        if self.run_open:
+            output = '</translate>' + self.trailing
+            self.run_open = False
+            self.trailing = ''
+            return output
+        output, self.leading = self.leading, ''
+        return output
+
+    def _renumber(self, output, final=False):
+        text = self.unit + output
+        end = 0
+        if final:
+            end = len(text)
+        else:
+            for boundary in boundary_pattern.finditer(text):
+                end = boundary.end()
+        self.unit = text[end:]
+        with phase('renumber', end):
+            return renumber_tvars_per_unit(text[:end])
+
+    def write(self, parts):
+        output = []
+        parts = _prepare_parts(parts)
+        with phase('handlers', lambda: _parts_size(parts)):
+            for part, handler in parts:
+                if handler == _wrap_in_translate:
+                    output.append(self._wrap(part))
+                else:
+                    output.append(self._end_run())
+                    output.append(handler(part))
+        return self._renumber(''.join(output))
+
+    def close(self):
+        return self._renumber(self._end_run(), final=True)
+
+def iter_convert(chunks, budget=None):
+    """
+    Converts wikitext that arrives as an iterable of string chunks, yielding
+    the converted text as soon as it is known. The concatenated output is the
+    same as `convert_to_translatable_wikitext` of the concatenated input, but
+    only the input that cannot be converted yet (typically the current line
+    or the construct being read) is kept in memory.
+    `budget` hardens the conversion as in `convert_to_translatable_wikitext`;
+    it covers the whole stream.
+    """
+    if budget is not None:
+        with _hardened(budget):
+            # Check every piece of the generator's work, but not the consumer's.
+            stream = iter(iter_convert(chunks))
+        while True:
+            with _hardened(budget):
+                output = next(stream, None)
+            if output is None:
+                return
+            yield output
+    scan = tokenizers[_active_tokenizer.get()]
+    writer = _StreamWriter()
+    buffer = ''
+    carriage_return = False
+    next_scan = 2 * STREAM_LOOKAHEAD
+
+    for chunk in chunks:
+        # A "\r\n" may be split between two chunks.
+        if carriage_return:
+            chunk = '\r' + chunk
+        carriage_return = chunk.endswith('\r')
+        if carriage_return:
+            chunk = chunk[:-1]
+        buffer += chunk.replace('\r\n', '\n').replace('\r', '\n')
+        if len(buffer) < next_scan:
             continue
 
-        pattern = '<language>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = curr + len('<language>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], lambda x: x))
-            curr = end_pattern
-            last = curr
-            continue
+        matches = []
+        with phase('tokenize', len(buffer)):
+            parts = scan(buffer, 0, len(buffer), matches)
+        cut = _find_stream_cut(buffer, matches, len(buffer) - STREAM_LOOKAHEAD)
+        if cut is not None:
+            cut, parts_count, text_start = cut
+            head = parts.head(parts_count)
+            _flush_text(text_start, cut, head)
+            output = writer.write(head)
+            if output:
+                yield output
+            buffer = buffer[cut:]
+        # Wait for the buffer to double so that a long construct is not
+        # rescanned for every chunk.
+        next_scan = 2 * len(buffer)
+
+    if carriage_return:
+        buffer += '\n'
+    output = ''
+    if buffer:
+        with phase('tokenize', len(buffer)):
+            parts = scan(buffer, 0, len(buffer))
+        output = writer.write(parts)
+    output += writer.close()
+    if output:
+        yield output
+
+# --- Incremental conversion ---
+# A document converted under a key is kept as segments: spans of its text
+# between cuts made right after a blank line in plain text, each with the
+# output `_StreamWriter` gave for it and the state of the writer before and
+# after it. When a new version of the document is converted, a segment is
+# reused if its text and the STREAM_LOOKAHEAD characters after it are
+# unchanged (so it scans the same) and the writer reaches it in the same
+# state; only the segments in between are scanned and rendered again. The
+# output is the same as that of `convert_to_translatable_wikitext`.
+
+# Cuts are at least this many characters apart. As a cut only depends on the
+# previous one and the text, the cuts after an edit soon fall on the old ones.
+INCREMENTAL_MIN_SEGMENT = 512
+INCREMENTAL_WINDOW = 4 * 1024  # Characters scanned at a time
+unit_cut = re.compile(r'\n[ \t]*\n')
+
+Segment = namedtuple('Segment', ['start', 'end', 'before', 'output', 'after'])
+IncrementalDocument = namedtuple('IncrementalDocument', ['text', 'segments'])
+
+def _iter_unit_cuts(buffer, matches, limit):
+    """
+    Yields the cuts of `buffer` (as `_find_stream_cut` returns them) that
+    follow a blank line in plain text, or lie between a construct ending with
+    a newline and a blank line, before `limit`, in order, each at least
+    INCREMENTAL_MIN_SEGMENT characters after the previous one. Either way the
+    scanner is at the start of a line outside every construct, as it would be
+    at the start of the text.
+    """
+    previous = 0
+    for i in range(len(matches) + 1):
+        region_start, parts_count, skipped = (matches[i - 1][1:] if i else (0, 0, False))
+        region_end = min(matches[i][0] if i < len(matches) else len(buffer), limit)
+        if (i and not skipped and previous + INCREMENTAL_MIN_SEGMENT <= region_start <= limit
+                and buffer[region_start - 1] == '\n' and buffer.startswith('\n', region_start)):
+            # E.g. between two lists separated by a blank line
+            previous = region_start
+            yield previous, parts_count, region_start
+        while True:
+            search_start = max(region_start + skipped, previous + INCREMENTAL_MIN_SEGMENT)
+            if search_start >= region_end:
+                break
+            blank = unit_cut.search(buffer, search_start, region_end)
+            if blank is None:
+                break
+            previous = blank.end()
+            yield previous, parts_count, region_start
+        if region_end == limit:
+            return
 
-        # Table block — use balanced matching so nested tables are handled correctly
-        pattern = '{|'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = _find_balanced_close_tag(wikitext, curr, '{|', '|}')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_table))
-            curr = end_pattern
-            last = curr
-            continue
-        # Blockquote
-        pattern = '<blockquote>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</blockquote>', curr) + len('</blockquote>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_blockquote))
-            curr = end_pattern
-            last = curr
-            continue
-        # Poem tag
-        pattern = '<poem'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</poem>', curr) + len('</poem>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_poem_tag))
-            curr = end_pattern
-            last = curr
-            continue
-                
-        # Center tag
-        pattern = '<center>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</center>', curr) + len('</center>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            # Lambda forces the handler to pass the correct tag name to our processor
-            parts.append((wikitext[curr:end_pattern], lambda x: process_formatting_tag(x, "center")))
-            curr = end_pattern
-            last = curr
-            continue
+def _segment_parts(parts, start, end):
+    """
+    Returns the parts of the buffer between two cuts, `start` and `end`,
+    given as (cut, parts_count, text_start).
+    """
+    cut, first, _ = start
+    end_cut, last, text_start = end
+    segment = SpanTable(parts.text)
+    if first < last and parts.starts[first] < cut:
+        # The text part the segment starts in
+        _flush_text(cut, parts.ends[first], segment)
+        first += 1
+    segment.extend(parts, first, last)
+    _flush_text(max(text_start, cut), end_cut, segment)
+    return segment
+
+def _iter_segments(text, pos, writer):
+    # Scans and renders `text` from `pos`, a cut, to its end, yielding every
+    # Segment once written.
+    scan = tokenizers[_active_tokenizer.get()]
+    window = INCREMENTAL_WINDOW
+    while pos < len(text):
+        end = min(len(text), pos + window)
+        buffer = text[pos:end]
+        limit = len(buffer) if end == len(text) else len(buffer) - STREAM_LOOKAHEAD
+        matches = []
+        with phase('tokenize', len(buffer)):
+            parts = scan(buffer, 0, len(buffer), matches)
+        start = (0, 0, 0)
+        cuts = list(_iter_unit_cuts(buffer, matches, limit))
+        if end == len(text) and (not cuts or cuts[-1][0] < len(buffer)):
+            cuts.append((len(buffer), len(parts), len(buffer)))
+        for cut in cuts:
+            before = writer.state()
+            output = writer.write(_segment_parts(parts, start, cut))
+            yield Segment(pos + start[0], pos + cut[0], before, output, writer.state())
+            start = cut
+        if cuts:
+            pos += start[0]
+            window = INCREMENTAL_WINDOW
+        else:
+            # No cut yet: scan a larger window, as iter_convert does.
+            window *= 2
 
-        # Big tag
-        pattern = '<big>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</big>', curr) + len('</big>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], lambda x: process_formatting_tag(x, "big")))
-            curr = end_pattern
-            last = curr
-            continue
-            
-        # Code tag
-        pattern = '<code'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</code>', curr) + len('</code>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_code_tag))
-            curr = end_pattern
-            last = curr
-            continue
-        # Div tag — use balanced matching so nested <div>s are handled correctly
-        pattern = '<div'
-        if wikitext.startswith(pattern, curr) and (
-            curr + 4 >= text_length or wikitext[curr + 4] in ('>', ' ', '\t', '\n', '/')
-        ):
-            end_pattern = _find_balanced_close_tag(
-                wikitext, curr, '<div', '</div>',
-                open_check_chars={'>', ' ', '\t', '\n', '/'}
-            )
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_div))
-            curr = end_pattern
-            last = curr
-            continue
-        # Hiero tag
-        pattern = '<hiero>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</hiero>', curr) + len('</hiero>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_hiero))
-            curr = end_pattern
-            last = curr
-            continue
-        # Sub tag
-        pattern = '<sub>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</sub>', curr) + len('</sub>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_sub_sup))
-            curr = end_pattern
-            last = curr
-            continue
-        # Sup tag
-        pattern = '<sup>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</sup>', curr) + len('</sup>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_sub_sup))
-            curr = end_pattern
-            last = curr
-            continue
-        # Math tag
-        pattern = '<math>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</math>', curr) + len('</math>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_math))
-            curr = end_pattern
-            last = curr
-            continue
-        # Small tag
-        pattern = '<small>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</small>', curr) + len('</small>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_small_tag))
-            curr = end_pattern
-            last = curr
-            continue
-        # Nowiki tag
-        pattern = '<nowiki>'
-        if wikitext.startswith(pattern, curr):
-            end_pattern = wikitext.find('</nowiki>', curr) + len('</nowiki>')
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pattern], process_nowiki))
-            curr = end_pattern
-            last = curr
-            continue
-        # br tag
-        patterns = ['<br>', '<br/>', '<br />']
-        for p in patterns:
-            if wikitext.startswith(p, curr):
-                end_pattern = curr + len(p)
-                if last < curr:
-                    parts.append((wikitext[last:curr], _wrap_in_translate))
-                parts.append((wikitext[curr:end_pattern], lambda x: x))
-                curr = end_pattern
-                last = curr
-                found = True
+def convert_incremental(wikitext, previous=None, budget=None):
+    """
+    Converts `wikitext` like `convert_to_translatable_wikitext`, reusing what
+    can be reused of `previous`, the IncrementalDocument of an earlier
+    conversion of the same document. Returns (converted text,
+    IncrementalDocument, number of characters of the text that were reused).
+    `budget` hardens the conversion as in `convert_to_translatable_wikitext`.
+    """
+    if budget is not None:
+        with _hardened(budget):
+            return convert_incremental(wikitext, previous)
+    text = wikitext.replace('\r\n', '\n').replace('\r', '\n')
+    old_text, old = previous if previous is not None else ('', [])
+    writer = _StreamWriter()
+
+    # Segments at the start that are unchanged
+    reused = 0
+    while reused < len(old):
+        segment = old[reused]
+        end = segment.end + STREAM_LOOKAHEAD
+        if text[segment.start:end] != old_text[segment.start:end]:
+            break
+        reused += 1
+    segments = old[:reused]
+    pos = 0
+    if segments:
+        pos = segments[-1].end
+        writer.restore(segments[-1].after)
+    reused_chars = pos
+
+    # Segments at the end that are unchanged, by their start in `text`
+    delta = len(text) - len(old_text)
+    suffix = {}
+    first = len(old)
+    while first > reused:
+        segment = old[first - 1]
+        if segment.start + delta < pos or (
+                text[segment.start + delta:segment.end + delta] != old_text[segment.start:segment.end]):
+            break
+        first -= 1
+        suffix[segment.start + delta] = first
+
+    def resume(at):
+        # Takes the unchanged segments from `at` on if the writer is where it
+        # was when they were written.
+        nonlocal reused_chars
+        first = suffix.get(at)
+        if first is None or old[first].before != writer.state():
+            return False
+        reused_chars += len(text) - at
+        segments.extend(
+            segment._replace(start=segment.start + delta, end=segment.end + delta) for segment in old[first:]
+        )
+        writer.restore(old[-1].after)
+        return True
+
+    if not resume(pos):
+        for segment in _iter_segments(text, pos, writer):
+            segments.append(segment)
+            if resume(segment.end):
                 break
-        if found:
-            continue
-        # Lists
-        patterns_newline = ['\n*', '\n#', '\n:', '\n;']
-        if any(wikitext.startswith(p, curr) for p in patterns_newline) :
-            curr += 1 # Discard the newline character
-            parts.append((wikitext[last:curr], _wrap_in_translate))
-            # Iterate through the list items
-            patterns = ['*', '#', ':', ';']
-            while any(wikitext.startswith(p, curr) for p in patterns) :
-                end_pattern = wikitext.find('\n', curr)
-                if end_pattern == -1:
-                    end_pattern = text_length
-                else :
-                    end_pattern += 1 # Include the newline in the part
-                parts.append((wikitext[curr:end_pattern], process_item))
-                curr = end_pattern
-                last = curr
-            continue
-        # Internal links
-        pattern = '[['
-        if wikitext.startswith(pattern, curr):
-            # Count the number of opening double brackets '[[' and closing ']]' to find the end
-            end_pos = curr + 2
-            bracket_count = 1
-            while end_pos < text_length and bracket_count > 0:
-                if wikitext.startswith('[[', end_pos):
-                    bracket_count += 1
-                    end_pos += 2
-                elif wikitext.startswith(']]', end_pos):
-                    bracket_count -= 1
-                    end_pos += 2
-                else:   
-                    end_pos += 1
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            if end_pos > curr + 2:  # Ensure we have a valid link
-                parts.append((wikitext[curr:end_pos], process_double_brackets))
-            curr = end_pos
-            last = curr
-            continue
-        # External links
-        pattern = '[http'
-        if wikitext.startswith(pattern, curr):
-            # Find the end of the external link
-            end_pos = wikitext.find(']', curr)
-            if end_pos == -1:
-                end_pos = text_length
-            else :
-                end_pos += 1 # Include the closing ']' in the part
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pos + 1], process_external_link))
-            curr = end_pos
-            last = curr
-            continue
-        # Templates
-        pattern = '{{'
-        if wikitext.startswith(pattern, curr):
-            # Find the end of the template
-            end_pos = wikitext.find('}}', curr) + 2
-            if end_pos == 1:
-                end_pos = text_length
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pos], process_template))
-            curr = end_pos
-            last = curr
-            continue
-        # Raw URLs
-        pattern = 'http'
-        if wikitext.startswith(pattern, curr):
-            # Find the end of the URL (space or end of string)
-            end_pos = wikitext.find(' ', curr)
-            if end_pos == -1:
-                end_pos = text_length
-            if last < curr:
-                parts.append((wikitext[last:curr], _wrap_in_translate))
-            parts.append((wikitext[curr:end_pos], process_raw_url))
-            curr = end_pos
-            last = curr
-            continue
-        # Behaviour switches
-        for switch in behaviour_switches:
-            if wikitext.startswith(switch, curr):
-                end_pos = curr + len(switch)
-                if last < curr:
-                    parts.append((wikitext[last:curr], _wrap_in_translate))
-                parts.append((wikitext[curr:end_pos], lambda x: x))
-                curr = end_pos
-                last = curr
-                
-        
-        curr += 1  # Move to the next character if no pattern matched
-        
-    # Add any remaining text after the last processed part
-    if last < text_length:
-        parts.append((wikitext[last:], _wrap_in_translate))
-    
+
+    converted = ''.join([segment.output for segment in segments]) + writer.close()
+    return converted, IncrementalDocument(text, segments), reused_chars
+
+# --- Conversion engine ---
+# Conversions run on a shared pool of worker processes so that requests do not
+# serialize on the GIL. CONVERSION_WORKERS=0 converts inline instead.
+
+MAX_BATCH_DOCUMENTS = 1000
+CONVERSION_TIMEOUT = float(os.environ['CONVERSION_TIMEOUT']) if os.environ.get('CONVERSION_TIMEOUT') else None
+# Every conversion the service runs is hardened: it gives up after
+# CONVERSION_DEADLINE seconds, or after CONVERSION_STEP_BUDGET scanner steps
+# per character of input (0 disables either). Unlike CONVERSION_TIMEOUT, which
+# replaces the worker pool, this leaves the worker ready for the next page.
+CONVERSION_DEADLINE = float(os.environ.get('CONVERSION_DEADLINE', 30)) or None
+CONVERSION_STEP_BUDGET = int(os.environ.get('CONVERSION_STEP_BUDGET', 64)) or None
+CONVERSION_BASE_STEPS = 10000
+
+def conversion_budget(length):
+    """Returns the budget of the service for converting `length` characters."""
+    steps = None if CONVERSION_STEP_BUDGET is None else CONVERSION_BASE_STEPS + CONVERSION_STEP_BUDGET * length
+    return ConversionBudget(CONVERSION_DEADLINE, steps)
+
+def _convert_document(wikitext):
+    if not isinstance(wikitext, str):
+        raise TypeError('"wikitext" must be a string')
+    return convert_to_translatable_wikitext(wikitext, budget=conversion_budget(len(wikitext)))
+
+def _convert_document_units(wikitext):
+    if not isinstance(wikitext, str):
+        raise TypeError('"wikitext" must be a string')
+    return convert_to_translatable_wikitext(wikitext, budget=conversion_budget(len(wikitext)), units=True)
+
+def _convert_document_profiled(wikitext):
+    # Runs in a worker: the profile travels back with the result.
+    return run_profiled(_convert_document, wikitext)
+
+# With CONVERSION_METRICS=1 every conversion is profiled and the totals are
+# exported at /metrics; otherwise only requests asking for a profile are.
+CONVERSION_METRICS = os.environ.get('CONVERSION_METRICS', '').strip().lower() in ('1', 'true', 'yes', 'on')
+conversion_metrics = Metrics()
+
+def _record_profile(converted):
+    if not CONVERSION_METRICS:
+        return converted
+    converted, profile = converted
+    conversion_metrics.add(profile)
+    return converted
+
+conversion_engine = ConversionEngine(
+    _convert_document_profiled if CONVERSION_METRICS else _convert_document,
+    workers=int(os.environ['CONVERSION_WORKERS']) if os.environ.get('CONVERSION_WORKERS') else None,
+    timeout=CONVERSION_TIMEOUT,
+)
+
+# --- Admission control ---
+# At most MAX_CONVERSIONS conversions run at once; the others wait in a queue
+# bounded by the size of their input, in which small pages go first (see
+# AdmissionControl). Each document of a batch and each streamed conversion
+# takes a slot too. Overloaded requests get 429 or 503 with Retry-After, and
+# conversion requests larger than their endpoint's limit get 413 before their
+# body is read.
+
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', 16 * 1024 * 1024)) or None
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 64 * 1024 * 1024)) or None
+MAX_STREAM_BYTES = int(os.environ.get('MAX_STREAM_BYTES', 256 * 1024 * 1024)) or None
+ADMITTED_ENDPOINTS = ('convert', 'api_convert')
+# Size of a compressed request body once decompressed, for the endpoints
+# without a limit of their own
+MAX_DECOMPRESSED_BYTES = int(os.environ.get('MAX_DECOMPRESSED_BYTES', 64 * 1024 * 1024)) or None
+
+admission = AdmissionControl(
+    int(os.environ.get('MAX_CONVERSIONS', 0)) or 2 * max(1, conversion_engine.workers),
+    max_queue_bytes=int(os.environ.get('ADMISSION_QUEUE_BYTES', 32 * 1024 * 1024)),
+    small_bytes=int(os.environ.get('ADMISSION_SMALL_BYTES', 64 * 1024)),
+    max_wait=float(os.environ.get('ADMISSION_MAX_WAIT', 10)) or None,
+)
+
+def body_limit(endpoint):
+    """Largest request body `endpoint` accepts, in bytes (None: no limit)."""
+    if endpoint in ADMITTED_ENDPOINTS:
+        return MAX_REQUEST_BYTES
+    if endpoint == 'api_convert_batch':
+        return MAX_BATCH_BYTES
+    if endpoint == 'api_convert_stream':
+        return MAX_STREAM_BYTES
+    return None
+
+class ConverterRequest(Request):
+
+    @property
+    def max_content_length(self):
+        limit = body_limit(self.endpoint)
+        return limit if limit is not None else super().max_content_length
+
+    @property
+    def decompressed(self):
+        """Whether the body is sent compressed (gzip or deflate) and read decompressed."""
+        return (self.content_encoding or '').strip().lower() in REQUEST_ENCODINGS
+
+    @property
+    def body_limit(self):
+        """
+        Largest body accepted, in bytes, once decompressed for a compressed
+        body (None: no limit).
+        """
+        limit = self.max_content_length
+        return MAX_DECOMPRESSED_BYTES if limit is None and self.decompressed else limit
+
+    @cached_property
+    def stream(self):
+        # A compressed body is decompressed as it is read, and it is as
+        # limited once decompressed as a plain body is.
+        stream = Request.stream.fget(self)
+        if not self.decompressed:
+            return stream
+        return io.BufferedReader(DecompressingStream(stream, self.body_limit))
+
+app.request_class = ConverterRequest
+
+# --- Response compression ---
+# Conversion responses are compressed for the clients that accept it: they
+# are mostly wikitext, which compresses several times over.
+
+API_COMPRESSION_LEVEL = int(os.environ.get('API_COMPRESSION_LEVEL', 5))
+# Smaller responses are sent as they are
+MIN_COMPRESSED_BYTES = 1024
+COMPRESSED_ENDPOINTS = ('api_convert', 'api_convert_batch')
+
+@app.after_request
+def compress_response(response):
+    if (request.endpoint not in COMPRESSED_ENDPOINTS or not API_COMPRESSION_LEVEL or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding == 'identity' or response.content_length < MIN_COMPRESSED_BYTES:
+        return response
+    response.set_data(compress(response.get_data(), encoding, API_COMPRESSION_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Bump whenever a change alters the output of the converter, so that results
+# cached by an older version are not served.
+CONVERTER_VERSION = '2'
+
+conversion_cache = ConversionCache(
+    CONVERTER_VERSION,
+    max_bytes=int(os.environ.get('CONVERSION_CACHE_BYTES', 64 * 1024 * 1024)),
+    disk_path=os.environ.get('CONVERSION_CACHE_PATH') or None,
+    disk_max_bytes=int(os.environ.get('CONVERSION_CACHE_DISK_BYTES', 512 * 1024 * 1024)),
+)
+
+def _convert_admitted(wikitext):
+    with admission.slot(len(wikitext)):
+        return _record_profile(conversion_engine.convert(wikitext))
+
+# Identical conversions requested at the same time (a page linked from a busy
+# discussion) run once: the requests that arrive while one is in flight wait
+# for it, without taking an admission slot, and share its result.
+conversion_flights = SingleFlight()
+
+def convert_cached(wikitext):
+    return conversion_cache.get_or_convert(wikitext, _convert_admitted, conversion_flights)
+
+# Last conversion of the documents converted incrementally, by document key
+incremental_documents = DocumentStore(int(os.environ.get('INCREMENTAL_CACHE_BYTES', 64 * 1024 * 1024)))
+MAX_DOCUMENT_KEY = 256
+
+def convert_document_incremental(key, wikitext):
     """
-    print ('*' * 20)
-    for i, (part, handler) in enumerate(parts):
-        print(f"--- Start element {i} with handler {handler.__name__} ---")
-        print(part) 
-        print(f"---\n") 
-        
-    print ('*' * 20)
+    Converts `wikitext`, the current version of the document `key`, in this
+    thread, only converting again what changed since its last conversion.
     """
-    
-    # Process links
-    tvar_id = 0
-    tvar_url_id = 0
-    tvar_code_id = 0
-    tvar_inline_icon_id = 0
-    for i, (part, handler) in enumerate(parts):
-        # Handlers for links require a tvar_id
-        if handler == process_double_brackets:
-            new_part, double_brackets_type = handler(part, tvar_id)
-            if double_brackets_type in [double_brackets_types.wikilink, double_brackets_types.special, double_brackets_types.inline_icon]:
-                new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-            else :
-                new_handler = lambda x: x  # No further processing for categories and files
-            parts[i] = (new_part, new_handler)
-            tvar_id += 1
-        elif handler == process_external_link:
-            new_part = handler(part, tvar_url_id)
-            new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-            parts[i] = (new_part, new_handler)
-            tvar_url_id += 1
-        elif handler == process_code_tag:
-            new_part = handler(part, tvar_code_id)
-            new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-            parts[i] = (new_part, new_handler)
-            tvar_code_id += 1
-        elif handler == process_double_brackets :
-            new_part, double_brackets_type = handler(part, tvar_inline_icon_id)
-            if double_brackets_type == double_brackets_types.inline_icon:
-                new_handler = _wrap_in_translate  # Change handler to _wrap_in_translate
-                tvar_inline_icon_id += 1
-            else:
-                new_handler = lambda x: x
-            
-    # Scan again the parts: merge consecutive parts handled by _wrap_in_translate
-    _parts = []
-    if parts:
-        current_part, current_handler = parts[0]
-        for part, handler in parts[1:]:
-            if handler == _wrap_in_translate and current_handler == _wrap_in_translate:
-                # Merge the parts
-                current_part += part
-            else:
-                _parts.append((current_part, current_handler))
-                current_part, current_handler = part, handler
-        # Add the last accumulated part
-        _parts.append((current_part, current_handler))
-        
-    # Process the parts with their respective handlers
-    processed_parts = [handler(part) for part, handler in _parts]            
-    
-    # Debug output
+    if not incremental_documents.max_bytes:
+        return convert_cached(wikitext)
+    converted, document = conversion_flights.do(
+        _document_flight(wikitext), _convert_incremental_admitted, key, wikitext)
+    _keep_document(key, document)
+    return converted
+
+def _document_flight(wikitext):
+    # Requests for other documents with the same text share the conversion,
+    # and take its document as the last version of their own.
+    return ('document', conversion_cache.key(wikitext))
+
+def _convert_incremental_admitted(key, wikitext):
+    with admission.slot(len(wikitext)):
+        return _convert_incremental_document(key, wikitext)
+
+def _convert_incremental_document(key, wikitext):
     """
-    print("Processed parts:")
-    for i, (ppart, (part, handler)) in enumerate(zip(processed_parts, _parts)):
-        print(f"--- Start element {i} with handler {handler.__name__} ---")
-        print(part)
-        print(f"---\n") 
-        print(ppart)  
-        print(f"---\n") 
+    Converts the new version of document `key`, whose previous version is
+    taken out of the store meanwhile. Returns (converted, IncrementalDocument),
+    the document being left to `_keep_document`.
     """
-    
-    # Join the processed parts into a single string and renumber tvars per unit
-    return renumber_tvars_per_unit(''.join(processed_parts)[1:])  # Remove the leading newline added at the beginning
+    previous = incremental_documents.take(key)
+    try:
+        converted, document, reused = convert_incremental(wikitext, previous, conversion_budget(len(wikitext)))
+    except ConversionError:
+        if previous is not None:
+            incremental_documents.put(key, previous, _document_size(previous))
+        raise
+    incremental_documents.count(len(document.text), reused)
+    return converted, document
+
+def _keep_document(key, document):
+    incremental_documents.put(key, document, _document_size(document))
+
+def _document_size(document):
+    return len(document.text) + sum(len(segment.output) for segment in document.segments)
+
+def _document_key(value):
+    return value if isinstance(value, str) and 0 < len(value) <= MAX_DOCUMENT_KEY else None
+
+def _document_conversion(wikitext, document):
+    """
+    The call converting `wikitext`, as (function, args): incrementally under
+    a document key, through the cache without one.
+    """
+    if document is None:
+        return convert_cached, (wikitext,)
+    return convert_document_incremental, (document, wikitext)
+
+# The conversion of the current request when the ASGI server (asgi.py) made it
+# ahead of the view, awaiting it on its event loop rather than on a thread: the
+# call, and its result or the exception it raised.
+converted_ahead = contextvars.ContextVar('converted_ahead', default=None)
+
+def _run_conversion(func, args):
+    """Returns func(*args), or the outcome of that call if it was made ahead of the view."""
+    ahead = converted_ahead.get()
+    if ahead is None or ahead[0] != (func, args):
+        return func(*args)
+    converted_ahead.set(None)
+    if isinstance(ahead[1], Exception):
+        raise ahead[1]
+    return ahead[1]
+
+# Documents of batches are admitted by these threads, each one taking an
+# admission slot for its size: a large batch waits in the queue among other
+# requests, in which small pages still go first, rather than filling the pool.
+batch_threads = ThreadPoolExecutor(admission.slots, thread_name_prefix='batch-conversion')
+
+class _BatchDocument:
+    def __init__(self, text):
+        self.text = text
+        self.error = None
+        self.converted = threading.Event()
+
+def _admit_batch_document(document, admitted):
+    # Holds the document's slot until the batch has converted it
+    try:
+        with admission.slot(len(document.text) if isinstance(document.text, str) else 0):
+            admitted.put(document)
+            document.converted.wait()
+    except Overloaded as e:
+        document.error = str(e)
+        admitted.put(document)
+
+def _convert_batch_documents(texts):
+    """
+    Converts the texts of a batch, each under admission control. The
+    documents admitted meanwhile are sent to the pool together, as one
+    `convert_many`, which spreads them over the workers in chunks.
+    """
+    documents = [_BatchDocument(text) for text in texts]
+    admitted = queue.SimpleQueue()
+    admissions = [batch_threads.submit(_admit_batch_document, document, admitted) for document in documents]
+    results = {}
+    try:
+        while len(results) < len(documents):
+            ready = [admitted.get()]
+            while True:
+                try:
+                    ready.append(admitted.get_nowait())
+                except queue.Empty:
+                    break
+            converting = []
+            for document in ready:
+                if document.error is not None:
+                    results[document] = (None, document.error)
+                else:
+                    converting.append(document)
+            for document, result in zip(converting, conversion_engine.convert_many([d.text for d in converting])):
+                results[document] = result
+                document.converted.set()
+    finally:
+        # The slots are released before the response is sent.
+        for document in documents:
+            document.converted.set()
+        futures_wait(admissions)
+    return [results[document] for document in documents]
+
+def convert_many_cached(texts):
+    """
+    Like `ConversionEngine.convert_many`, but only the texts that are not in
+    the conversion cache are converted, each under admission control.
+    """
+    results = [None] * len(texts)
+    keys = {}
+    for i, text in enumerate(texts):
+        if isinstance(text, str):
+            keys[i] = conversion_cache.key(text)
+            cached = conversion_cache.get(keys[i])
+            if cached is not None:
+                results[i] = (cached, None)
+    pending = [i for i, result in enumerate(results) if result is None]
+    for i, (converted, error) in zip(pending, _convert_batch_documents([texts[i] for i in pending])):
+        if error is None:
+            converted = _record_profile(converted)
+            conversion_cache.put(keys[i], converted)
+        results[i] = (converted, error)
+    return results
+
+# --- Pre-rendered pages ---
+# The home page without a conversion and the docs have no per-request
+# content: they are rendered once and served pre-compressed, with an ETag.
+
+STATIC_PAGE_MAX_AGE = int(os.environ.get('STATIC_PAGE_MAX_AGE', 24 * 3600))
+prerendered_pages = PrerenderedPages()
+
+def home_page(last_updated):
+    # Rendered again when the "last updated" date changes, which browsers
+    # see no later than the cache's refresh interval: the shorter one of a
+    # failed fetch while the date is unavailable.
+    ttl = last_updated_cache.failure_ttl if last_updated == UNAVAILABLE else last_updated_cache.ttl
+    return prerendered_pages.get(
+        'home', lambda: render_template('home.html', last_updated=last_updated),
+        min(STATIC_PAGE_MAX_AGE, ttl), version=last_updated)
+
+def docs_page():
+    return prerendered_pages.get('docs', lambda: render_template('docs.html'), STATIC_PAGE_MAX_AGE)
+
+def prerender_pages(wait=True):
+    """
+    Renders the pre-rendered pages ahead of their first request. Without
+    `wait`, the home page is only rendered if its date is known without
+    asking GitHub.
+    """
+    with app.app_context():
+        docs_page()
+        last_updated = last_updated_cache.get(wait=wait)
+        if last_updated is not None:
+            home_page(last_updated)
+
+# Rendered at startup, also when served by a WSGI server; not in the worker
+# processes of the conversion engine, which import this module too.
+if multiprocessing.parent_process() is None:
+    try:
+        prerender_pages(wait=False)
+    except Exception:
+        app.logger.exception("Could not pre-render the pages; they are rendered on their first request")
 
 @app.route('/')
 def index():
-    return render_template('home.html', last_updated=get_last_updated_date())
+    return home_page(get_last_updated_date()).respond(request)
 
 @app.route('/docs')
 def docs():
-    return render_template('docs.html')
+    return docs_page().respond(request)
 
 @app.route('/convert', methods=['GET'])
 def redirect_to_home():
-    return render_template('home.html', last_updated=get_last_updated_date())
+    return home_page(get_last_updated_date()).respond(request)
 
 @app.route('/convert', methods=['POST'])
 def convert():
     wikitext = request.form.get('wikitext', '')
-    converted_text = convert_to_translatable_wikitext(wikitext)
-    return render_template('home.html', original=wikitext, converted=converted_text, last_updated=get_last_updated_date())
+    # The page is converted again after every edit: it gets a document key,
+    # and conversions under that key are incremental. The first one, without
+    # a key, goes through the cache and the pool.
+    document = _document_key(request.form.get('document'))
+    func, args = _document_conversion(wikitext, document)
+    if document is None:
+        document = uuid.uuid4().hex
+    try:
+        converted_text = _run_conversion(func, args)
+    except ConversionError as e:
+        converted_text = str(e)
+    return render_template('home.html', original=wikitext, converted=converted_text, document=document,
+                           last_updated=get_last_updated_date())
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    if request.path.startswith('/api/'):
+        response = jsonify({'error': 'Server overloaded', 'reason': error.reason, 'retry_after': error.retry_after})
+    else:
+        response = make_response(render_template(
+            'home.html', original=request.form.get('wikitext', ''), converted=str(error),
+            document=_document_key(request.form.get('document')), last_updated=get_last_updated_date()))
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
-@app.route('/api/convert', methods=['GET', 'POST'])
-def api_convert():
-    if request.method == 'GET':
-        return """
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    admission.reject_too_large()
+    limit = request.body_limit
+    if limit is None:
+        message = 'Request body too large'
+    else:
+        message = f"Request body larger than {limit} bytes{' once decompressed' if request.decompressed else ''}"
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message}), 413
+    return render_template('home.html', converted=message, last_updated=get_last_updated_date()), 413
+
+def _conversion_error(error):
+    """
+    The JSON body and status of a failed conversion: a page that cannot be
+    converted within its budget is unprocessable; any other failure is an
+    internal error.
+    """
+    if isinstance(error, ConversionAborted):
+        return {'error': 'Conversion aborted', 'reason': error.reason, 'detail': error.detail}, 422
+    if isinstance(error, ConversionTimeout):
+        return {'error': 'Conversion aborted', 'reason': 'timeout', 'detail': str(error)}, 422
+    return {'error': str(error)}, 500
+
+def _conversion_error_response(error):
+    body, status = _conversion_error(error)
+    return jsonify(body), status
+
+# Ends a streamed conversion that failed after its response started, on a
+# line of its own: a wikitext comment holding the error as JSON.
+STREAM_ERROR_PREFIX = '<!-- translatetagger-error: '
+STREAM_ERROR_SUFFIX = ' -->\n'
+
+def _stream_error(error):
+    # Escaped so that the JSON cannot end the comment
+    body = json.dumps(_conversion_error(error)[0]).replace('>', '\\u003e')
+    return f"\n{STREAM_ERROR_PREFIX}{body}{STREAM_ERROR_SUFFIX}"
+
+API_CONVERT_USAGE = """
         <h1>Translate Tagger API</h1>
         <p>Send a POST request with JSON data to use this API.</p>
         <p>Example:</p>
@@ -1110,18 +2553,227 @@ def api_convert():
         -d '{"wikitext": "This is a test [[link|example]]"}'
         </pre>
         """
+
+def _read_convert_request(data, args):
+    """
+    Validates the JSON payload of a POST to /api/convert. Returns
+    ((wikitext, document, profiled, with_units, include_original), None), or
+    (None, error response).
+    """
+    if not data or 'wikitext' not in data:
+        return None, (jsonify({'error': 'Missing "wikitext" in JSON payload'}), 400)
+    wikitext = data.get('wikitext', '')
+    if not isinstance(wikitext, str):
+        return None, (jsonify({'error': '"wikitext" must be a string'}), 400)
+    profiled = _parse_bool(data.get('profile', args.get('profile')), False)
+    with_units = _parse_bool(data.get('units', args.get('units')), False)
+    include_original = _parse_bool(data.get('include_original', args.get('include_original')), True)
+    document = None if profiled or with_units else data.get('document')
+    if document is not None and _document_key(document) is None:
+        return None, (jsonify({'error': f'"document" must be a string of 1 to {MAX_DOCUMENT_KEY} characters'}), 400)
+    return (wikitext, document, profiled, with_units, include_original), None
+
+def _convert_in_process(wikitext, profiled, with_units):
+    """
+    Converts in this process, bypassing the cache and the pool: conversions
+    that are profiled or return their units. Returns (converted, units, profile).
+    """
+    convert = _convert_document_units if with_units else _convert_document
+    if profiled:
+        converted, profile = run_profiled(convert, wikitext)
+        conversion_metrics.add(profile)
+    else:
+        converted, profile = convert(wikitext), None
+    converted, units = converted if with_units else (converted, None)
+    return converted, units, profile
+
+def _convert_in_process_admitted(wikitext, profiled, with_units):
+    with admission.slot(len(wikitext)):
+        return _convert_in_process(wikitext, profiled, with_units)
+
+def _api_conversion(job):
+    """The call converting the page of a valid /api/convert request, as (function, args)."""
+    wikitext, document, profiled, with_units, _ = job
+    if profiled or with_units:
+        return _convert_in_process_admitted, (wikitext, profiled, with_units)
+    return _document_conversion(wikitext, document)
+
+def _converted_response(wikitext, converted_text, profile=None, units=None, include_original=True):
+    body = {'original': wikitext, 'converted': converted_text} if include_original else {'converted': converted_text}
+    if units is not None:
+        body['units'] = [unit._asdict() for unit in units]
+    if profile is not None:
+        body['profile'] = profile.as_dict()
+    return jsonify(body)
+
+@app.route('/api/convert', methods=['GET', 'POST'])
+def api_convert():
+    if request.method == 'GET':
+        return API_CONVERT_USAGE
     elif request.method == 'POST':
-        data = request.get_json()
-        if not data or 'wikitext' not in data:
-            return jsonify({'error': 'Missing "wikitext" in JSON payload'}), 400
-        
-        wikitext = data.get('wikitext', '')
-        converted_text = convert_to_translatable_wikitext(wikitext)
-        
-        return jsonify({
-            'original': wikitext,
-            'converted': converted_text
-        })
+        job, error = _read_convert_request(request.get_json(), request.args)
+        if error is not None:
+            return error
+        wikitext, document, profiled, with_units, include_original = job
+        try:
+            converted = _run_conversion(*_api_conversion(job))
+        except ConversionError as e:
+            return _conversion_error_response(e)
+        if profiled or with_units:
+            converted_text, units, profile = converted
+            return _converted_response(wikitext, converted_text, profile, units, include_original)
+        return _converted_response(wikitext, converted, include_original=include_original)
+
+def planned_conversion():
+    """
+    The conversion the view of the current request will make, as (function,
+    args), for the ASGI server to make it ahead of the view; None when the
+    view makes none or the request is invalid, which the view reports.
+    """
+    if request.method != 'POST':
+        return None
+    if request.endpoint == 'convert':
+        return _document_conversion(request.form.get('wikitext', ''), _document_key(request.form.get('document')))
+    if request.endpoint == 'api_convert':
+        job, error = _read_convert_request(request.get_json(silent=True), request.args)
+        return None if error is not None else _api_conversion(job)
+    return None
+
+@app.route('/api/convert/stream', methods=['POST'])
+def api_convert_stream():
+    """
+    Converts a raw UTF-8 wikitext request body and streams the converted text
+    back as it is produced, so that large pages are never held in memory as a
+    whole. Invalid UTF-8 is replaced rather than rejected, as the response has
+    already started by the time it is read. For the same reason, a conversion
+    that fails ends the response before it is complete, with a last line
+    holding the error (see STREAM_ERROR_PREFIX) instead of an error status.
+    """
+    # Opening the stream rejects a body larger than MAX_STREAM_BYTES, before
+    # the response starts.
+    stream = request.stream
+
+    def read_chunks():
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            data = stream.read(STREAM_READ_SIZE)
+            if not data:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+
+    # The length of a compressed body is not that of the page.
+    length = None if request.decompressed else request.content_length
+
+    def generate():
+        budget = conversion_budget(length) if length else ConversionBudget(CONVERSION_DEADLINE)
+        try:
+            for piece in iter_convert(read_chunks(), budget):
+                yield piece.encode('utf-8')
+        except ConversionError as e:
+            app.logger.warning("Streamed conversion failed after its response started: %s", e)
+            yield _stream_error(e).encode('utf-8')
+
+    # The conversion holds an admission slot until the response is closed; a
+    # page of unknown length counts as a large one.
+    slot = ExitStack()
+    slot.enter_context(admission.slot(length or admission.small_bytes + 1))
+    response = Response(stream_with_context(generate()), mimetype='text/plain')
+    response.call_on_close(slot.close)
+    return response
+
+def _parse_bool(value, default):
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() not in ('0', 'false', 'no', 'off', '')
+
+@app.route('/api/convert/batch', methods=['POST'])
+def api_convert_batch():
+    data = request.get_json(silent=True)
+    include_original = _parse_bool(request.args.get('include_original'), True)
+    if isinstance(data, dict):
+        include_original = _parse_bool(data.get('include_original'), include_original)
+        data = data.get('documents')
+    if not isinstance(data, list):
+        return jsonify({'error': 'Expected a JSON array of {"id", "wikitext"} documents'}), 400
+    if len(data) > MAX_BATCH_DOCUMENTS:
+        return jsonify({'error': f'At most {MAX_BATCH_DOCUMENTS} documents per batch'}), 413
+
+    ids = []
+    seen = set()
+    for index, document in enumerate(data):
+        if not isinstance(document, dict) or 'id' not in document:
+            return jsonify({'error': f'Document {index} must be an object with an "id"'}), 400
+        doc_id = str(document['id'])
+        if doc_id in seen:
+            return jsonify({'error': f'Duplicate document id "{doc_id}"'}), 400
+        seen.add(doc_id)
+        ids.append(doc_id)
+
+    texts = [document.get('wikitext') for document in data]
+    results = {}
+    for doc_id, text, (converted, error) in zip(ids, texts, convert_many_cached(texts)):
+        if error is not None:
+            results[doc_id] = {'error': error}
+            continue
+        results[doc_id] = {'converted': converted}
+        if include_original:
+            results[doc_id]['original'] = text
+    return jsonify({'results': results})
+
+@app.route('/api/stats')
+def api_stats():
+    return jsonify({
+        'conversion_cache': conversion_cache.stats(),
+        'fragment_memo': fragment_memo.stats(),
+        'incremental': incremental_documents.stats(),
+        'admission': admission.stats(),
+        'coalescing': conversion_flights.stats(),
+        'conversion_engine': {
+            'kind': conversion_engine.kind,
+            'workers': conversion_engine.workers,
+            'pool_restarts': conversion_engine.pool_restarts,
+        },
+        'last_updated': last_updated_cache.stats(),
+    })
+
+@app.route('/metrics')
+def metrics():
+    cache = conversion_cache.stats()
+    samples = [
+        ('translatetagger_cache_hits_total', 'counter', 'Conversion cache hits (memory tier).', [({}, cache['hits'])]),
+        ('translatetagger_cache_disk_hits_total', 'counter', 'Conversion cache hits (disk tier).', [({}, cache['disk_hits'])]),
+        ('translatetagger_cache_misses_total', 'counter', 'Conversion cache misses.', [({}, cache['misses'])]),
+        ('translatetagger_cache_evictions_total', 'counter', 'Conversion cache evictions (memory tier).', [({}, cache['evictions'])]),
+        ('translatetagger_cache_bytes', 'gauge', 'Size of the conversion cache (memory tier).', [({}, cache['bytes'])]),
+        ('translatetagger_pool_restarts_total', 'counter', 'Worker pools replaced after a timeout or crash.',
+         [({}, conversion_engine.pool_restarts)]),
+    ]
+    queue = admission.stats()
+    samples.extend([
+        ('translatetagger_admission_running', 'gauge', 'Conversions running.', [({}, queue['running'])]),
+        ('translatetagger_admission_queue_depth', 'gauge', 'Conversions waiting for a slot, per lane.',
+         [({'lane': lane}, depth) for lane, depth in queue['queued'].items()]),
+        ('translatetagger_admission_queued_bytes', 'gauge', 'Input size of the conversions waiting.', [({}, queue['queued_bytes'])]),
+        ('translatetagger_admission_admitted_total', 'counter', 'Conversions admitted.', [({}, queue['admitted'])]),
+        ('translatetagger_admission_wait_seconds_total', 'counter', 'Time admitted conversions waited for a slot.',
+         [({}, queue['wait_seconds_total'])]),
+        ('translatetagger_admission_rejections_total', 'counter', 'Requests rejected, by reason.',
+         [({'reason': reason}, count) for reason, count in queue['rejections'].items()]),
+    ])
+    flights = conversion_flights.stats()
+    samples.extend([
+        ('translatetagger_coalescing_in_flight', 'gauge', 'Conversions in flight that identical requests can join.',
+         [({}, flights['in_flight'])]),
+        ('translatetagger_coalescing_calls_total', 'counter', 'Conversions run for the requests that missed the cache.',
+         [({}, flights['calls'])]),
+        ('translatetagger_coalesced_requests_total', 'counter', 'Requests that shared a conversion already in flight.',
+         [({}, flights['coalesced'])]),
+    ])
+    samples.extend(profile_samples(conversion_metrics.snapshot()))
+    return Response(format_prometheus(samples), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,309 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from tempfile import SpooledTemporaryFile
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.exceptions import HTTPException
+
+import app as service
+
+# Serves the application on an asyncio event loop: `uvicorn asgi:app`.
+#
+# Requests are read on the loop: a client that is slow to send its request
+# only costs the loop a socket. The conversion of /convert and /api/convert
+# is then made on the loop too, which waits for its admission and for the
+# worker pool without a thread (see app.planned_conversion). Each request is
+# finally handed to the Flask app, adapted by asgiref, on a thread of its
+# own; its view takes the conversion already made, and its response is
+# queued for the loop to send, so that a client slow to read it does not
+# hold the thread either.
+
+flask_app = service.app
+
+# Worker processes forked from the server would inherit the sockets of the
+# connections open at the time, which then stay open until the worker exits.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    service.conversion_engine.start_method = 'forkserver'
+
+# Requests served by the Flask app at once, each on a thread. Batches and
+# streamed conversions, which convert on their thread, take at most half of
+# them, so that the pages are still served meanwhile.
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+CONVERTING_VIEWS = ('api_convert_batch', 'api_convert_stream')
+# Request bodies are held in memory up to this size, in a temporary file beyond
+BODY_SPOOL_BYTES = 1024 * 1024
+BODY_CHUNK_BYTES = 64 * 1024
+# Response bytes queued for a client before the view producing a streamed
+# response waits for it to read them
+RESPONSE_BUFFER_BYTES = 1024 * 1024
+# Methods whose request bodies are never read
+BODILESS_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+threads = asyncio.Semaphore(ASGI_THREADS)
+converting_threads = asyncio.Semaphore(max(1, ASGI_THREADS // 2))
+
+# Blocking calls: parsing a request ahead of its view, the disk cache
+blocking_threads = ThreadPoolExecutor(ASGI_THREADS, thread_name_prefix='asgi-blocking')
+# Conversions admitted that run in this process rather than on the pool
+conversion_threads = ThreadPoolExecutor(service.admission.slots, thread_name_prefix='asgi-conversion')
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def _blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_threads, func, *args)
+
+
+async def _in_process(size, func, *args):
+    async with service.admission.async_slot(size):
+        return await asyncio.get_running_loop().run_in_executor(conversion_threads, func, *args)
+
+# --- Conversions ---
+# The asynchronous counterparts of the conversions of the views of app.py
+
+
+async def convert_cached(wikitext):
+    """Like `app.convert_cached`, without blocking the event loop."""
+    cache = service.conversion_cache
+    key = cache.key(wikitext)
+    # The memory tier is a dictionary lookup: only the disk tier needs a thread.
+    converted = await _blocking(cache.get, key) if cache.disk is not None else cache.get(key)
+    if converted is None:
+        converted = await service.conversion_flights.do_async(key, _convert_and_cache, key, wikitext)
+    return converted
+
+
+async def _convert_and_cache(key, wikitext):
+    cache = service.conversion_cache
+    async with service.admission.async_slot(len(wikitext)):
+        converted = service._record_profile(await service.conversion_engine.convert_async(wikitext))
+    if cache.disk is not None:
+        await _blocking(cache.put, key, converted)
+    else:
+        cache.put(key, converted)
+    return converted
+
+
+async def convert_document_incremental(key, wikitext):
+    """Like `app.convert_document_incremental`, without blocking the event loop."""
+    if not service.incremental_documents.max_bytes:
+        return await convert_cached(wikitext)
+    converted, document = await service.conversion_flights.do_async(
+        service._document_flight(wikitext), _in_process, len(wikitext), service._convert_incremental_document,
+        key, wikitext)
+    service._keep_document(key, document)
+    return converted
+
+
+async def convert_in_process(wikitext, profiled, with_units):
+    """Like `app._convert_in_process_admitted`, without blocking the event loop."""
+    return await _in_process(len(wikitext), service._convert_in_process, wikitext, profiled, with_units)
+
+
+CONVERSIONS = {
+    service.convert_cached: convert_cached,
+    service.convert_document_incremental: convert_document_incremental,
+    service._convert_in_process_admitted: convert_in_process,
+}
+
+
+def _planned_conversion(environ):
+    # Only parses the request: a request the view rejects is not converted.
+    with flask_app.request_context(environ):
+        try:
+            return service.planned_conversion()
+        except HTTPException:
+            return None
+
+
+async def _convert_ahead(scope, body):
+    """
+    Makes the conversion of the request ahead of its view; returns it with
+    its outcome, for `app.converted_ahead`, or None.
+    """
+    environ = _environ(scope, body)
+    try:
+        call = await _blocking(_planned_conversion, environ)
+    finally:
+        body.seek(0)
+    if call is None:
+        return None
+    func, args = call
+    if func not in CONVERSIONS:
+        return None
+    try:
+        return call, await CONVERSIONS[func](*args)
+    except Exception as e:
+        return call, e
+
+# --- Requests ---
+
+
+class _Disconnected(Exception):
+    pass
+
+
+def _environ(scope, body):
+    instance = WsgiToAsgiInstance(flask_app)
+    instance.scope = scope
+    return instance.build_environ(scope, body)
+
+
+def _endpoint(scope):
+    """The endpoint `scope` is routed to, or None."""
+    path, root_path = scope['path'], scope.get('root_path', '')
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+    try:
+        endpoint, _ = flask_app.url_map.bind('localhost').match(path, method=scope['method'])
+    except HTTPException:
+        return None
+    return endpoint
+
+
+def _content_length(scope):
+    for name, value in scope.get('headers', ()):
+        if name == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def _read_body(scope, endpoint, receive):
+    """
+    Reads the request body into a file; returns the file and the scope to
+    hand to the Flask app with it. Stops one byte past the endpoint's limit,
+    and does not read a body whose Content-Length is already past it, nor
+    that of a request which no view reads.
+    """
+    body = SpooledTemporaryFile(BODY_SPOOL_BYTES)
+    if endpoint is None or scope['method'] in BODILESS_METHODS:
+        return body, scope
+    limit = service.body_limit(endpoint) or service.MAX_DECOMPRESSED_BYTES
+    if limit is not None and (_content_length(scope) or 0) > limit:
+        return body, scope
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            raise _Disconnected()
+        chunk = message.get('body', b'')
+        if limit is not None:
+            chunk = chunk[:limit + 1 - size]
+        body.write(chunk)
+        size += len(chunk)
+        if not message.get('more_body', False) or (limit is not None and size > limit):
+            break
+    body.seek(0)
+    # The body is sent to the app with the length read, chunked or not: one
+    # past the limit gets a 413 before the view reads it.
+    headers = [(name, value) for name, value in scope.get('headers', ())
+               if name not in (b'content-length', b'transfer-encoding')]
+    headers.append((b'content-length', str(size).encode('latin-1')))
+    return body, dict(scope, headers=headers)
+
+
+def _replay(body):
+    async def receive():
+        chunk = body.read(BODY_CHUNK_BYTES)
+        return {'type': 'http.request', 'body': chunk, 'more_body': len(chunk) == BODY_CHUNK_BYTES}
+    return receive
+
+
+class _ResponseQueue:
+    """
+    The `send` of the Flask app: queues the messages of its response for the
+    loop to send, so that the view's thread does not wait for the client.
+    Only a streamed response waits once RESPONSE_BUFFER_BYTES are queued.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._messages = asyncio.Queue()
+        self._queued = 0
+        self._failed = None
+        self._sent = asyncio.Condition()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def send(self, message):
+        size = len(message.get('body', b''))
+        if size:
+            async with self._sent:
+                await self._sent.wait_for(lambda: self._failed or self._queued <= RESPONSE_BUFFER_BYTES)
+        if self._failed is not None:
+            raise self._failed
+        self._queued += size
+        self._messages.put_nowait(message)
+
+    async def _run(self):
+        while True:
+            message = await self._messages.get()
+            if message is None:
+                return
+            try:
+                await self._send(message)
+            except Exception as e:
+                # The view stops at its next message
+                self._failed = e
+            async with self._sent:
+                self._queued -= len(message.get('body', b''))
+                self._sent.notify_all()
+
+    async def close(self):
+        self._messages.put_nowait(None)
+        await self.task
+
+
+async def _serve(scope, receive, send):
+    endpoint = _endpoint(scope)
+    try:
+        body, scope = await _read_body(scope, endpoint, receive)
+    except _Disconnected:
+        # Nobody is left to respond to
+        return
+    with body:
+        if endpoint in ('convert', 'api_convert'):
+            service.converted_ahead.set(await _convert_ahead(scope, body))
+        responses = _ResponseQueue(send)
+        try:
+            async with (converting_threads if endpoint in CONVERTING_VIEWS else nullcontext()), threads:
+                async with ThreadSensitiveContext():
+                    await wsgi_app(scope, _replay(body), responses.send)
+        finally:
+            await responses.close()
+
+
+def _prerendered(future):
+    if not future.cancelled() and future.exception() is not None:
+        flask_app.logger.error("Could not pre-render the pages; they are rendered on their first request",
+                               exc_info=future.exception())
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Fetch the "last updated" date and render the pages now rather
+            # than on the first page view.
+            prerendered = asyncio.get_running_loop().run_in_executor(blocking_threads, service.prerender_pages)
+            prerendered.add_done_callback(_prerendered)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            service.conversion_engine.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http':
+        await _serve(scope, receive, send)
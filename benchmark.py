@@ -0,0 +1,414 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, 'corpus')
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+# Sizes (in characters) of the documents generated for every category.
+CORPUS_SIZES = (2 * 1024, 16 * 1024, 64 * 1024)
+CORPUS_SEED = 20250301
+
+# --- Synthetic corpus ---
+
+WORDS = (
+    "the of and translation page wiki community project language content "
+    "volunteer article editor help software contributor guide meeting report "
+    "update feature policy discussion support version documentation"
+).split()
+
+
+def _sentence(rng, words=12):
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(words // 2, words)))
+    return text.capitalize() + '.'
+
+
+def _paragraph(rng, sentences=5):
+    return ' '.join(_sentence(rng) for _ in range(rng.randint(2, sentences)))
+
+
+def _link(rng):
+    page = rng.choice(WORDS).capitalize() + ' ' + rng.choice(WORDS)
+    return rng.choice([
+        f"[[{page}]]",
+        f"[[{page}|{rng.choice(WORDS)}]]",
+        f"[https://example.org/{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.choice(WORDS)}]",
+        f"[[File:{rng.choice(WORDS)}.png|thumb|{_sentence(rng, 6)}]]",
+        f"[[Category:{page}]]",
+        f"[[m:{page}]]",
+        f"[[phab:T{rng.randint(1000, 99999)}]]",
+    ])
+
+
+def _template(rng):
+    name = rng.choice(WORDS).capitalize()
+    params = '|'.join(
+        rng.choice([rng.choice(WORDS), f"{rng.choice(WORDS)}={rng.choice(WORDS)}"])
+        for _ in range(rng.randint(0, 4))
+    )
+    return '{{' + name + ('|' + params if params else '') + '}}'
+
+
+def _prose(rng):
+    if rng.random() < 0.1:
+        return f"== {_sentence(rng, 4)[:-1]} ==\n\n"
+    return _paragraph(rng, 8) + "\n\n"
+
+
+def _links(rng):
+    words = []
+    for _ in range(rng.randint(4, 12)):
+        words.append(_link(rng) if rng.random() < 0.4 else rng.choice(WORDS))
+    return ' '.join(words) + ".\n\n"
+
+
+def _nested(rng, depth=0):
+    if depth >= 6 or rng.random() < 0.2:
+        return _paragraph(rng, 2) + ' ' + _link(rng)
+    inner = '\n'.join(_nested(rng, depth + 1) for _ in range(rng.randint(1, 2)))
+    if rng.random() < 0.5:
+        return f'<div class="level-{depth}">\n{inner}\n</div>'
+    return f'{{| class="wikitable"\n! {_sentence(rng, 3)}\n|-\n| {_sentence(rng, 6)}\n|-\n| {inner}\n|}}'
+
+
+def _nested_block(rng):
+    return _nested(rng) + "\n\n"
+
+
+def _lists(rng):
+    lines = []
+    for _ in range(rng.randint(3, 10)):
+        marker = rng.choice(['*', '**', '#', '##', ':', ';'])
+        item = _sentence(rng, 8)
+        if rng.random() < 0.3:
+            item += ' ' + _link(rng)
+        lines.append(f"{marker} {item}")
+    return '\n'.join(lines) + "\n\n"
+
+
+def _templates(rng):
+    pieces = []
+    for _ in range(rng.randint(2, 6)):
+        pieces.append(_template(rng) if rng.random() < 0.6 else _sentence(rng, 6))
+    return ' '.join(pieces) + "\n\n"
+
+
+CATEGORIES = {
+    'prose': _prose,
+    'links': _links,
+    'nested': _nested_block,
+    'lists': _lists,
+    'templates': _templates,
+}
+
+
+def generate_document(category, size, seed=CORPUS_SEED):
+    """
+    Returns a synthetic page of `category` of about `size` characters. The
+    output only depends on the arguments.
+    """
+    rng = random.Random(f"{seed}-{category}-{size}")
+    block = CATEGORIES[category]
+    pieces = []
+    length = 0
+    while length < size:
+        piece = block(rng)
+        pieces.append(piece)
+        length += len(piece)
+    return ''.join(pieces)
+
+
+def write_corpus(directory=CORPUS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    for category in CATEGORIES:
+        for size in CORPUS_SIZES:
+            path = os.path.join(directory, f"{category}-{size // 1024}k.wiki")
+            with open(path, 'w', encoding='utf-8', newline='\n') as f:
+                f.write(generate_document(category, size))
+
+
+def load_corpus(directory=CORPUS_DIR, categories=None):
+    """
+    Returns {category: [(name, text), ...]} for the *.wiki files of
+    `directory`, named "<category>-<anything>.wiki".
+    """
+    corpus = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.wiki'):
+            continue
+        category = name.split('-', 1)[0]
+        if categories and category not in categories:
+            continue
+        with open(os.path.join(directory, name), encoding='utf-8') as f:
+            corpus.setdefault(category, []).append((name, f.read()))
+    return corpus
+
+# --- Measurements ---
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+# Runs needed for a percentile to say more than the maximum does: the tail
+# percentiles are only reported with that many timed runs of a size.
+PERCENTILE_MIN_RUNS = {'p90': 10, 'p99': 100}
+
+
+def latency_summary(latencies):
+    """Median and maximum of `latencies`, in ms, and the percentiles as many runs support."""
+    summary = {'p50': percentile(latencies, 0.5) * 1000}
+    for name, fraction in (('p90', 0.9), ('p99', 0.99)):
+        if len(latencies) >= PERCENTILE_MIN_RUNS[name]:
+            summary[name] = percentile(latencies, fraction) * 1000
+    summary['max'] = max(latencies) * 1000
+    return summary
+
+
+def size_label(name):
+    """The size part of a corpus file name: "2k" for "links-2k.wiki"."""
+    return name[:-len('.wiki')].split('-', 1)[-1]
+
+
+CALIBRATION_TOKENS = re.compile(r"\[\[|\]\]|\{\{|\}\}|<[^<>]*>|\w+|[^\w\s]")
+
+
+def calibrate(rounds=10, passes=5):
+    """
+    Milliseconds taken by a fixed amount of string, regex and dictionary
+    work that does not involve the converter (best of `rounds`). Timings are
+    compared in units of this run, which is as much slower on a slower
+    machine as the conversions are.
+    """
+    text = generate_document('links', 16 * 1024)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(passes):
+            counts = {}
+            for token in CALIBRATION_TOKENS.findall(text):
+                counts[token] = counts.get(token, 0) + 1
+            ''.join(sorted(text.split('\n\n'))).replace('[[', '<translate>').lower()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def benchmark_documents(convert, documents, repeat, reset=None):
+    # `reset` is called before every conversion, so that none of them reuses
+    # what the previous one left in a cache.
+    reset = reset or (lambda: None)
+    latencies = []
+    best_seconds = 0.0
+    total_bytes = 0
+    for _, text in documents:
+        reset()
+        convert(text)  # Warm up
+        timings = []
+        for _ in range(repeat):
+            reset()
+            start = time.perf_counter()
+            convert(text)
+            timings.append(time.perf_counter() - start)
+        latencies.extend(timings)
+        # Throughput is based on the fastest run of every document, which
+        # is the least disturbed by whatever else the machine is doing.
+        best_seconds += min(timings)
+        total_bytes += len(text.encode('utf-8'))
+
+    # Memory is measured in separate runs: tracing slows conversions down.
+    peak_memory = 0
+    for _, text in documents:
+        reset()
+        tracemalloc.start()
+        try:
+            convert(text)
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'documents': len(documents),
+        'bytes': total_bytes,
+        'runs': len(latencies),
+        'throughput_kb_s': total_bytes / 1024 / best_seconds if best_seconds else None,
+        'latency_ms': latency_summary(latencies),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def benchmark_category(convert, documents, repeat, reset=None):
+    """
+    Measures the documents of a category by size: latencies of documents
+    of different sizes are not mixed in one percentile. Throughput and
+    peak memory are also given for the category as a whole.
+    """
+    by_size = {}
+    for name, text in documents:
+        by_size.setdefault(size_label(name), []).append((name, text))
+    sizes = {
+        size: benchmark_documents(convert, sized, repeat, reset)
+        for size, sized in sorted(by_size.items(), key=lambda item: sum(len(text) for _, text in item[1]))
+    }
+    best_seconds = sum(r['bytes'] / 1024 / r['throughput_kb_s'] for r in sizes.values() if r['throughput_kb_s'])
+    total_bytes = sum(r['bytes'] for r in sizes.values())
+    return {
+        'documents': len(documents),
+        'bytes': total_bytes,
+        'throughput_kb_s': total_bytes / 1024 / best_seconds if best_seconds else None,
+        'peak_memory_bytes': max(r['peak_memory_bytes'] for r in sizes.values()),
+        'sizes': sizes,
+    }
+
+
+def run_benchmarks(convert, corpus, repeat=5, reset=None, fragment_memo='cleared'):
+    """
+    Measures `convert` on `corpus`. `fragment_memo` records how the memo of
+    converted links and templates was treated ('cleared' by `reset` before
+    every conversion, or 'kept'), as timings of both are not comparable.
+    """
+    # Calibrated on both sides of the measurements, keeping the fastest run as
+    # throughput does
+    calibration_ms = calibrate()
+    categories = {
+        category: benchmark_category(convert, documents, repeat, reset)
+        for category, documents in corpus.items()
+    }
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'calibration_ms': min(calibration_ms, calibrate()),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'fragment_memo': fragment_memo,
+        'categories': categories,
+    }
+
+
+def compare(results, baseline, threshold=0.3):
+    """
+    Lists the regressions of `results` against `baseline`: a category whose
+    throughput dropped, or whose peak memory or median latency at one of its
+    sizes grew, by more than `threshold` (a fraction). The timings of the
+    baseline are first scaled by how much slower or faster the calibration
+    run of `results` was; without calibrations to go by, only memory is
+    compared.
+    """
+    regressions = []
+    scale = None
+    if results.get('calibration_ms') and baseline.get('calibration_ms'):
+        scale = results['calibration_ms'] / baseline['calibration_ms']
+    for category, new in results['categories'].items():
+        old = baseline.get('categories', {}).get(category)
+        if old is None:
+            continue
+        if scale is not None and old['throughput_kb_s']:
+            expected = old['throughput_kb_s'] / scale
+            if new['throughput_kb_s'] < expected * (1 - threshold):
+                regressions.append(
+                    f"{category}: throughput {new['throughput_kb_s']:.1f} KB/s, baseline {expected:.1f} KB/s "
+                    f"on this machine"
+                )
+        for size, new_size in new['sizes'].items():
+            old_size = old.get('sizes', {}).get(size)
+            if scale is None or old_size is None:
+                continue
+            expected = old_size['latency_ms']['p50'] * scale
+            if new_size['latency_ms']['p50'] > expected * (1 + threshold):
+                regressions.append(
+                    f"{category} {size}: p50 latency {new_size['latency_ms']['p50']:.1f} ms, "
+                    f"baseline {expected:.1f} ms on this machine"
+                )
+        if new['peak_memory_bytes'] > old['peak_memory_bytes'] * (1 + threshold):
+            regressions.append(
+                f"{category}: peak memory {new['peak_memory_bytes']} bytes, baseline {old['peak_memory_bytes']} bytes"
+            )
+    return regressions
+
+
+def _latency(latency, name):
+    # A percentile not reported for lack of runs shows as "-"
+    return f"{latency[name]:>9.1f}" if name in latency else f"{'-':>9}"
+
+
+def format_results(results):
+    lines = [f"{'category':<10} {'size':>5} {'docs':>4} {'runs':>5} {'KB/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+             f"{'max ms':>9} {'peak MiB':>9}"]
+    for category, c in results['categories'].items():
+        for size, r in c['sizes'].items():
+            latency = r['latency_ms']
+            lines.append(
+                f"{category:<10} {size:>5} {r['documents']:>4} {r['runs']:>5} {r['throughput_kb_s']:>9.1f} {_latency(latency, 'p50')} "
+                f"{_latency(latency, 'p90')} {_latency(latency, 'p99')} {_latency(latency, 'max')} "
+                f"{r['peak_memory_bytes'] / 2**20:>9.2f}"
+            )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks convert_to_translatable_wikitext on a synthetic corpus.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('generate', help="rewrite the checked-in corpus from the generator")
+    run = subcommands.add_parser('run', help="run the benchmarks")
+    run.add_argument('--corpus', default=CORPUS_DIR, help="directory of <category>-*.wiki files")
+    run.add_argument('--category', action='append', help="only run this category (repeatable)")
+    run.add_argument('--repeat', type=int, default=5,
+                     help="timed conversions per document (p90 is reported from 10 runs of a size, p99 from 100)")
+    run.add_argument('--output', help="write the results as JSON to this file")
+    run.add_argument('--baseline', default=BASELINE_PATH, help="results to compare against")
+    run.add_argument('--threshold', type=float, default=0.3, help="allowed regression, as a fraction")
+    run.add_argument('--keep-memo', action='store_true',
+                     help="keep the fragment memo between conversions, measuring repeated links and templates "
+                          "as memo hits")
+    run.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        write_corpus()
+        return 0
+
+    from app import convert_to_translatable_wikitext, fragment_memo
+
+    memo_mode = 'kept' if args.keep_memo else 'cleared'
+    results = run_benchmarks(convert_to_translatable_wikitext, load_corpus(args.corpus, args.category), args.repeat,
+                             reset=None if args.keep_memo else fragment_memo.clear, fragment_memo=memo_mode)
+    print("Fragment memo: kept between conversions" if args.keep_memo else "Fragment memo: cleared before each conversion")
+    print(f"Calibration: {results['calibration_ms']:.1f} ms")
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('fragment_memo', 'kept') != memo_mode:
+        print(f"Not compared: the baseline was measured with the fragment memo {baseline.get('fragment_memo', 'kept')}",
+              file=sys.stderr)
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import gzip
+import io
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+try:
+    import brotli
+except ImportError:  # Optional: without it, responses are offered with gzip only.
+    brotli = None
+
+# Response encodings, preferred first when a client accepts several equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Content-Encodings of request bodies that are decompressed
+REQUEST_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+READ_SIZE = 64 * 1024
+
+
+def negotiate(accept_encodings, encodings=ENCODINGS):
+    """
+    The encoding of `encodings` that a client with these `Accept-Encoding`
+    values prefers, or "identity".
+    """
+    best, best_quality = 'identity', 0
+    for encoding in encodings:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(body, encoding, level=6):
+    """
+    Compresses `body` for `encoding` at `level`: the gzip level (at most 9)
+    or the Brotli quality (at most 11).
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    if encoding == 'gzip':
+        return gzip.compress(body, min(level, 9), mtime=0)
+    return body
+
+
+class DecompressingStream(io.RawIOBase):
+    """
+    A gzip or zlib ("deflate") compressed request body, read decompressed as
+    it arrives. More than `limit` bytes of output (None: no limit) raise
+    RequestEntityTooLarge, so that a small body cannot expand without bound;
+    a body that is not valid raises BadRequest.
+    """
+
+    def __init__(self, stream, limit=None):
+        self._stream = stream
+        self._limit = limit
+        self._size = 0
+        # 32 + MAX_WBITS accepts both gzip and zlib headers.
+        self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            data = self._read(len(b))
+        except zlib.error as e:
+            raise BadRequest(f"Invalid compressed request body: {e}")
+        self._size += len(data)
+        if self._limit is not None and self._size > self._limit:
+            raise RequestEntityTooLarge()
+        b[:len(data)] = data
+        return len(data)
+
+    def _read(self, size):
+        # Never more output than the caller asked for, whatever the input:
+        # what is left of the input waits in the unconsumed tail.
+        decompressor = self._decompressor
+        while not self._finished:
+            if decompressor.unconsumed_tail:
+                data = decompressor.decompress(decompressor.unconsumed_tail, size)
+            else:
+                chunk = self._stream.read(READ_SIZE)
+                if not chunk:
+                    self._finished = True
+                    if not decompressor.eof:
+                        raise BadRequest("Truncated compressed request body")
+                    break
+                data = decompressor.decompress(chunk, size)
+            if data:
+                return data
+        return b''
@@ -0,0 +1,506 @@
+import asyncio
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from contextlib import contextmanager
+
+from instrumentation import record_memo
+
+
+def cache_key(wikitext, version):
+    """
+    Content address of a conversion: a hash of the converter version and of
+    the input with its line endings normalized the way the converter does.
+    """
+    normalized = wikitext.replace('\r\n', '\n').replace('\r', '\n')
+    digest = hashlib.sha256(version.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(normalized.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def _entry_size(key, value):
+    return len(key) + len(value.encode('utf-8', 'surrogatepass'))
+
+
+class DiskTier:
+    """
+    SQLite store for cached conversions that survives restarts and that every
+    worker process of a host can share: a conversion stored by one worker is
+    a hit for all the others. Values are stored compressed, and the store is
+    bounded to `max_bytes` of keys and compressed values; the least recently
+    used entries are removed first. Entries written by another converter
+    version are dropped when the store is opened.
+
+    The database is in WAL mode, so readers do not block the writer nor each
+    other, and every write runs in a transaction that keeps the size total
+    exact whichever process writes. The access time of an entry is only
+    rewritten once it is `access_resolution` seconds old, so that reads
+    rarely write. A store locked by another process for more than `timeout`
+    seconds is skipped (a miss, or a put that does not happen) and counted in
+    `errors`.
+    """
+
+    def __init__(self, path, version, max_bytes, access_resolution=60.0, timeout=10.0):
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+        self.access_resolution = access_resolution
+        self.timeout = timeout
+        self.evictions = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._pid = os.getpid()
+        self._inherited = []
+        with self._transaction():
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversions ("
+                " key TEXT PRIMARY KEY, version TEXT NOT NULL, value BLOB NOT NULL,"
+                " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS conversions_lru ON conversions (last_access)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._conn.execute("DELETE FROM conversions WHERE version != ?", (version,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO totals (name, value)"
+                " SELECT 'bytes', COALESCE(SUM(size), 0) FROM conversions"
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connection(self):
+        # A connection cannot be used across a fork: a worker forked from the
+        # process that opened the store opens its own, and keeps the inherited
+        # one unused rather than closing it under the parent.
+        if self._pid != os.getpid():
+            self._inherited.append(self._conn)
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front: a transaction that
+        # starts reading and then writes could fail on a concurrent writer.
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, key):
+        row = None
+        with self._lock:
+            try:
+                conn = self._connection()
+                row = conn.execute("SELECT value, last_access FROM conversions WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                now = time.time()
+                if now - row[1] >= self.access_resolution:
+                    conn.execute("UPDATE conversions SET last_access = ? WHERE key = ?", (now, key))
+            except sqlite3.OperationalError:
+                self.errors += 1
+                if row is None:
+                    return None
+        return _decompress(row[0])
+
+    def put(self, key, value):
+        data = zlib.compress(value.encode('utf-8', 'surrogatepass'))
+        size = len(key) + len(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                with self._transaction() as conn:
+                    old = conn.execute("SELECT size FROM conversions WHERE key = ?", (key,)).fetchone()
+                    conn.execute(
+                        "INSERT OR REPLACE INTO conversions (key, version, value, size, last_access)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (key, self.version, data, size, time.time()),
+                    )
+                    total = self._total(conn) + size - (old[0] if old else 0)
+                    while total > self.max_bytes:
+                        oldest = conn.execute(
+                            "SELECT key, size FROM conversions ORDER BY last_access LIMIT 1"
+                        ).fetchone()
+                        conn.execute("DELETE FROM conversions WHERE key = ?", (oldest[0],))
+                        total -= oldest[1]
+                        self.evictions += 1
+                    conn.execute("UPDATE totals SET value = ? WHERE name = 'bytes'", (total,))
+            except sqlite3.OperationalError:
+                self.errors += 1
+
+    @staticmethod
+    def _total(conn):
+        return conn.execute("SELECT value FROM totals WHERE name = 'bytes'").fetchone()[0]
+
+    @property
+    def bytes(self):
+        """Size of the store, written by every process sharing it."""
+        with self._lock:
+            return self._total(self._connection())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _decompress(value):
+    # Stores written before values were compressed hold text.
+    if isinstance(value, str):
+        return value
+    return zlib.decompress(value).decode('utf-8', 'surrogatepass')
+
+
+class ConversionCache:
+    """
+    Cache of conversion results keyed by `cache_key`.
+
+    The memory tier is an LRU bounded to `max_bytes` (keys plus UTF-8 encoded
+    values). With `disk_path`, entries also go to a `DiskTier`, which is
+    consulted on memory misses and can be shared by the worker processes of a
+    host. Changing `version` makes every older entry unreachable, and the
+    disk tier deletes them.
+    """
+
+    def __init__(self, version, max_bytes=64 * 1024 * 1024, disk_path=None, disk_max_bytes=512 * 1024 * 1024):
+        self.version = version
+        self.max_bytes = max_bytes
+        self.disk = DiskTier(disk_path, version, disk_max_bytes) if disk_path else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, wikitext):
+        return cache_key(wikitext, self.version)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(key, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def _remember(self, key, value):
+        size = _entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def get_or_convert(self, wikitext, convert, flights=None):
+        """
+        Returns the cached conversion of `wikitext`, or converts it with
+        `convert` and caches it. With `flights`, a SingleFlight, concurrent
+        misses for the same text share one conversion.
+        """
+        key = self.key(wikitext)
+        value = self.get(key)
+        if value is None:
+            if flights is None:
+                value = self._convert(key, wikitext, convert)
+            else:
+                value = flights.do(key, self._convert, key, wikitext, convert)
+        return value
+
+    def _convert(self, key, wikitext, convert):
+        value = convert(wikitext)
+        self.put(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'version': self.version,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+        if self.disk is not None:
+            stats['disk_bytes'] = self.disk.bytes
+            stats['disk_max_bytes'] = self.disk.max_bytes
+            stats['disk_evictions'] = self.disk.evictions
+            stats['disk_errors'] = self.disk.errors
+        return stats
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, from threads (`do`) and
+    coroutines (`do_async`) alike: the first caller runs the call, and those
+    arriving while it runs wait for it and share its result or exception.
+    If the coroutine running a call is cancelled, one of the callers waiting
+    runs it instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future of the call in flight
+        self.calls = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        # Returns (future of the call in flight, whether the caller runs it)
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.calls += 1
+            return future, True
+
+    def _land(self, key, future, value=None, error=None, cancelled=False):
+        # Later callers start a new call, rather than join this one.
+        with self._lock:
+            del self._calls[key]
+        if cancelled:
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def do(self, key, func, *args):
+        """Returns func(*args), or the result of the call in flight for `key`."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return future.result()
+            except CancelledError:
+                pass  # The coroutine running it was cancelled: run it here
+        try:
+            value = func(*args)
+        except BaseException as e:
+            self._land(key, future, error=e)
+            raise
+        self._land(key, future, value)
+        return value
+
+    async def do_async(self, key, func, *args):
+        """Like `do`, for a coroutine function `func`."""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                # Only the cancellation of the call in flight is retried.
+                if not future.cancelled():
+                    raise
+        try:
+            value = await func(*args)
+        except asyncio.CancelledError:
+            self._land(key, future, cancelled=True)
+            raise
+        except BaseException as e:
+            self._land(key, future, error=e)
+            raise
+        self._land(key, future, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls), 'calls': self.calls, 'coalesced': self.coalesced}
+
+
+# Stands for the <tvar> number while a memoized handler runs; fragments that
+# contain it are not memoized.
+TVAR_PLACEHOLDER = '\0tvar\0'
+
+
+class FragmentMemo:
+    """
+    LRU of handler results for fragments of wikitext (a link, a template),
+    keyed on the handler and the text of the fragment, bounded to
+    `max_entries` fragments of at most `max_fragment` characters. It lives in
+    the process converting, so every worker of a pool has its own.
+
+    Handlers numbering a <tvar> are run with `TVAR_PLACEHOLDER` as the number
+    and their output is stored split around it, so a repeated fragment costs
+    a lookup and a join whatever its number.
+    """
+
+    def __init__(self, max_entries=4096, max_fragment=2048):
+        self.max_entries = max_entries
+        self.max_fragment = max_fragment
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        record_memo(key[0], entry is not None)
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def memoize(self, numbered=False):
+        """
+        Decorator memoizing a handler taking the text of a fragment and, if
+        `numbered`, the number of its <tvar>. The handler must only depend on
+        these arguments and return a string or a tuple starting with one.
+        """
+        def decorator(func):
+            if self.max_entries <= 0:
+                return func
+            name = func.__name__
+
+            @functools.wraps(func)
+            def wrapper(text, *args):
+                if len(text) > self.max_fragment or (numbered and TVAR_PLACEHOLDER in text):
+                    return func(text, *args)
+                key = (name, text)
+                entry = self.get(key)
+                if entry is None:
+                    result = func(text, TVAR_PLACEHOLDER) if numbered else func(text)
+                    if type(result) is tuple:
+                        entry = (result[0].split(TVAR_PLACEHOLDER), result[1:])
+                    else:
+                        entry = (result.split(TVAR_PLACEHOLDER), None)
+                    self.put(key, entry)
+                pieces, rest = entry
+                output = str(args[0] if args else 0).join(pieces) if len(pieces) > 1 else pieces[0]
+                return output if rest is None else (output,) + rest
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class DocumentStore:
+    """
+    LRU of the documents converted incrementally, by document key, bounded to
+    `max_bytes` (as given to `put` for every document). A document is taken
+    out while a new version of it is converted, so that two conversions of
+    the same key never share it.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.chars = 0
+        self.reused_chars = 0
+
+    def take(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes -= entry[1]
+            return entry[0]
+
+    def put(self, key, document, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (document, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def count(self, chars, reused_chars):
+        """Counts a conversion of `chars` characters, `reused_chars` of which were reused."""
+        with self._lock:
+            self.chars += chars
+            self.reused_chars += reused_chars
+
+    def stats(self):
+        with self._lock:
+            return {
+                'documents': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'chars': self.chars,
+                'reused_chars': self.reused_chars,
+            }
@@ -0,0 +1,349 @@
+import argparse
+import bz2
+import gzip
+import json
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape
+
+from app import conversion_budget, convert_to_translatable_wikitext
+from engine import ConversionEngine
+
+EXPORT_NAMESPACE = 'http://www.mediawiki.org/xml/export-0.11/'
+# Fields of a page that are copied to an output dump, in order.
+REVISION_FIELDS = ('id', 'timestamp', 'model', 'format')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _open_input(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_pages(source):
+    """
+    Yields a dict per <page> of a MediaWiki XML export, read incrementally:
+    "title", "ns", "id" and the "text" of its last revision, plus that
+    revision's "revision" fields (id, timestamp, model, format). Every page
+    is discarded once yielded, so the dump is never held in memory.
+    """
+    root = None
+    page = None
+    revision = None
+    depth = 0
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        name = _local_name(element.tag)
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = element
+            elif name == 'page':
+                page = {'title': '', 'ns': 0, 'id': None, 'text': '', 'revision': {}}
+            elif name == 'revision' and page is not None:
+                revision = {}
+            continue
+        depth -= 1
+        if page is None:
+            continue
+        if name == 'page':
+            yield page
+            page = None
+            root.clear()
+        elif name == 'revision':
+            page['revision'] = revision
+            revision = None
+        elif revision is not None:
+            if name == 'text':
+                page['text'] = element.text or ''
+            elif name in REVISION_FIELDS and depth == 3:
+                revision[name] = element.text
+        elif name == 'title':
+            page['title'] = element.text or ''
+        elif name == 'ns':
+            page['ns'] = int(element.text or 0)
+        elif name == 'id':
+            page['id'] = int(element.text) if element.text else None
+
+
+def convert_page(text):
+    # Runs in a worker: the same hardened conversion as the web service.
+    return convert_to_translatable_wikitext(text, budget=conversion_budget(len(text)))
+
+# --- Output ---
+
+
+class JsonlWriter:
+    """One JSON object per page: the page fields and "converted" or "error"."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def header(self):
+        pass
+
+    def page(self, page, converted, error):
+        record = {'title': page['title'], 'ns': page['ns'], 'id': page['id']}
+        if page['revision'].get('id') is not None:
+            record['revision_id'] = int(page['revision']['id'])
+        if error is None:
+            record['converted'] = converted
+        else:
+            record['error'] = error
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def footer(self):
+        pass
+
+
+class XmlWriter:
+    """
+    A MediaWiki export with the converted text of every page, which can be
+    imported with Special:Import. Pages that failed to convert are left out.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def header(self):
+        self.f.write(f'<mediawiki xmlns="{EXPORT_NAMESPACE}" version="0.11" xml:lang="en">\n')
+
+    def page(self, page, converted, error):
+        if error is not None:
+            return
+        lines = [
+            '  <page>',
+            f'    <title>{escape(page["title"])}</title>',
+            f'    <ns>{page["ns"]}</ns>',
+        ]
+        if page['id'] is not None:
+            lines.append(f'    <id>{page["id"]}</id>')
+        lines.append('    <revision>')
+        for field in REVISION_FIELDS:
+            value = page['revision'].get(field)
+            if value is not None:
+                lines.append(f'      <{field}>{escape(value)}</{field}>')
+        lines.append(f'      <text xml:space="preserve">{escape(converted)}</text>')
+        lines.append('    </revision>')
+        lines.append('  </page>\n')
+        self.f.write('\n'.join(lines))
+
+    def footer(self):
+        self.f.write('</mediawiki>\n')
+
+
+WRITERS = {'jsonl': JsonlWriter, 'xml': XmlWriter}
+
+# --- Checkpoints ---
+# A checkpoint records how many input pages are fully written and the size of
+# the output at that point. Resuming truncates the output back to that size
+# and skips that many pages of the input.
+
+
+def checkpoint_path(output):
+    return output + '.checkpoint'
+
+
+def read_checkpoint(output):
+    try:
+        with open(checkpoint_path(output), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(output, state):
+    path = checkpoint_path(output)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+# --- Conversion ---
+
+
+class Progress:
+
+    def __init__(self, stream=sys.stderr, interval=10.0):
+        self.stream = stream
+        self.interval = interval
+        self.started = self.last_report = time.monotonic()
+        self.pages = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def add(self, text, error):
+        self.pages += 1
+        self.failed += error is not None
+        self.bytes += len(text.encode('utf-8', 'surrogatepass'))
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started, 1e-9)
+        print(
+            f"{self.pages} pages ({self.failed} failed), {self.pages / elapsed:.1f} pages/s, "
+            f"{self.bytes / elapsed / 1e6:.2f} MB/s",
+            file=self.stream,
+        )
+
+
+def _batches(pages, namespaces, skip, size):
+    # Yields lists of (position in the input, page); the first `skip` pages of
+    # the input, and pages outside `namespaces`, are not converted.
+    batch = []
+    for position, page in enumerate(pages):
+        if position < skip or (namespaces and page['ns'] not in namespaces):
+            continue
+        batch.append((position, page))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _submit(engine, texts):
+    if engine.workers == 0:
+        future = Future()
+        future.set_result(engine.convert_many(texts))
+        return future
+    return engine.submit(texts)[1]
+
+
+def _output_size(out):
+    # The size in bytes of the text file `out`, once written out: the
+    # position of a text file is an opaque cookie, not a byte offset.
+    out.flush()
+    return out.buffer.tell()
+
+
+def _results(engine, texts, future):
+    try:
+        return future.result()
+    except (BrokenProcessPool, CancelledError):
+        # A worker died: convert_many replaces the pool and retries.
+        return engine.convert_many(texts)
+
+
+def convert_dump(input_path, output_path, output_format='jsonl', namespaces=None, workers=None,
+                 batch_size=16, checkpoint_every=60.0, restart=False, progress=None):
+    """
+    Converts the pages of the XML export at `input_path` into `output_path`
+    and returns the Progress. Pages go to the pool in batches of
+    `batch_size`, and results are written in the order of the input.
+    Resumes from the last checkpoint of `output_path` unless `restart` is set.
+    """
+    engine = ConversionEngine(convert_page, workers=workers)
+    # Two batches per worker keep every worker busy while results are written.
+    window = max(1, engine.workers) * 2
+    progress = progress or Progress()
+    writer_class = WRITERS[output_format]
+
+    state = None if restart else read_checkpoint(output_path)
+    if state is not None and (state.get('input') != os.path.abspath(input_path) or state.get('format') != output_format):
+        raise SystemExit(f"{checkpoint_path(output_path)} belongs to another conversion; use --restart")
+    if state is None:
+        state = {'input': os.path.abspath(input_path), 'format': output_format, 'pages': 0, 'offset': 0}
+        out = open(output_path, 'w', encoding='utf-8', newline='\n')
+        writer = writer_class(out)
+        writer.header()
+    else:
+        print(f"Resuming after {state['pages']} pages", file=progress.stream)
+        # The offset is in bytes: the output is cut in binary mode.
+        with open(output_path, 'r+b') as f:
+            f.truncate(state['offset'])
+        out = open(output_path, 'a', encoding='utf-8', newline='\n')
+        writer = writer_class(out)
+    # Input pages and output size after the last batch written in full
+    completed = (state['pages'], _output_size(out))
+
+    def checkpoint():
+        out.flush()
+        os.fsync(out.fileno())
+        state['pages'], state['offset'] = completed
+        write_checkpoint(output_path, state)
+
+    in_flight = deque()
+
+    def write_oldest():
+        nonlocal completed
+        batch, texts, future = in_flight.popleft()
+        for (_, page), (converted, error) in zip(batch, _results(engine, texts, future)):
+            writer.page(page, converted, error)
+            progress.add(page['text'], error)
+            if error is not None:
+                print(f"{page['title']}: {error}", file=progress.stream)
+        completed = (batch[-1][0] + 1, _output_size(out))
+
+    last_checkpoint = time.monotonic()
+    try:
+        with _open_input(input_path) as source:
+            for batch in _batches(iter_pages(source), namespaces, state['pages'], batch_size):
+                texts = [page['text'] for _, page in batch]
+                in_flight.append((batch, texts, _submit(engine, texts)))
+                if len(in_flight) < window:
+                    continue
+                write_oldest()
+                progress.report()
+                if time.monotonic() - last_checkpoint >= checkpoint_every:
+                    checkpoint()
+                    last_checkpoint = time.monotonic()
+        while in_flight:
+            write_oldest()
+    except KeyboardInterrupt:
+        # Keep the batches written in full; the others are redone.
+        checkpoint()
+        raise
+    finally:
+        engine.shutdown(wait=False)
+
+    writer.footer()
+    out.close()
+    try:
+        os.remove(checkpoint_path(output_path))
+    except FileNotFoundError:
+        pass
+    progress.report(force=True)
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Converts the pages of a MediaWiki XML export (optionally .bz2 or .gz) to translatable wikitext.")
+    parser.add_argument('input', help="XML export (Special:Export or a dump)")
+    parser.add_argument('output', help="output file, resumed if it has a checkpoint")
+    parser.add_argument('--format', choices=sorted(WRITERS), help="output format (default: from the output extension, else jsonl)")
+    parser.add_argument('--namespace', type=int, action='append', help="only convert pages of this namespace (repeatable)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: number of CPUs; 0 converts inline)")
+    parser.add_argument('--batch-size', type=int, default=16, help="pages sent to a worker at once")
+    parser.add_argument('--checkpoint-every', type=float, default=60.0, help="seconds between checkpoints")
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint and start over")
+    args = parser.parse_args(argv)
+
+    output_format = args.format or ('xml' if args.output.endswith('.xml') else 'jsonl')
+    try:
+        convert_dump(
+            args.input, args.output, output_format, namespaces=set(args.namespace or ()),
+            workers=args.workers, batch_size=args.batch_size, checkpoint_every=args.checkpoint_every,
+            restart=args.restart,
+        )
+    except KeyboardInterrupt:
+        print(f"Interrupted; run again to resume from {checkpoint_path(args.output)}", file=sys.stderr)
+        return 130
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+import asyncio
+import math
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ConversionError(Exception):
+    """
+    Raised by `ConversionEngine.convert` when a conversion fails.
+    """
+
+
+class ConversionTimeout(ConversionError):
+    """
+    Raised by `ConversionEngine.convert` when a conversion takes longer than
+    the engine's task timeout.
+    """
+
+
+class ConversionAborted(ConversionError):
+    """
+    Raised by a hardened conversion that gives up on its input instead of
+    hanging or crashing: `reason` is "deadline" or "steps" when it ran out of
+    its budget, "malformed", "nesting" or "no_progress" when the input cannot
+    be converted.
+    """
+
+    def __init__(self, reason, detail=''):
+        super().__init__(f"Conversion aborted ({reason}): {detail}" if detail else f"Conversion aborted ({reason})")
+        self.reason = reason
+        self.detail = detail
+
+    def __reduce__(self):
+        return type(self), (self.reason, self.detail)
+
+    @classmethod
+    def from_message(cls, message):
+        match = _aborted_message.match(message)
+        return cls(match.group(1), match.group(2) or '') if match else None
+
+
+_aborted_message = re.compile(r'Conversion aborted \((\w+)\)(?:: (.*))?\Z', re.DOTALL)
+
+
+class ConversionBudget:
+    """
+    Limits on the work of one conversion: at most `steps` scanner steps and
+    `seconds` of wall-clock time from its creation. `step` raises
+    ConversionAborted once either is used up; the clock is only read every
+    `check_interval` steps.
+    """
+
+    def __init__(self, seconds=None, steps=None, clock=time.monotonic, check_interval=256):
+        self.seconds = seconds
+        self.steps = steps
+        self.used = 0
+        self.clock = clock
+        self.check_interval = check_interval
+        self.deadline = None if seconds is None else clock() + seconds
+        self._next_check = check_interval
+
+    def step(self, count=1):
+        self.used += count
+        if self.steps is not None and self.used > self.steps:
+            raise ConversionAborted('steps', f"more than {self.steps} steps")
+        if self.deadline is not None and self.used >= self._next_check:
+            self._next_check = self.used + self.check_interval
+            if self.clock() > self.deadline:
+                raise ConversionAborted('deadline', f"more than {self.seconds:g} seconds")
+
+
+def gil_disabled():
+    """
+    True on a free-threaded Python build running without the GIL, where
+    threads can run conversions in parallel.
+    """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def _run_one(func, text):
+    try:
+        return func(text), None
+    except ConversionAborted as e:
+        return None, str(e)
+    except (Exception, SystemExit) as e:
+        return None, f"Conversion failed: {type(e).__name__}: {e}"
+
+
+def _unwrap(converted, error):
+    if error is None:
+        return converted
+    if error.startswith("Conversion timed out"):
+        raise ConversionTimeout(error)
+    aborted = ConversionAborted.from_message(error)
+    if aborted is not None:
+        raise aborted
+    raise ConversionError(error)
+
+
+def _run_chunk(func, texts):
+    # Runs in a worker: failures are returned, not raised, so that they stay
+    # local to the document that caused them.
+    return [_run_one(func, text) for text in texts]
+
+
+class ConversionEngine:
+    """
+    Runs conversions on a persistent pool of workers so that CPU-bound
+    conversions do not serialize on the GIL of the web server process.
+
+    `func` is the conversion function; it must be importable by the workers
+    (i.e. a module-level function). `workers` defaults to the number of CPUs;
+    with 0 conversions run inline in the calling thread. `kind` is "process",
+    "thread" or "auto" (threads on a free-threaded build, processes otherwise).
+    `timeout` is the per-document time limit in seconds (None for no limit).
+    `start_method` is the multiprocessing start method of worker processes
+    (None for the platform's default).
+
+    A worker that exceeds its time limit cannot be interrupted, so the whole
+    pool is replaced: tasks still running on the old pool are retried once on
+    the new one. A task is also given the time of its share of the texts that
+    were in flight when it was submitted, which it may wait behind: waiting
+    for other requests' tasks does not time it out.
+    """
+
+    def __init__(self, func, workers=None, kind='auto', timeout=None, chunksize=None, start_method=None):
+        self.func = func
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        if kind == 'auto':
+            kind = 'thread' if gil_disabled() else 'process'
+        if kind not in ('process', 'thread'):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self.start_method = start_method
+        self._lock = threading.Lock()
+        self._executor = None
+        self.pool_restarts = 0
+        # Texts submitted to the pool and not done yet
+        self._in_flight = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.kind == 'thread':
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method))
+            return self._executor
+
+    def _restart(self, executor):
+        """
+        Replaces `executor` (unless that already happened) and stops its
+        workers, which may be stuck in a conversion that timed out.
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self.pool_restarts += 1
+        executor.shutdown(wait=False, cancel_futures=True)
+        if isinstance(executor, ProcessPoolExecutor):
+            terminate_workers = getattr(executor, 'terminate_workers', None)
+            if terminate_workers is not None:
+                terminate_workers()
+            else:
+                for process in list((executor._processes or {}).values()):
+                    process.terminate()
+
+    def _chunks(self, texts):
+        chunksize = self.chunksize
+        if chunksize is None:
+            # A few chunks per worker keeps them all busy without paying the
+            # inter-process overhead for every document.
+            chunksize = max(1, len(texts) // (self.workers * 4))
+        return [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+
+    def submit(self, texts):
+        """
+        Submits one chunk of texts. Returns (executor, future, ahead); the
+        future resolves to a list of (converted, error) pairs, and `ahead` is
+        the number of texts in flight before them.
+        """
+        texts = list(texts)
+        executor = self._get_executor()
+        try:
+            future = executor.submit(_run_chunk, self.func, texts)
+        except (BrokenProcessPool, RuntimeError):
+            # The pool broke or was replaced by another thread in between.
+            self._restart(executor)
+            executor = self._get_executor()
+            future = executor.submit(_run_chunk, self.func, texts)
+        with self._lock:
+            ahead = self._in_flight
+            self._in_flight += len(texts)
+        future.add_done_callback(lambda _: self._done(len(texts)))
+        return executor, future, ahead
+
+    def _done(self, size):
+        with self._lock:
+            self._in_flight -= size
+
+    def _time_limit(self, timeout, size, ahead):
+        """
+        Time given to a task of `size` texts submitted behind `ahead` others:
+        each of these is done or timed out within `timeout`, spread over the
+        workers.
+        """
+        if timeout is None:
+            return None
+        return timeout * (size + math.ceil(ahead / self.workers))
+
+    def _collect(self, chunks, timeout):
+        submitted = [self.submit(chunk) for chunk in chunks]
+        results = []
+        for chunk, (executor, future, ahead) in zip(chunks, submitted):
+            try:
+                results.append(future.result(timeout=self._time_limit(timeout, len(chunk), ahead)))
+            except FutureTimeoutError:
+                self._restart(executor)
+                results.append([(None, f"Conversion timed out after {timeout} seconds")] * len(chunk))
+            except (BrokenProcessPool, CancelledError):
+                self._restart(executor)
+                results.append(None)  # Retried below
+        return results
+
+    def convert_many(self, texts, timeout=None):
+        """
+        Converts a list of texts, spread over the pool in chunks.
+        Returns a (converted, error) pair per text, in order.
+        """
+        texts = list(texts)
+        timeout = self.timeout if timeout is None else timeout
+        if self.workers == 0 or not texts:
+            return [_run_one(self.func, text) for text in texts]
+
+        chunks = self._chunks(texts)
+        results = self._collect(chunks, timeout)
+        broken = [i for i, result in enumerate(results) if result is None]
+        if broken:
+            # The pool died under these chunks (a worker crashed or another
+            # task's timeout replaced the pool); give them one more try.
+            retried = self._collect([chunks[i] for i in broken], timeout)
+            for i, result in zip(broken, retried):
+                results[i] = result or [(None, "Conversion failed: worker process died")] * len(chunks[i])
+        return [pair for chunk_results in results for pair in chunk_results]
+
+    def convert(self, text, timeout=None):
+        """
+        Converts a single text and returns the result. Raises ConversionTimeout,
+        ConversionAborted or ConversionError on failure.
+        """
+        [(converted, error)] = self.convert_many([text], timeout=timeout)
+        return _unwrap(converted, error)
+
+    async def convert_async(self, text, timeout=None):
+        """
+        Like `convert`, from a coroutine: the event loop keeps serving other
+        requests while the text is converted. With 0 workers the conversion
+        runs in the loop's default thread pool instead.
+        """
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+        if self.workers == 0:
+            return _unwrap(*await loop.run_in_executor(None, _run_one, self.func, text))
+        for _ in range(2):
+            executor, future, ahead = self.submit([text])
+            try:
+                [(converted, error)] = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)), self._time_limit(timeout, 1, ahead))
+            except asyncio.TimeoutError:
+                self._restart(executor)
+                raise ConversionTimeout(f"Conversion timed out after {timeout} seconds")
+            except asyncio.CancelledError:
+                # The future is shielded, so it is only cancelled when its
+                # pool was replaced: that is retried; the cancellation of the
+                # calling task is passed on.
+                if not future.cancelled():
+                    raise
+                self._restart(executor)
+            except BrokenProcessPool:
+                self._restart(executor)
+            else:
+                return _unwrap(converted, error)
+        raise ConversionError("Conversion failed: worker process died")
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
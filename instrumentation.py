@@ -0,0 +1,275 @@
+import contextvars
+import functools
+import threading
+import time
+from contextlib import nullcontext
+
+# Profile collecting the counters of the current conversion, if any.
+_active_profile = contextvars.ContextVar('profile', default=None)
+_no_phase = nullcontext()
+
+
+class Profile:
+    """
+    Counters of one or more conversions: calls, cumulative seconds and input
+    size (in characters) per handler and per phase.
+
+    Handler times are inclusive: a table's time includes the links in its
+    cells; a handler running within itself (a nested table) only counts as
+    a call. Phase times are exclusive: a phase entered during another one (the
+    cells of a table are tokenized while its handler runs) pauses it, so the
+    phases of a conversion add up to its total time.
+    """
+
+    def __init__(self):
+        self.conversions = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.handlers = {}  # name -> [calls, seconds, bytes]
+        self.phases = {}
+        self.memo = {}  # handler -> [hits, misses] of the fragment memo
+        self.markup = {}  # markup family ("plain" for none) -> fragments it was found in
+        self._stack = []  # [phase, time it was (re)started]
+        self._running = {}  # handler -> number of calls in progress
+
+    @staticmethod
+    def _add(table, name, calls, seconds, size):
+        entry = table.get(name)
+        if entry is None:
+            table[name] = [calls, seconds, size]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] += size
+
+    def start_handler(self, name):
+        depth = self._running.get(name, 0)
+        self._running[name] = depth + 1
+        return depth
+
+    def end_handler(self, name, depth, seconds, size):
+        self._running[name] = depth
+        self._add(self.handlers, name, 1, seconds if depth == 0 else 0.0, size)
+
+    def enter_phase(self, name, size=0):
+        if callable(size):
+            size = size()
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            self._add(self.phases, parent[0], 0, now - parent[1], 0)
+        self._add(self.phases, name, 1, 0.0, size)
+        self._stack.append([name, now])
+
+    def exit_phase(self):
+        now = time.perf_counter()
+        name, started = self._stack.pop()
+        self._add(self.phases, name, 0, now - started, 0)
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def phase(self, name, size=0):
+        return _Phase(self, name, size)
+
+    def add_memo(self, name, hits, misses):
+        entry = self.memo.get(name)
+        if entry is None:
+            self.memo[name] = [hits, misses]
+        else:
+            entry[0] += hits
+            entry[1] += misses
+
+    def merge(self, other):
+        self.conversions += other.conversions
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        for table, other_table in ((self.handlers, other.handlers), (self.phases, other.phases)):
+            for name, (calls, seconds, size) in other_table.items():
+                self._add(table, name, calls, seconds, size)
+        for name, (hits, misses) in other.memo.items():
+            self.add_memo(name, hits, misses)
+        for family, fragments in other.markup.items():
+            self.markup[family] = self.markup.get(family, 0) + fragments
+
+    def as_dict(self):
+        def entries(table):
+            return {
+                name: {'calls': calls, 'seconds': seconds, 'bytes': size}
+                for name, (calls, seconds, size) in sorted(table.items())
+            }
+        return {
+            'conversions': self.conversions,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'phases': entries(self.phases),
+            'handlers': entries(self.handlers),
+            'fragment_memo': {
+                name: {'hits': hits, 'misses': misses} for name, (hits, misses) in sorted(self.memo.items())
+            },
+            'markup': dict(sorted(self.markup.items())),
+        }
+
+    def __getstate__(self):
+        # Profiles travel back from worker processes once they are complete.
+        state = self.__dict__.copy()
+        state['_stack'] = []
+        state['_running'] = {}
+        return state
+
+
+class _Phase:
+
+    def __init__(self, profile, name, size):
+        self.profile = profile
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.profile.enter_phase(self.name, self.size)
+
+    def __exit__(self, *exc_info):
+        self.profile.exit_phase()
+
+
+def phase(name, size=0):
+    """
+    Context manager timing a phase of the current conversion; does nothing
+    when no profile is being collected. `size` is the number of characters
+    the phase processes, or a function returning it, which is only called
+    when profiling.
+    """
+    profile = _active_profile.get()
+    if profile is None:
+        return _no_phase
+    return profile.phase(name, size)
+
+
+def record_memo(name, hit):
+    """
+    Counts a lookup of handler `name` in the fragment memo in the profile of
+    the current conversion, if any.
+    """
+    profile = _active_profile.get()
+    if profile is not None:
+        profile.add_memo(name, 1 if hit else 0, 0 if hit else 1)
+
+
+def record_markup(families):
+    """
+    Counts a fragment classified as containing the markup `families` (none:
+    plain text) in the profile of the current conversion, if any.
+    """
+    profile = _active_profile.get()
+    if profile is not None:
+        for family in families or ('plain',):
+            profile.markup[family] = profile.markup.get(family, 0) + 1
+
+
+def instrumented(func):
+    """
+    Decorator counting the calls, time and input size of a handler in the
+    profile of the current conversion. Without a profile it only costs a
+    context variable lookup.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = _active_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        depth = profile.start_handler(name)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            size = len(args[0]) if args and isinstance(args[0], str) else 0
+            profile.end_handler(name, depth, time.perf_counter() - start, size)
+    return wrapper
+
+
+def run_profiled(func, text, profile=None):
+    """
+    Runs `func(text)` while collecting a profile. Returns (result, profile).
+    """
+    profile = Profile() if profile is None else profile
+    token = _active_profile.set(profile)
+    start = time.perf_counter()
+    try:
+        result = func(text)
+    finally:
+        _active_profile.reset(token)
+        profile.conversions += 1
+        profile.seconds += time.perf_counter() - start
+        profile.bytes += len(text) if isinstance(text, str) else 0
+    return result, profile
+
+
+class Metrics:
+    """
+    Process-wide totals of the profiles added to it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._total = Profile()
+
+    def add(self, profile):
+        with self._lock:
+            self._total.merge(profile)
+
+    def snapshot(self):
+        with self._lock:
+            return self._total.as_dict()
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def profile_samples(snapshot, prefix='translatetagger'):
+    """
+    Turns a `Profile.as_dict()` into (name, type, help, [(labels, value)])
+    metrics for `format_prometheus`.
+    """
+    samples = [
+        (f'{prefix}_profiled_conversions_total', 'counter', 'Conversions that were profiled.',
+         [({}, snapshot['conversions'])]),
+        (f'{prefix}_profiled_conversion_seconds_total', 'counter', 'Time spent in profiled conversions.',
+         [({}, snapshot['seconds'])]),
+        (f'{prefix}_profiled_conversion_bytes_total', 'counter', 'Characters of input of profiled conversions.',
+         [({}, snapshot['bytes'])]),
+    ]
+    for kind, what in (('phase', 'conversion phase (exclusive time)'), ('handler', 'handler (inclusive time)')):
+        entries = snapshot[kind + 's']
+        for field, unit in (('calls', 'Calls of each'), ('seconds', 'Time spent in each'), ('bytes', 'Characters processed by each')):
+            samples.append((
+                f'{prefix}_{kind}_{field}_total', 'counter', f'{unit} {what}.',
+                [({kind: name}, entry[field]) for name, entry in entries.items()],
+            ))
+    memo = snapshot.get('fragment_memo', {})
+    for field, what in (('hits', 'Fragments'), ('misses', 'Fragments not')):
+        samples.append((
+            f'{prefix}_fragment_memo_{field}_total', 'counter', f'{what} found in the fragment memo, per handler.',
+            [({'handler': name}, entry[field]) for name, entry in memo.items()],
+        ))
+    samples.append((
+        f'{prefix}_markup_fragments_total', 'counter', 'Fragments containing each markup family ("plain": none).',
+        [({'family': family}, fragments) for family, fragments in snapshot.get('markup', {}).items()],
+    ))
+    return samples
+
+
+def format_prometheus(samples):
+    """
+    Renders (name, type, help, [(labels, value)]) metrics in the Prometheus
+    text exposition format.
+    """
+    lines = []
+    for name, metric_type, help_text, values in samples:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in values:
+            label_text = ','.join(f'{key}="{_escape_label(val)}"' for key, val in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+    return '\n'.join(lines) + '\n'
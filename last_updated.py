@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+UNAVAILABLE = "Unavailable"
+
+
+def format_commit_date(raw):
+    """
+    Formats an ISO 8601 date ("2025-03-01", "2025-03-01T12:00:00Z" or with an
+    offset) as it is shown in the footer, e.g. "March 1, 2025".
+    Returns None if the value cannot be parsed.
+    """
+    raw = raw.strip()
+    if raw.endswith('Z'):
+        raw = raw[:-1] + '+00:00'
+    try:
+        dt = datetime.fromisoformat(raw)
+    except ValueError:
+        return None
+    return f"{dt:%B} {dt.day}, {dt.year}"
+
+
+def read_static_date(env=None):
+    """
+    Returns the date provided by the deployment, if any: either the
+    LAST_UPDATED environment variable or the file named by LAST_UPDATED_FILE
+    (default: last_updated.txt next to this module), holding an ISO date such
+    as the output of `git log -1 --format=%cI`.
+    """
+    env = os.environ if env is None else env
+    if env.get('LAST_UPDATED'):
+        return format_commit_date(env['LAST_UPDATED'])
+    path = env.get('LAST_UPDATED_FILE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'last_updated.txt')
+    try:
+        with open(path, encoding='utf-8') as f:
+            return format_commit_date(f.read())
+    except OSError:
+        return None
+
+
+class LastUpdatedCache:
+    """
+    Process-wide cache for the "last updated" date shown in the footer.
+
+    A fresh value is served straight from memory. Once it is older than `ttl`
+    seconds the stale value is still served while a background thread fetches
+    a new one (stale-while-revalidate). Only the very first lookup waits for
+    the network. Failed fetches keep the previous value; if there is none,
+    "Unavailable" is cached for `failure_ttl` seconds so that a rate-limited
+    API is not hit on every request.
+
+    `fetch` returns the formatted date or None on failure. `static_value`, when
+    given, is served as is and `fetch` is never called.
+    """
+
+    def __init__(self, fetch, ttl=3600, failure_ttl=300, static_value=None, clock=time.monotonic):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.static_value = static_value
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._value = None
+        self._expires = 0.0
+        self._refreshing = False
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.refresh_seconds_total = 0.0
+        self.last_refresh_seconds = None
+
+    def get(self, wait=True):
+        """
+        Returns the date. Only the first lookup has to wait for the network;
+        with `wait` false it returns None instead.
+        """
+        if self.static_value is not None:
+            with self._lock:
+                self.hits += 1
+            return self.static_value
+
+        with self._lock:
+            if self._value is not None:
+                if self.clock() < self._expires:
+                    self.hits += 1
+                    return self._value
+                self.stale_hits += 1
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, daemon=True).start()
+                return self._value
+            if not wait:
+                return None
+            self.misses += 1
+
+        # Nothing cached yet: this lookup has to wait for the network, but
+        # concurrent first lookups share a single fetch.
+        with self._fetch_lock:
+            with self._lock:
+                if self._value is not None:
+                    return self._value
+            self._refresh()
+        with self._lock:
+            return self._value
+
+    def _refresh(self):
+        start = self.clock()
+        try:
+            value = self.fetch()
+        except Exception:
+            value = None
+        elapsed = self.clock() - start
+        with self._lock:
+            self.refreshes += 1
+            self.refresh_seconds_total += elapsed
+            self.last_refresh_seconds = elapsed
+            now = self.clock()
+            if value is not None:
+                self._value = value
+                self._expires = now + self.ttl
+            else:
+                self.refresh_failures += 1
+                if self._value is None:
+                    self._value = UNAVAILABLE
+                self._expires = now + self.failure_ttl
+            self._refreshing = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'refresh_seconds_total': self.refresh_seconds_total,
+                'last_refresh_seconds': self.last_refresh_seconds,
+            }
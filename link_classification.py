@@ -0,0 +1,98 @@
+import json
+import os
+from enum import Enum
+
+
+class LinkKind(Enum):
+    plain = 1          # No namespace: an article in the main namespace
+    category = 2
+    file = 3
+    special = 4
+    kept = 5           # Links left exactly as they are (user pages)
+    interlanguage = 6
+    internal = 7       # Another namespace of this wiki
+    interwiki = 8      # An unknown prefix: a link to another wiki
+
+
+# Namespace names and aliases of a default MediaWiki installation, by kind.
+DEFAULT_NAMESPACES = {
+    'internal': [
+        'Talk', 'User', 'User talk', 'Project', 'Project talk', 'File', 'File talk',
+        'MediaWiki', 'MediaWiki talk', 'Template', 'Template talk', 'Help', 'Help talk',
+        'Category', 'Category talk', 'Special', 'Media', 'Image', 'Image talk', 'Cat',
+    ],
+    'kept': ['User', 'User talk'],
+    'special': ['Special'],
+    'file': ['File', 'Image'],
+    'category': ['Category', 'Cat'],
+}
+
+DEFAULT_INTERLANGUAGE = [
+    'en', 'fr', 'de', 'es', 'it', 'pt', 'nl', 'pl', 'ru', 'ja', 'zh', 'ar', 'hi', 'bn', 'ta',
+    'te', 'ml', 'kn', 'mr', 'gu', 'pa', 'or', 'as', 'ur', 'fa', 'he', 'ko', 'vi', 'th', 'id',
+    'ms', 'tr', 'uk', 'cs', 'sv', 'fi', 'da', 'no', 'nb', 'nn', 'el', 'hu', 'ro', 'bg', 'sr',
+    'hr', 'sk', 'sl', 'et', 'lv', 'lt', 'ca', 'eu', 'gl', 'ga', 'cy', 'is', 'sq', 'simple',
+]
+
+# When a name is listed under several kinds, the later kind wins.
+_PRECEDENCE = ('internal', 'interlanguage', 'kept', 'special', 'file', 'category')
+
+
+def fold_namespace(name):
+    """
+    Normalizes a namespace or interwiki prefix the way MediaWiki compares
+    them: case-insensitively, with underscores standing for spaces.
+    """
+    return name.replace('_', ' ').strip().casefold()
+
+
+class LinkClassifier:
+    """
+    Classifies link targets by their namespace prefix with a single lookup in
+    a table of case-folded names, built once.
+
+    `namespaces` maps kinds ("internal", "kept", "special", "file",
+    "category") to lists of names and `interlanguage` lists language
+    prefixes; both are added to the defaults.
+    """
+
+    def __init__(self, namespaces=None, interlanguage=None):
+        names = {kind: list(values) for kind, values in DEFAULT_NAMESPACES.items()}
+        names['interlanguage'] = list(DEFAULT_INTERLANGUAGE)
+        for kind, values in (namespaces or {}).items():
+            if kind not in names or kind == 'interlanguage':
+                raise ValueError(f"Unknown namespace kind: {kind}")
+            names[kind].extend(values)
+        names['interlanguage'].extend(interlanguage or ())
+
+        self.table = {}
+        for kind in _PRECEDENCE:
+            for name in names[kind]:
+                self.table[fold_namespace(name)] = LinkKind[kind]
+
+    def classify(self, target):
+        colon = target.find(':')
+        if colon == -1:
+            return LinkKind.plain
+        return self.table.get(fold_namespace(target[:colon]), LinkKind.interwiki)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Reads a JSON file such as
+        {"namespaces": {"file": ["Datei"], "category": ["Kategorie"]},
+         "interlanguage": ["als", "bar"]}.
+        """
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        return cls(config.get('namespaces'), config.get('interlanguage'))
+
+
+def load_link_classifier(env=None):
+    """
+    Returns the classifier for this deployment: the defaults, plus the names
+    from the JSON file named by the WIKI_CONFIG environment variable, if set.
+    """
+    env = os.environ if env is None else env
+    path = env.get('WIKI_CONFIG')
+    return LinkClassifier.from_file(path) if path else LinkClassifier()
@@ -0,0 +1,68 @@
+import hashlib
+import threading
+
+from flask import Response
+
+from compression import ENCODINGS, compress, negotiate
+
+
+class PrerenderedPage:
+    """
+    A response rendered once and kept with its compressed variants, served
+    with a strong ETag per variant and `Cache-Control: public, max-age`.
+    """
+
+    def __init__(self, body, max_age, content_type='text/html; charset=utf-8'):
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.max_age = max_age
+        self.content_type = content_type
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': body}
+        for encoding in ENCODINGS:
+            self.variants[encoding] = compress(body, encoding, level=11)
+        self.etags = {
+            encoding: digest if encoding == 'identity' else f'{digest}-{encoding}' for encoding in self.variants
+        }
+
+    def respond(self, request):
+        """The response to `request`: 304 when the client has the variant already."""
+        encoding = negotiate(request.accept_encodings)
+        response = Response(status=200, content_type=self.content_type)
+        response.set_etag(self.etags[encoding])
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.vary.add('Accept-Encoding')
+        if request.if_none_match.contains(self.etags[encoding]) or request.if_none_match.star_tag:
+            response.status_code = 304
+            return response
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.set_data(self.variants[encoding])
+        return response
+
+
+class PrerenderedPages:
+    """
+    Pages rendered once per process, by name. A page depending on a value
+    that changes now and then (a date) is rendered again when `version`
+    changes; only the latest version of each page is kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}  # name -> (version, PrerenderedPage)
+        self.renders = 0
+
+    def get(self, name, render, max_age, version=None):
+        entry = self._pages.get(name)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        page = PrerenderedPage(render(), max_age)
+        with self._lock:
+            self._pages[name] = (version, page)
+            self.renders += 1
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
@@ -1,5 +1,42 @@
+import asyncio
+import concurrent.futures
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from app import convert_to_translatable_wikitext, process_double_brackets
+import zlib
+from unittest import mock
+from admission import AdmissionControl, Overloaded
+import app as app_module
+import asgi
+import benchmark
+import convert_dump
+from app import (
+    Container, app, classify_markup, convert_incremental, convert_to_translatable_wikitext, iter_convert,
+    process_double_brackets, process_template, tokenizers,
+)
+from compression import DecompressingStream
+from conversion_cache import ConversionCache, FragmentMemo, SingleFlight, TVAR_PLACEHOLDER, cache_key
+from engine import ConversionAborted, ConversionBudget, ConversionEngine, ConversionError, ConversionTimeout
+from instrumentation import Profile, instrumented, run_profiled
+from last_updated import LastUpdatedCache, format_commit_date, read_static_date
+from link_classification import LinkClassifier, LinkKind, load_link_classifier
+from prerendered import PrerenderedPages
+
+def _delayed_upper(text):
+    time.sleep(0.3)
+    return text.upper()
+
+def _slow_upper(text):
+    if text == 'slow':
+        time.sleep(10)
+    if text == 'fail':
+        raise ValueError('bad input')
+    return text.upper()
 
 class TestTranslatableWikitext(unittest.TestCase):
 
@@ -271,5 +308,1318 @@ class TestTranslatableWikitext(unittest.TestCase):
         ),
         "<translate>[[<tvar name=0>m:Special:MyLanguage/Main Page</tvar>|Main Page]]</translate>"
     )
+
+class TestTokenizers(unittest.TestCase):
+
+    samples = [
+        "== Example ==\n\nlorem ipsum\n\n=== Second example ===\n\nlorem ipsum",
+        "E=mc<sup>2</sup> text == not a heading",
+        "Hello world! [[Link]] {{Template}} [https://meta.wikimedia.org/wiki/Main_Page Home] http://example.org end",
+        "* Item 1\n** Sub-item 1.1\n# Num\n;Term\n:Definition",
+        "<div class=\"a\"><div>Nested [[x]]</div>\n* item</div><center><big>Big</big></center>",
+        "{|\n| cell [[q]]\n|-\n! head\n|}<code>x</code><math>y</math><small>s</small>",
+        "__NOTOC____TOC__[[skipped]] __NOINDEX__ text<br />more<br/>end<br>",
+        "<translate>Already [[done]]</translate><languages/><nowiki>[[raw]]</nowiki>",
+        "[[File:a.png|thumb|left|Caption]] [[File:smiley.png|alt=🙂]] [[Category:Foo]]",
+    ]
+
+    def test_dispatch_matches_reference_parts(self):
+        for sample in self.samples:
+            text = '\n' + sample
+            self.assertEqual(tokenizers['dispatch'](text), tokenizers['reference'](text), sample)
+
+    def test_markup_classification(self):
+        self.assertEqual(classify_markup("Plain prose, a = b < c, no {braces} or [brackets]."), frozenset())
+        self.assertEqual(classify_markup("<translate>Already</translate> E=mc"), {'translate'})
+        self.assertEqual(
+            classify_markup("== H ==\n* [[a]] [http://b c] {{T}} {|\n|}<br>__TOC__"),
+            {'heading', 'list', 'link', 'external_link', 'raw_url', 'template', 'table', 'tag', 'behaviour_switch'},
+        )
+
+    def test_family_scanners_match_reference_parts(self):
+        for sample in self.samples:
+            text = '\n' + sample
+            token = app_module._active_scanner.set(app_module._family_scanner(classify_markup(text)))
+            try:
+                self.assertEqual(tokenizers['dispatch'](text), tokenizers['reference'](text), sample)
+            finally:
+                app_module._active_scanner.reset(token)
+
+    def test_containers_are_scanned_into_a_tree(self):
+        [(node, _)] = tokenizers['dispatch']('<div>a [[b]]</div>')
+        self.assertIsInstance(node, Container)
+        self.assertEqual((node.prefix, node.suffix), ('<div>', '</div>'))
+        self.assertEqual([part for part, _ in node.children], ['a ', '[[b]]'])
+
+    def test_nested_containers(self):
+        self.assertEqual(
+            convert_to_translatable_wikitext('<div class="a">\n<center>Hi [[b]]</center>\n* one [[c]]\n</div>'),
+            '<div class="a">\n<center><translate>Hi [[<tvar name="1">Special:MyLanguage/B</tvar>|b]]</translate></center>\n'
+            '* <translate>one [[<tvar name="1">Special:MyLanguage/C</tvar>|c]]</translate>\n</div>'
+        )
+
+    def test_dispatch_matches_reference_output(self):
+        for sample in self.samples:
+            self.assertEqual(
+                convert_to_translatable_wikitext(sample, tokenizer='dispatch'),
+                convert_to_translatable_wikitext(sample, tokenizer='reference'),
+            )
+
+class TestOutputWriting(unittest.TestCase):
+
+    def test_wrap_keeps_surrounding_whitespace(self):
+        self.assertEqual(app_module._wrap_in_translate(" \n\tHello world\r\n "), " \n\t<translate>Hello world</translate>\r\n ")
+        self.assertEqual(app_module._wrap_in_translate("\u00a0x\u00a0"), "<translate>\u00a0x\u00a0</translate>")
+        self.assertEqual(app_module._wrap_in_translate(" \n "), " \n ")
+
+    def test_renumber_restarts_in_every_unit(self):
+        self.assertEqual(
+            app_module.renumber_tvars_per_unit(
+                '<translate><tvar name=0>a</tvar> <tvar name="x">b</tvar>\n \n<tvar name=0>c</tvar></translate>'
+                '<tvar name=0>d</tvar>'
+            ),
+            '<translate><tvar name="1">a</tvar> <tvar name="2">b</tvar>\n \n<tvar name="1">c</tvar></translate>'
+            '<tvar name="1">d</tvar>'
+        )
+
+    def test_renumber_tvar_across_a_boundary(self):
+        for text in ('<tvar name=a</translate><tvar name=0>', '<tvar\n\nname=0> <tvar name=0>', 'no tvars\n\nhere'):
+            self.assertEqual(app_module.renumber_tvars_per_unit(text), app_module._renumber_tvars_per_piece(text), text)
+
+class TestSharedParsing(unittest.TestCase):
+
+    samples = [
+        "{{Simple|one|two}} {{Named|a=1|2= x \n\n\n\n y }} {{Positional|1|2=named|3}}",
+        "{{Infobox\n| name = x\n| 2 = second\n}} {{Link|a|[[b]]}} {{Outer|{{inner|x}}|y}}",
+        "{| class=\"navbox\"\n! {{Title|[[Main]]}}\n|-\n| {{Nav|a=[[x]]|b}} and {|\n| {{Cell|[[z]]|w}}\n|}\n|}",
+        "{|\n| <div>{{T|a|[[b]]}}\n{|\n| inner [[c]]\n|}</div>\n|-\n| {{T|a|[[b]]}} {{T|a|[[b]]}}\n|}",
+    ]
+
+    def test_shared_matches_fragment_output(self):
+        for sample in self.samples:
+            self.assertEqual(
+                convert_to_translatable_wikitext(sample, parser='shared'),
+                convert_to_translatable_wikitext(sample, parser='fragment'),
+                sample,
+            )
+
+    def test_simple_templates_are_not_parsed(self):
+        with mock.patch.object(app_module.mwparserfromhell, 'parse') as parse:
+            self.assertEqual(process_template("{{T|one|two|x=y}}"), "{{T|one|2=<translate>two</translate>|x=y}}")
+            self.assertEqual(process_template("{{T|one|2=two}}"), "{{T|one|2=2=<translate>two</translate>}}")
+        parse.assert_not_called()
+
+    def test_nested_tables_are_parsed_once(self):
+        text = "{|\n| a\n|-\n| {|\n| {{T|x|[[y]]}}\n|}\n|}"
+        with mock.patch.object(app_module.mwparserfromhell, 'parse', wraps=app_module.mwparserfromhell.parse) as parse:
+            convert_to_translatable_wikitext(text)
+        self.assertEqual(parse.call_count, 1)
+
+class TestStreaming(unittest.TestCase):
+
+    text = '\n\n'.join(TestTokenizers.samples + [
+        "A paragraph with [[a link]] and [https://example.org an external link].\n\nAnother one, same unit? No.",
+        "<syntaxhighlight lang=\"python\">\nx = 1\n\ny = 2\n</syntaxhighlight>",
+        "{{Multi-line\n|a=1\n\n|b=2}}\n__NOTOC__\n* not a list after a switch",
+    ]) * 10
+
+    def chunked(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_streamed_output_matches_whole_conversion(self):
+        expected = convert_to_translatable_wikitext(self.text)
+        for size in (1, 7, 100, 4096):
+            self.assertEqual(''.join(iter_convert(self.chunked(self.text, size))), expected, size)
+
+    def test_output_is_yielded_incrementally(self):
+        pieces = list(iter_convert(self.chunked(self.text, 512)))
+        self.assertGreater(len(pieces), 5)
+
+    def test_line_endings_split_between_chunks(self):
+        self.assertEqual(
+            ''.join(iter_convert(['== A ==\r', '\nText\r', '\r\n'])),
+            convert_to_translatable_wikitext('== A ==\r\nText\r\r\n'),
+        )
+        self.assertEqual(list(iter_convert([])), [])
+
+    def test_stream_endpoint(self):
+        resp = app.test_client().post('/api/convert/stream', data=self.text.encode('utf-8'), content_type='text/plain')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.get_data(as_text=True), convert_to_translatable_wikitext(self.text))
+
+    def test_failed_stream_ends_with_an_error_line(self):
+        with mock.patch.object(app_module, 'conversion_budget', lambda length: ConversionBudget(steps=10)):
+            resp = app.test_client().post('/api/convert/stream', data=self.text.encode('utf-8'),
+                                          content_type='text/plain')
+            output = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        last_line = output.splitlines()[-1]
+        self.assertTrue(last_line.startswith(app_module.STREAM_ERROR_PREFIX), last_line)
+        error = json.loads(last_line[len(app_module.STREAM_ERROR_PREFIX):-len(app_module.STREAM_ERROR_SUFFIX.strip())])
+        self.assertEqual((error['error'], error['reason']), ('Conversion aborted', 'steps'))
+
+class TestIncrementalConversion(unittest.TestCase):
+
+    paragraphs = [
+        "Paragraph {} with a [[link]], a {{{{Template|x|y}}}} and [https://example.org some text].".format(i) * 6
+        if i % 3 else "* item {}\n** [[sub]] item\n# number".format(i)
+        for i in range(40)
+    ]
+
+    def test_edits_match_full_conversion(self):
+        text = '\n\n'.join(self.paragraphs)
+        converted, document, reused = convert_incremental(text)
+        self.assertEqual(converted, convert_to_translatable_wikitext(text))
+        self.assertEqual(reused, 0)
+        self.assertGreater(len(document.segments), 5)
+        edits = [
+            text.replace('Paragraph 20', 'Edited paragraph 20 <tvar name=0>x</tvar>'),
+            text.replace('* item 21', '* item 21\n\nNew paragraph'),
+            text.replace('Paragraph 4 ', '', 6),
+            text + '\n\nLast [[one]]',
+            text,
+        ]
+        for edited in edits:
+            converted, edited_document, reused = convert_incremental(edited, document)
+            self.assertEqual(converted, convert_to_translatable_wikitext(edited))
+            self.assertGreater(reused, len(edited) // 2)
+        self.assertEqual(convert_incremental(text, document)[2], len(text))
+
+    def test_document_key_on_api(self):
+        client = app.test_client()
+        text = '\n\n'.join(self.paragraphs)
+        before = app_module.incremental_documents.stats()
+        for wikitext in (text, text.replace('Paragraph 30', 'Changed')):
+            resp = client.post('/api/convert', json={'wikitext': wikitext, 'document': 'test-page'})
+            self.assertEqual(resp.get_json()['converted'], convert_to_translatable_wikitext(wikitext))
+        stats = app_module.incremental_documents.stats()
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+        self.assertGreater(stats['reused_chars'], before['reused_chars'])
+        self.assertEqual(client.post('/api/convert', json={'wikitext': text, 'document': ''}).status_code, 400)
+
+    def test_form_keeps_document_key(self):
+        resp = app.test_client().post('/convert', data={'wikitext': 'Hello', 'document': 'abc'})
+        self.assertIn(b'name="document" value="abc"', resp.data)
+
+    def test_anonymous_form_uses_conversion_cache(self):
+        client = app.test_client()
+        text = 'Anonymous [[form]] %f' % time.time()
+        before = (app_module.conversion_cache.stats(), app_module.incremental_documents.stats())
+        for _ in range(2):
+            resp = client.post('/convert', data={'wikitext': text})
+            self.assertIn(b'name="document" value="', resp.data)
+        cache, documents = app_module.conversion_cache.stats(), app_module.incremental_documents.stats()
+        self.assertEqual(cache['misses'] - before[0]['misses'], 1)
+        self.assertEqual(cache['hits'] - before[0]['hits'], 1)
+        self.assertEqual(documents['documents'], before[1]['documents'])
+
+class TestLinkClassification(unittest.TestCase):
+
+    def test_default_namespaces(self):
+        classifier = LinkClassifier()
+        self.assertEqual(classifier.classify('Main Page'), LinkKind.plain)
+        self.assertEqual(classifier.classify('Category:Foo'), LinkKind.category)
+        self.assertEqual(classifier.classify('Image:a.png'), LinkKind.file)
+        self.assertEqual(classifier.classify('Special:RecentChanges'), LinkKind.special)
+        self.assertEqual(classifier.classify('User talk:Bob'), LinkKind.kept)
+        self.assertEqual(classifier.classify('fr:Page'), LinkKind.interlanguage)
+        self.assertEqual(classifier.classify('Help:Contents'), LinkKind.internal)
+        self.assertEqual(classifier.classify('phab:T1'), LinkKind.interwiki)
+        self.assertEqual(classifier.classify(':Category:Foo'), LinkKind.interwiki)
+
+    def test_lookup_is_case_folded(self):
+        classifier = LinkClassifier()
+        self.assertEqual(classifier.classify('CATEGORY:Foo'), LinkKind.category)
+        self.assertEqual(classifier.classify('user_Talk:Bob'), LinkKind.kept)
+        self.assertEqual(classifier.classify('FR:Page'), LinkKind.interlanguage)
+        self.assertEqual(
+            process_double_brackets('[[CATEGORY:Foo]]')[0],
+            process_double_brackets('[[Category:Foo]]')[0],
+        )
+
+    def test_per_wiki_config(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'wiki.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('{"namespaces": {"file": ["Datei"], "category": ["Kategorie"]}, "interlanguage": ["bar"]}')
+            classifier = load_link_classifier({'WIKI_CONFIG': path})
+        self.assertEqual(classifier.classify('Datei:a.png'), LinkKind.file)
+        self.assertEqual(classifier.classify('kategorie:Foo'), LinkKind.category)
+        self.assertEqual(classifier.classify('bar:Seitn'), LinkKind.interlanguage)
+        self.assertEqual(classifier.classify('File:a.png'), LinkKind.file)
+        self.assertEqual(load_link_classifier({}).classify('Datei:a.png'), LinkKind.interwiki)
+        with self.assertRaises(ValueError):
+            LinkClassifier({'talk': ['Diskussion']})
+
+class TestLastUpdatedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.calls = 0
+
+    def clock(self):
+        return self.now
+
+    def fetch(self):
+        self.calls += 1
+        return f"March {self.calls}, 2025"
+
+    def wait_for_refresh(self, cache):
+        deadline = time.monotonic() + 5
+        while cache._refreshing and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_fresh_value_is_served_from_memory(self):
+        cache = LastUpdatedCache(self.fetch, ttl=60, clock=self.clock)
+        self.assertEqual(cache.get(), "March 1, 2025")
+        self.assertEqual(cache.get(), "March 1, 2025")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+    def test_stale_value_is_served_while_refreshing(self):
+        cache = LastUpdatedCache(self.fetch, ttl=60, clock=self.clock)
+        cache.get()
+        self.now = 61
+        self.assertEqual(cache.get(), "March 1, 2025")
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get(), "March 2, 2025")
+        self.assertEqual(cache.stats()['stale_hits'], 1)
+        self.assertEqual(cache.stats()['refreshes'], 2)
+
+    def test_failure_keeps_previous_value(self):
+        cache = LastUpdatedCache(self.fetch, ttl=60, clock=self.clock)
+        cache.get()
+        cache.fetch = lambda: None
+        self.now = 61
+        cache.get()
+        self.wait_for_refresh(cache)
+        self.assertEqual(cache.get(), "March 1, 2025")
+        self.assertEqual(cache.refresh_failures, 1)
+
+    def test_failure_without_value_is_cached(self):
+        cache = LastUpdatedCache(lambda: None, failure_ttl=300, clock=self.clock)
+        self.assertEqual(cache.get(), "Unavailable")
+        self.assertEqual(cache.get(), "Unavailable")
+        self.assertEqual(cache.refreshes, 1)
+
+    def test_static_value_skips_network(self):
+        cache = LastUpdatedCache(self.fetch, static_value="June 2, 2025")
+        self.assertEqual(cache.get(), "June 2, 2025")
+        self.assertEqual(self.calls, 0)
+
+    def test_static_date_sources(self):
+        self.assertEqual(format_commit_date("2025-03-01T12:00:00Z"), "March 1, 2025")
+        self.assertEqual(format_commit_date("2024-12-31T23:00:00+05:30\n"), "December 31, 2024")
+        self.assertIsNone(format_commit_date("not a date"))
+        self.assertEqual(read_static_date({'LAST_UPDATED': '2025-01-09'}), "January 9, 2025")
+        self.assertIsNone(read_static_date({'LAST_UPDATED_FILE': '/nonexistent/last_updated.txt'}))
+
+class TestBatchApi(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_batch_results_keyed_by_id(self):
+        resp = self.client.post('/api/convert/batch', json=[
+            {'id': 'a', 'wikitext': '[[link]]'},
+            {'id': 7, 'wikitext': '== Example =='},
+        ])
+        self.assertEqual(resp.status_code, 200)
+        results = resp.get_json()['results']
+        self.assertEqual(results['a'], {
+            'original': '[[link]]',
+            'converted': '<translate>[[<tvar name="1">Special:MyLanguage/Link</tvar>|link]]</translate>',
+        })
+        self.assertEqual(results['7']['converted'], "<translate>\n==Example==\n</translate>")
+
+    def test_batch_without_original(self):
+        resp = self.client.post('/api/convert/batch', json={
+            'documents': [{'id': 'a', 'wikitext': 'Hello'}],
+            'include_original': False,
+        })
+        self.assertEqual(resp.get_json()['results'], {'a': {'converted': '<translate>Hello</translate>'}})
+
+    def test_batch_errors_are_per_document(self):
+        resp = self.client.post('/api/convert/batch', json=[
+            {'id': 'bad', 'wikitext': 42},
+            {'id': 'good', 'wikitext': 'Hello'},
+        ])
+        self.assertEqual(resp.status_code, 200)
+        results = resp.get_json()['results']
+        self.assertIn('error', results['bad'])
+        self.assertEqual(results['good']['converted'], '<translate>Hello</translate>')
+
+    def test_batch_rejects_invalid_payloads(self):
+        self.assertEqual(self.client.post('/api/convert/batch', json={'wikitext': 'x'}).status_code, 400)
+        self.assertEqual(self.client.post('/api/convert/batch', json=[{'wikitext': 'x'}]).status_code, 400)
+        self.assertEqual(self.client.post('/api/convert/batch', json=[{'id': 1}, {'id': '1'}]).status_code, 400)
+
+class TestInstrumentation(unittest.TestCase):
+
+    text = "== Title ==\nSome [[link]] text.\n{|\n| cell {{T}}\n|}\n<div>[[a]] and [[b]]</div>\n* item"
+
+    def test_profile_flag_on_api(self):
+        resp = app.test_client().post('/api/convert', json={'wikitext': self.text, 'profile': True})
+        data = resp.get_json()
+        self.assertEqual(data['converted'], convert_to_translatable_wikitext(self.text))
+        profile = data['profile']
+        self.assertEqual(profile['conversions'], 1)
+        self.assertEqual(profile['bytes'], len(self.text))
+        self.assertEqual(set(profile['phases']), {'classify', 'tokenize', 'assign_tvars', 'merge', 'handlers', 'renumber'})
+        self.assertEqual(profile['handlers']['process_table']['calls'], 1)
+        self.assertEqual(profile['handlers']['process_double_brackets']['calls'], 3)
+        # Phase times are exclusive, so they add up to (at most) the total.
+        self.assertLessEqual(sum(p['seconds'] for p in profile['phases'].values()), profile['seconds'])
+
+    def test_markup_is_reported(self):
+        _, profile = run_profiled(convert_to_translatable_wikitext, "Just some prose.")
+        self.assertEqual(profile.as_dict()['markup'], {'plain': 1})
+        self.assertNotIn('tokenize', profile.phases)
+        _, profile = run_profiled(convert_to_translatable_wikitext, self.text)
+        markup = profile.as_dict()['markup']
+        self.assertEqual(markup['heading'], 1)
+        self.assertEqual(markup['link'], 1)
+        self.assertEqual(markup['template'], 2)  # The page and its table cell
+
+    def test_nested_calls_are_timed_once(self):
+        @instrumented
+        def nest(text):
+            return nest(text[1:]) if text else ''
+        _, profile = run_profiled(nest, 'abc')
+        self.assertEqual(profile.handlers['nest'][0], 4)
+        self.assertLessEqual(profile.handlers['nest'][1], profile.seconds)
+
+    def test_profiles_merge(self):
+        total = Profile()
+        for _ in range(2):
+            total.merge(run_profiled(convert_to_translatable_wikitext, self.text)[1])
+        self.assertEqual(total.conversions, 2)
+        self.assertEqual(total.phases['renumber'][0], 2)
+
+    def test_metrics_endpoint(self):
+        client = app.test_client()
+        client.post('/api/convert?profile=1', json={'wikitext': self.text})
+        resp = client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        self.assertIn('# TYPE translatetagger_handler_calls_total counter', body)
+        self.assertIn('translatetagger_phase_seconds_total{phase="tokenize"}', body)
+        self.assertIn('translatetagger_cache_hits_total ', body)
+        self.assertIn('translatetagger_markup_fragments_total{family="template"}', body)
+
+class TestTranslationUnits(unittest.TestCase):
+
+    text = ("== Title ==\nSome [[link]] text.\n\nSecond paragraph.\n* item [[a]]\n"
+            "[[File:a.png|thumb|Caption]]\n{|\n| cell\n|}\n<div>In a div</div>")
+
+    def test_units(self):
+        converted, units = convert_to_translatable_wikitext(self.text, units=True)
+        self.assertEqual(converted, convert_to_translatable_wikitext(self.text))
+        self.assertEqual(
+            [(unit.kind, self.text[unit.start:unit.end], unit.text) for unit in units],
+            [
+                ('heading', '== Title ==', '==Title=='),
+                ('paragraph', 'Some [[link]] text.',
+                 'Some [[<tvar name="1">Special:MyLanguage/Link</tvar>|link]] text.'),
+                ('paragraph', 'Second paragraph.', 'Second paragraph.'),
+                ('list_item', 'item [[a]]', 'item [[<tvar name="1">Special:MyLanguage/A</tvar>|a]]'),
+                ('file_caption', '[[File:a.png|thumb|Caption]]', 'Caption'),
+                ('table_cell', 'cell', 'cell'),
+                ('paragraph', 'In a div', 'In a div'),
+            ]
+        )
+        self.assertEqual(units[1].tvars, {'1': 'Special:MyLanguage/Link'})
+
+    def test_table_cells_have_offsets_of_their_own(self):
+        text = "{| class=\"x\"\n! Head !! Other\n|-\n| style=\"q\" | [[a]] text || b\n|-\n| c\n{|\n| inner\n|}\n|}"
+        for given in (text, text.replace('\n', '\r\n')):
+            _, units = convert_to_translatable_wikitext(given, units=True)
+            self.assertEqual(
+                [given[unit.start:unit.end].replace('\r\n', '\n') for unit in units],
+                ['Head', 'Other', '[[a]] text', 'b', 'c\n{|\n| inner\n|}', 'inner'],
+            )
+
+    def test_cells_of_tables_within_tags_have_offsets_of_their_own(self):
+        text = "{|\n| Outer\n<div>\n{|\n| inner [[x]]\n|}\n</div>\n|}"
+        _, units = convert_to_translatable_wikitext(text, units=True)
+        self.assertEqual(
+            [(text[unit.start:unit.end], unit.tvars) for unit in units],
+            [("Outer\n<div>\n{|\n| inner [[x]]\n|}\n</div>", {}), ('inner [[x]]', {'1': 'Special:MyLanguage/X'})],
+        )
+
+    def test_tvars_written_in_the_input(self):
+        _, units = convert_to_translatable_wikitext("Text <tvar name=x>v</tvar> [[link]]", units=True)
+        self.assertEqual(units[0].tvars, {'1': 'v', '2': 'Special:MyLanguage/Link'})
+
+    def test_offsets_are_in_the_input(self):
+        text = "First.\r\n\r\nSecond [[link]]."
+        _, units = convert_to_translatable_wikitext(text, units=True)
+        self.assertEqual([text[unit.start:unit.end] for unit in units], ['First.', 'Second [[link]].'])
+
+    def test_api(self):
+        resp = app.test_client().post('/api/convert', json={'wikitext': self.text, 'units': True})
+        data = resp.get_json()
+        self.assertEqual(data['converted'], convert_to_translatable_wikitext(self.text))
+        self.assertEqual(data['units'][0], {'kind': 'heading', 'start': 0, 'end': 11, 'text': '==Title==', 'tvars': {}})
+        self.assertNotIn('units', app.test_client().post('/api/convert', json={'wikitext': 'x'}).get_json())
+
+class TestConversionEngine(unittest.TestCase):
+
+    def test_inline_and_pooled_results_match(self):
+        texts = ['Hello [[world]]', '== Heading ==', '* item', 'plain'] * 5
+        expected = [(convert_to_translatable_wikitext(text), None) for text in texts]
+        for kind, workers in (('process', 0), ('process', 2), ('thread', 2)):
+            engine = ConversionEngine(convert_to_translatable_wikitext, workers=workers, kind=kind, chunksize=3)
+            try:
+                self.assertEqual(engine.convert_many(texts), expected)
+            finally:
+                engine.shutdown()
+
+    def test_errors_stay_with_their_document(self):
+        engine = ConversionEngine(_slow_upper, workers=2, kind='process')
+        try:
+            results = engine.convert_many(['a', 'fail', 'b'])
+            self.assertEqual(results[0], ('A', None))
+            self.assertIn('bad input', results[1][1])
+            self.assertEqual(results[2], ('B', None))
+            with self.assertRaises(ConversionError):
+                engine.convert('fail')
+        finally:
+            engine.shutdown()
+
+    def test_timeout_replaces_pool(self):
+        engine = ConversionEngine(_slow_upper, workers=1, kind='process', timeout=0.5)
+        try:
+            with self.assertRaises(ConversionTimeout):
+                engine.convert('slow')
+            self.assertEqual(engine.pool_restarts, 1)
+            self.assertEqual(engine.convert('ok'), 'OK')
+        finally:
+            engine.shutdown()
+
+    def test_convert_async(self):
+        engine = ConversionEngine(_slow_upper, workers=1, kind='process', timeout=0.5)
+        try:
+            self.assertEqual(asyncio.run(engine.convert_async('ok')), 'OK')
+            with self.assertRaises(ConversionError):
+                asyncio.run(engine.convert_async('fail'))
+            with self.assertRaises(ConversionTimeout):
+                asyncio.run(engine.convert_async('slow'))
+            self.assertEqual(engine.pool_restarts, 1)
+        finally:
+            engine.shutdown()
+
+    def test_time_queued_does_not_count(self):
+        # Each task takes most of the limit: the last ones wait longer than
+        # the limit for the worker.
+        engine = ConversionEngine(_delayed_upper, workers=1, kind='thread', timeout=0.5, chunksize=1)
+        try:
+            self.assertEqual(engine.convert_many(['a', 'b', 'c']), [('A', None), ('B', None), ('C', None)])
+            self.assertEqual(engine.pool_restarts, 0)
+        finally:
+            engine.shutdown()
+
+class TestHardenedConversion(unittest.TestCase):
+
+    def test_same_output_within_budget(self):
+        text = "Intro [[link]]\n<div>inner [[x]] text</div>\n* item {{T|a}}"
+        self.assertEqual(
+            convert_to_translatable_wikitext(text, budget=ConversionBudget(30, 10000)),
+            convert_to_translatable_wikitext(text),
+        )
+
+    def test_step_budget(self):
+        with self.assertRaises(ConversionAborted) as cm:
+            convert_to_translatable_wikitext("[[a]] [[b]] [[c]]", budget=ConversionBudget(steps=2))
+        self.assertEqual(cm.exception.reason, 'steps')
+
+    def test_deadline(self):
+        ticks = iter(range(100))
+        budget = ConversionBudget(seconds=1, clock=lambda: next(ticks), check_interval=1)
+        with self.assertRaises(ConversionAborted) as cm:
+            convert_to_translatable_wikitext("[[a]] [[b]] [[c]] [[d]]", budget=budget)
+        self.assertEqual(cm.exception.reason, 'deadline')
+
+    def test_malformed_input(self):
+        with self.assertRaises(ConversionAborted) as cm:
+            convert_to_translatable_wikitext("<div>never closed", budget=ConversionBudget())
+        self.assertEqual(cm.exception.reason, 'malformed')
+        with self.assertRaises(ConversionAborted):
+            process_double_brackets("[[unclosed")
+
+    def test_rule_without_progress(self):
+        rules = [('x', lambda wikitext, curr, last, text_length, parts: curr)]
+        with mock.patch.object(app_module, 'scanner_rules', rules):
+            with self.assertRaises(ConversionAborted) as cm:
+                convert_to_translatable_wikitext("text", tokenizer='reference')
+        self.assertEqual(cm.exception.reason, 'no_progress')
+
+    def test_streaming(self):
+        with self.assertRaises(ConversionAborted):
+            list(iter_convert(["<div>never ", "closed"], ConversionBudget()))
+
+    def test_engine_reports_abort(self):
+        engine = ConversionEngine(app_module._convert_document, workers=0)
+        try:
+            with self.assertRaises(ConversionAborted) as cm:
+                engine.convert("<div>never closed")
+            self.assertEqual(cm.exception.reason, 'malformed')
+        finally:
+            engine.shutdown()
+
+    def test_api_returns_422(self):
+        resp = app.test_client().post('/api/convert', json={'wikitext': "<div>never closed"})
+        self.assertEqual(resp.status_code, 422)
+        self.assertEqual(resp.get_json()['error'], 'Conversion aborted')
+        self.assertEqual(resp.get_json()['reason'], 'malformed')
+
+class TestConversionCache(unittest.TestCase):
+
+    def test_key_normalizes_line_endings_and_includes_version(self):
+        self.assertEqual(cache_key('a\r\nb', '1'), cache_key('a\nb', '1'))
+        self.assertNotEqual(cache_key('a\nb', '1'), cache_key('a\nb', '2'))
+
+    def test_get_or_convert_counts_hits_and_misses(self):
+        cache = ConversionCache('1')
+        calls = []
+        convert = lambda text: calls.append(text) or text.upper()
+        self.assertEqual(cache.get_or_convert('abc', convert), 'ABC')
+        self.assertEqual(cache.get_or_convert('abc', convert), 'ABC')
+        self.assertEqual(calls, ['abc'])
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+    def test_lru_eviction_by_bytes(self):
+        key_len = len(cache_key('', '1'))
+        cache = ConversionCache('1', max_bytes=2 * (key_len + 10))
+        keys = [cache.key(str(i)) for i in range(3)]
+        cache.put(keys[0], 'x' * 10)
+        cache.put(keys[1], 'y' * 10)
+        cache.get(keys[0])  # keys[1] is now the least recently used
+        cache.put(keys[2], 'z' * 10)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertEqual(cache.get(keys[0]), 'x' * 10)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.bytes, cache.max_bytes)
+
+    def test_disk_tier_survives_restart_until_version_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.sqlite3')
+            cache = ConversionCache('1', disk_path=path)
+            cache.put(cache.key('abc'), 'ABC')
+            cache.disk.close()
+
+            restarted = ConversionCache('1', disk_path=path)
+            self.assertEqual(restarted.get(restarted.key('abc')), 'ABC')
+            self.assertEqual(restarted.stats()['disk_hits'], 1)
+            restarted.disk.close()
+
+            bumped = ConversionCache('2', disk_path=path)
+            self.assertIsNone(bumped.get(bumped.key('abc')))
+            self.assertEqual(bumped.stats()['disk_bytes'], 0)
+            bumped.disk.close()
+
+    def test_disk_tier_is_shared_between_caches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.sqlite3')
+            first, second = ConversionCache('1', disk_path=path), ConversionCache('1', disk_path=path)
+            value = '<translate>Hello</translate>\n' * 100
+            first.put(first.key('abc'), value)
+            self.assertEqual(second.get(second.key('abc')), value)
+            self.assertEqual(second.stats()['disk_hits'], 1)
+            # Values are compressed; both caches see the same total.
+            self.assertLess(second.stats()['disk_bytes'], len(value))
+            self.assertEqual(first.stats()['disk_bytes'], second.stats()['disk_bytes'])
+            first.disk.close()
+            second.disk.close()
+
+    def test_disk_tier_stays_bounded_under_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.sqlite3')
+            caches = [ConversionCache('1', max_bytes=0, disk_path=path, disk_max_bytes=4096) for _ in range(4)]
+
+            def fill(cache, worker):
+                for i in range(50):
+                    cache.put(cache.key(f'{worker}-{i}'), f'{worker}-{i}-' + os.urandom(32).hex())
+                    cache.get(cache.key(f'{worker}-{i // 2}'))
+
+            threads = [threading.Thread(target=fill, args=(cache, worker)) for worker, cache in enumerate(caches)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            conn = caches[0].disk._connection()
+            stored = conn.execute("SELECT COALESCE(SUM(size), 0) FROM conversions").fetchone()[0]
+            self.assertEqual(caches[0].disk.bytes, stored)
+            self.assertLessEqual(stored, 4096)
+            self.assertEqual(sum(cache.disk.errors for cache in caches), 0)
+            self.assertGreater(sum(cache.disk.evictions for cache in caches), 0)
+            for cache in caches:
+                cache.disk.close()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def _run_concurrently(self, flights, func, callers):
+        results = [None] * callers
+
+        def call(i):
+            try:
+                results[i] = flights.do('key', func)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(0,))]
+        threads[0].start()
+        _wait_for(lambda: flights.stats()['in_flight'] == 1)
+        threads += [threading.Thread(target=call, args=(i,)) for i in range(1, callers)]
+        for thread in threads[1:]:
+            thread.start()
+        _wait_for(lambda: flights.stats()['coalesced'] == callers - 1)
+        return threads, results
+
+    def test_concurrent_calls_share_one(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def convert():
+            calls.append(1)
+            release.wait()
+            return 'converted'
+
+        threads, results = self._run_concurrently(flights, convert, 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['converted'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.stats(), {'in_flight': 0, 'calls': 1, 'coalesced': 3})
+        # Calls that do not overlap are not coalesced.
+        self.assertEqual(flights.do('key', lambda: 'again'), 'again')
+
+    def test_errors_are_shared(self):
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def fail():
+            release.wait()
+            raise ConversionError("bad input")
+
+        threads, results = self._run_concurrently(flights, fail, 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(result, ConversionError) for result in results))
+
+    def test_cancelled_call_is_run_by_a_waiter(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def convert(wait):
+            calls.append(wait)
+            if wait:
+                await asyncio.Event().wait()
+            return 'converted'
+
+        async def run():
+            leader = asyncio.create_task(flights.do_async('key', convert, True))
+            await asyncio.sleep(0)
+            waiter = asyncio.create_task(flights.do_async('key', convert, False))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await waiter
+
+        self.assertEqual(asyncio.run(run()), 'converted')
+        self.assertEqual(calls, [True, False])
+
+    def test_documents_converted_at_once(self):
+        text = "Some [[link]] text."
+        release = threading.Event()
+        convert_incremental = app_module.convert_incremental
+
+        def slow_convert(*args):
+            release.wait()
+            return convert_incremental(*args)
+
+        keys = [f"coalesced-{i}" for i in range(3)]
+        with mock.patch.object(app_module, 'convert_incremental', slow_convert):
+            results = {}
+            threads = [
+                threading.Thread(target=lambda key=key: results.update({key: app_module.convert_document_incremental(key, text)}))
+                for key in keys
+            ]
+            before = app_module.conversion_flights.stats()['coalesced']
+            for thread in threads:
+                thread.start()
+            _wait_for(lambda: app_module.conversion_flights.stats()['coalesced'] == before + 2)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(set(results.values()), {convert_to_translatable_wikitext(text)})
+        # Every document keeps its version, for its next incremental conversion.
+        for key in keys:
+            self.assertIsNotNone(app_module.incremental_documents.take(key))
+
+
+class TestFragmentMemo(unittest.TestCase):
+
+    def setUp(self):
+        app_module.fragment_memo.clear()
+
+    def test_numbered_handler_output_is_renumbered(self):
+        memo = FragmentMemo()
+        calls = []
+
+        @memo.memoize(numbered=True)
+        def link(text, tvar_id=0):
+            calls.append(tvar_id)
+            return f'<tvar name="{tvar_id}">{text}</tvar>', 'kind'
+
+        self.assertEqual(link('a', 3), ('<tvar name="3">a</tvar>', 'kind'))
+        self.assertEqual(link('a', 7), ('<tvar name="7">a</tvar>', 'kind'))
+        self.assertEqual(link('a'), ('<tvar name="0">a</tvar>', 'kind'))
+        self.assertEqual(calls, [TVAR_PLACEHOLDER])
+        self.assertEqual(link(TVAR_PLACEHOLDER, 1), (f'<tvar name="1">{TVAR_PLACEHOLDER}</tvar>', 'kind'))
+        self.assertEqual((memo.stats()['hits'], memo.stats()['misses']), (2, 1))
+
+    def test_bounded_lru(self):
+        memo = FragmentMemo(max_entries=2, max_fragment=3)
+        upper = memo.memoize()(str.upper)
+        for text in ('a', 'b', 'a', 'c', 'b', 'long'):
+            upper(text)
+        stats = memo.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses'], stats['evictions']), (2, 1, 4, 2))
+
+    def test_repeated_templates_are_parsed_once(self):
+        text = "{{Note|see [[a]]|b}} text {{Note|see [[a]]|b}}\n\n{{Note|see [[a]]|b}}"
+        expected = convert_to_translatable_wikitext(text, parser='fragment')
+        app_module.fragment_memo.clear()
+        with mock.patch.object(app_module.mwparserfromhell, 'parse', wraps=app_module.mwparserfromhell.parse) as parse:
+            self.assertEqual(convert_to_translatable_wikitext(text), expected)
+        self.assertEqual(parse.call_count, 1)
+
+    def test_hits_are_reported(self):
+        text = "[[a]] [[b]] [[a]]\n\n[[a]]"
+        before = app_module.fragment_memo.stats()
+        _, profile = run_profiled(convert_to_translatable_wikitext, text)
+        self.assertEqual(profile.as_dict()['fragment_memo']['process_double_brackets'], {'hits': 2, 'misses': 2})
+        stats = app.test_client().get('/api/stats').get_json()['fragment_memo']
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (2, 2))
+
+class TestDumpConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        pages = ''.join(
+            f'<page><title>Page {i}</title><ns>{i % 2}</ns><id>{i}</id>'
+            f'<revision><id>{100 + i}</id><contributor><id>7</id></contributor>'
+            f'<text xml:space="preserve">Text {i} [[link]]{" &lt;div&gt;open" if i == 3 else ""}</text></revision></page>'
+            for i in range(10)
+        )
+        self.input = os.path.join(self.dir.name, 'dump.xml')
+        with open(self.input, 'w', encoding='utf-8') as f:
+            f.write(f'<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/"><siteinfo/>{pages}</mediawiki>')
+
+    def convert(self, output, **kwargs):
+        kwargs.setdefault('progress', convert_dump.Progress(stream=io.StringIO()))
+        convert_dump.convert_dump(self.input, output, workers=0, batch_size=2, **kwargs)
+        with open(output, encoding='utf-8') as f:
+            return f.read()
+
+    def test_iter_pages(self):
+        with open(self.input, 'rb') as f:
+            pages = list(convert_dump.iter_pages(f))
+        self.assertEqual(len(pages), 10)
+        self.assertEqual((pages[1]['title'], pages[1]['ns'], pages[1]['id']), ('Page 1', 1, 1))
+        self.assertEqual(pages[1]['revision'], {'id': '101'})
+        self.assertEqual(pages[3]['text'], 'Text 3 [[link]] <div>open')
+
+    def test_jsonl_output(self):
+        output = os.path.join(self.dir.name, 'out.jsonl')
+        records = [json.loads(line) for line in self.convert(output).splitlines()]
+        self.assertEqual([r['id'] for r in records], list(range(10)))
+        self.assertEqual(records[0]['converted'], convert_to_translatable_wikitext('Text 0 [[link]]'))
+        self.assertIn('Conversion aborted (malformed)', records[3]['error'])
+        self.assertFalse(os.path.exists(convert_dump.checkpoint_path(output)))
+
+    def test_xml_output_and_namespaces(self):
+        output = os.path.join(self.dir.name, 'out.xml')
+        self.convert(output, output_format='xml', namespaces={0})
+        with open(output, 'rb') as f:
+            pages = list(convert_dump.iter_pages(f))
+        self.assertEqual([page['id'] for page in pages], [0, 2, 4, 6, 8])
+        self.assertEqual(pages[0]['text'], convert_to_translatable_wikitext('Text 0 [[link]]'))
+
+    def test_resume_after_interruption(self):
+        self.interrupt_and_resume()
+
+    def test_resume_after_non_ascii_pages(self):
+        with open(self.input, encoding='utf-8') as f:
+            dump = f.read()
+        with open(self.input, 'w', encoding='utf-8') as f:
+            f.write(dump.replace('<title>Page', '<title>Страница «').replace('Text ', 'Texte é€ '))
+        self.interrupt_and_resume()
+
+    def interrupt_and_resume(self):
+        class Interrupting(convert_dump.Progress):
+            def add(self, text, error):
+                if self.pages == 5:
+                    raise KeyboardInterrupt
+                super().add(text, error)
+
+        expected = self.convert(os.path.join(self.dir.name, 'full.jsonl'))
+        output = os.path.join(self.dir.name, 'out.jsonl')
+        with self.assertRaises(KeyboardInterrupt):
+            self.convert(output, checkpoint_every=0, progress=Interrupting(stream=io.StringIO()))
+        self.assertEqual(convert_dump.read_checkpoint(output)['pages'], 4)
+        self.assertEqual(self.convert(output), expected)
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def test_small_documents_go_first(self):
+        admission = AdmissionControl(2, small_bytes=100, max_wait=None)
+        order = []
+
+        async def convert(name, size, done):
+            async with admission.async_slot(size):
+                order.append(name)
+                await done.wait()
+
+        async def run():
+            done = {name: asyncio.Event() for name in 'ABCD'}
+            tasks = []
+            for name, size in (('A', 1000), ('B', 1000), ('C', 10), ('D', 10)):
+                tasks.append(asyncio.create_task(convert(name, size, done[name])))
+                await asyncio.sleep(0)
+            # Large documents never take the last slot: B waits, C runs.
+            self.assertEqual(order, ['A', 'C'])
+            self.assertEqual(admission.stats()['queued'], {'small': 1, 'large': 1})
+            done['A'].set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(order, ['A', 'C', 'D'])
+            done['C'].set()
+            done['D'].set()
+            done['B'].set()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        self.assertEqual(order, ['A', 'C', 'D', 'B'])
+        self.assertEqual(admission.stats()['running'], 0)
+        self.assertEqual(admission.stats()['admitted'], 4)
+
+    def test_full_queue_and_long_waits_are_rejected(self):
+        admission = AdmissionControl(1, max_queue_bytes=2048, max_wait=0.05)
+        with admission.slot(10):
+            with self.assertRaises(Overloaded) as cm:
+                with admission.slot(10):
+                    pass
+            self.assertEqual((cm.exception.status, cm.exception.reason), (503, 'timeout'))
+            waiter = admission._enqueue(2000, lambda: None)
+            with self.assertRaises(Overloaded) as cm:
+                admission._enqueue(100, lambda: None)
+            self.assertEqual((cm.exception.status, cm.exception.reason), (429, 'queue_full'))
+            self.assertGreaterEqual(cm.exception.retry_after, 1)
+            self.assertFalse(admission._withdraw(waiter))
+        stats = admission.stats()
+        self.assertEqual(stats['rejections'], {'queue_full': 1, 'timeout': 1, 'too_large': 0})
+        self.assertEqual((stats['running'], stats['queued_bytes']), (0, 0))
+
+    def test_endpoints_reject_with_retry_after(self):
+        admission = AdmissionControl(1, max_wait=0.01)
+        client = app.test_client()
+        with mock.patch.object(app_module, 'admission', admission), admission.slot(10):
+            resp = client.post('/api/convert', json={'wikitext': 'Not cached yet %f' % time.time()})
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.get_json()['reason'], 'timeout')
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            resp = client.post('/convert', data={'wikitext': 'Not cached either %f' % time.time()})
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn(b'Not cached either', resp.data)
+
+    def test_batches_and_streams_take_slots(self):
+        admission = AdmissionControl(2)
+        client = app.test_client()
+        with mock.patch.object(app_module, 'admission', admission):
+            documents = [{'id': str(i), 'wikitext': f'Batch document {i} %f' % time.time()} for i in range(3)]
+            resp = client.post('/api/convert/batch', json=documents)
+            self.assertEqual(len(resp.get_json()['results']), 3)
+            self.assertEqual(admission.stats()['admitted'], 3)
+            resp = client.post('/api/convert/stream', data=b'Hello [[x]]', content_type='text/plain')
+            self.assertIn('Special:MyLanguage', resp.get_data(as_text=True))
+            resp.close()
+            self.assertEqual((admission.stats()['admitted'], admission.stats()['running']), (4, 0))
+
+    def test_admitted_batch_documents_are_converted_together(self):
+        admission = AdmissionControl(4)
+        engine = app_module.conversion_engine
+        calls = []
+
+        def convert_many(texts):
+            calls.append(len(texts))
+            if len(calls) == 1:
+                # The other documents are admitted meanwhile
+                _wait_for(lambda: admission.stats()['running'] == 3)
+                time.sleep(0.05)
+            return [(text.upper(), None) for text in texts]
+
+        documents = [{'id': str(i), 'wikitext': f'Together {i} %f' % time.time()} for i in range(3)]
+        with mock.patch.object(app_module, 'admission', admission), \
+                mock.patch.object(app_module, 'batch_threads', concurrent.futures.ThreadPoolExecutor(4)), \
+                mock.patch.object(engine, 'convert_many', side_effect=convert_many):
+            resp = app.test_client().post('/api/convert/batch', json=documents)
+        results = resp.get_json()['results']
+        self.assertEqual([results[str(i)]['converted'] for i in range(3)], [d['wikitext'].upper() for d in documents])
+        self.assertEqual(sum(calls), 3)
+        self.assertLessEqual(len(calls), 2)
+        self.assertEqual(admission.stats()['running'], 0)
+
+    def test_batch_documents_wait_behind_small_requests(self):
+        admission = AdmissionControl(1, max_wait=0.01)
+        client = app.test_client()
+        with mock.patch.object(app_module, 'admission', admission), admission.slot(10):
+            resp = client.post('/api/convert/batch', json=[{'id': 'a', 'wikitext': 'Busy %f' % time.time()}])
+            self.assertIn('overloaded', resp.get_json()['results']['a']['error'])
+            self.assertEqual(client.post('/api/convert/stream', data=b'Hi', content_type='text/plain').status_code, 503)
+
+    def test_large_bodies_are_rejected_before_parsing(self):
+        with mock.patch.object(app_module, 'MAX_REQUEST_BYTES', 100):
+            body = json.dumps({'wikitext': 'x' * 200}).encode()
+            resp = app.test_client().post('/api/convert', data=body, content_type='application/json')
+            self.assertEqual(resp.status_code, 413)
+            self.assertIn('error', resp.get_json())
+            status, _, data = asgi_request('POST', '/api/convert', body, [('content-type', 'application/json')],
+                                           chunk_size=64)
+            self.assertEqual((status, data), (413, resp.data))
+            self.assertEqual(app.test_client().post('/convert', data={'wikitext': 'x' * 200}).status_code, 413)
+            self.assertEqual(app.test_client().get('/docs').status_code, 200)
+        with mock.patch.object(app_module, 'MAX_STREAM_BYTES', 100), mock.patch.object(app_module, 'MAX_BATCH_BYTES', 100):
+            resp = app.test_client().post('/api/convert/stream', data=b'x' * 200, content_type='text/plain')
+            self.assertEqual(resp.status_code, 413)
+            self.assertEqual(resp.get_json()['error'], 'Request body larger than 100 bytes')
+            resp = app.test_client().post('/api/convert/batch', json=[{'id': 'a', 'wikitext': 'x' * 200}])
+            self.assertEqual(resp.status_code, 413)
+
+def asgi_request(method, path, body=b'', headers=(), chunk_size=None):
+    """Sends a request to the ASGI app; returns (status, headers, body)."""
+    chunk_size = chunk_size or max(1, len(body))
+    messages = [
+        {'type': 'http.request', 'body': body[i:i + chunk_size], 'more_body': i + chunk_size < len(body)}
+        for i in range(0, max(1, len(body)), chunk_size)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+        'query_string': b'', 'root_path': '', 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    }
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+class TestPrerenderedPages(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in (('last_updated_cache', LastUpdatedCache(None, static_value="June 2, 2025")),
+                            ('prerendered_pages', PrerenderedPages())):
+            patcher = mock.patch.object(app_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+
+    def test_docs_are_rendered_once_and_served_compressed(self):
+        plain = self.client.get('/docs')
+        compressed = self.client.get('/docs', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(app_module.prerendered_pages.renders, 1)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
+        self.assertLess(len(compressed.data), len(plain.data) // 3)
+        self.assertNotEqual(plain.headers['ETag'], compressed.headers['ETag'])
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        self.assertEqual(compressed.headers['Cache-Control'], f'public, max-age={app_module.STATIC_PAGE_MAX_AGE}')
+
+    def test_if_none_match_is_not_modified(self):
+        etag = self.client.get('/docs', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        resp = self.client.get('/docs', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual((resp.status_code, resp.data), (304, b''))
+        self.assertEqual(resp.headers['ETag'], etag)
+        # The identity variant has another tag
+        self.assertEqual(self.client.get('/docs', headers={'If-None-Match': etag}).status_code, 200)
+        status, headers, data = asgi_request('GET', '/docs', headers=[('accept-encoding', 'gzip'), ('if-none-match', etag)])
+        self.assertEqual((status, data), (304, b''))
+
+    def test_pages_are_rendered_ahead_of_requests(self):
+        app_module.prerender_pages(wait=False)
+        self.assertEqual(app_module.prerendered_pages.renders, 2)
+        self.client.get('/')
+        self.client.get('/docs')
+        self.assertEqual(app_module.prerendered_pages.renders, 2)
+
+    def test_failed_prerendering_is_logged(self):
+        future = concurrent.futures.Future()
+        future.set_exception(RuntimeError('template error'))
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            asgi._prerendered(future)
+        self.assertIn('template error', logs.output[0])
+
+    def test_home_page_follows_the_last_updated_date(self):
+        first = self.client.get('/')
+        self.assertIn(b'June 2, 2025', first.data)
+        self.assertEqual(self.client.get('/convert').headers['ETag'], first.headers['ETag'])
+        app_module.last_updated_cache.static_value = "July 3, 2025"
+        second = self.client.get('/')
+        self.assertIn(b'July 3, 2025', second.data)
+        self.assertNotEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(app_module.prerendered_pages.renders, 2)
+
+    def test_home_page_without_a_date_is_cached_briefly(self):
+        cache = app_module.last_updated_cache
+        self.assertEqual(self.client.get('/').cache_control.max_age, cache.ttl)
+        with mock.patch.object(cache, 'static_value', 'Unavailable'):
+            self.assertEqual(self.client.get('/').cache_control.max_age, cache.failure_ttl)
+
+class TestCompression(unittest.TestCase):
+
+    text = '\n\n'.join(TestIncrementalConversion.paragraphs) * 20
+
+    def post(self, body, headers=(), **args):
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+        return app.test_client().post('/api/convert', data=body, headers=headers, query_string=args)
+
+    def test_compressed_request_bodies(self):
+        body = json.dumps({'wikitext': self.text}).encode()
+        expected = self.post(body).get_json()
+        for encoding, data in (('gzip', gzip.compress(body)), ('deflate', zlib.compress(body))):
+            resp = self.post(data, {'Content-Encoding': encoding})
+            self.assertEqual((resp.status_code, resp.get_json()), (200, expected))
+        status, _, data = asgi_request('POST', '/api/convert', gzip.compress(body),
+                                       [('content-type', 'application/json'), ('content-encoding', 'gzip')],
+                                       chunk_size=100)
+        self.assertEqual((status, json.loads(data)), (200, expected))
+        form = gzip.compress(b'wikitext=Hello+%5B%5Bx%5D%5D&document=gzip-form')
+        headers = [('content-type', 'application/x-www-form-urlencoded'), ('content-encoding', 'gzip')]
+        status, _, data = asgi_request('POST', '/convert', form, headers)
+        resp = app.test_client().post('/convert', data=form, headers=dict(headers))
+        self.assertEqual((status, data), (200, resp.data))
+        self.assertIn(b'Special:MyLanguage/X', data)
+
+    def test_decompressed_size_is_limited(self):
+        body = gzip.compress(json.dumps({'wikitext': 'x' * 10000}).encode())
+        with mock.patch.object(app_module, 'MAX_REQUEST_BYTES', 1000):
+            self.assertLess(len(body), 1000)
+            resp = self.post(body, {'Content-Encoding': 'gzip'})
+            self.assertEqual(resp.status_code, 413)
+            self.assertEqual(resp.get_json()['error'], 'Request body larger than 1000 bytes once decompressed')
+        self.assertEqual(self.post(body[:-10], {'Content-Encoding': 'gzip'}).status_code, 400)
+        self.assertEqual(self.post(b'not gzip', {'Content-Encoding': 'gzip'}).status_code, 400)
+
+    def test_decompressing_stream_output_is_bounded_per_read(self):
+        stream = DecompressingStream(io.BytesIO(gzip.compress(b'a' * 100000)))
+        self.assertEqual(len(stream.read(1000)), 1000)
+        self.assertEqual(len(stream.read()), 99000)
+
+    def test_negotiated_response_compression(self):
+        body = json.dumps({'wikitext': self.text}).encode()
+        plain = self.post(body)
+        compressed = self.post(body, {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
+        self.assertLess(len(compressed.data), len(plain.data) // 3)
+        status, headers, data = asgi_request('POST', '/api/convert', body,
+                                             [('content-type', 'application/json'), ('accept-encoding', 'gzip')])
+        self.assertEqual((status, headers[b'content-encoding'], gzip.decompress(data)), (200, b'gzip', plain.data))
+        # Not worth it for small responses
+        small = self.post(json.dumps({'wikitext': 'Hi'}).encode(), {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', small.headers)
+
+    def test_include_original(self):
+        body = {'wikitext': 'Hello [[world]]'}
+        self.assertIn('original', self.post(json.dumps(body).encode()).get_json())
+        resp = self.post(json.dumps(dict(body, include_original=False)).encode())
+        self.assertEqual(resp.get_json(), {'converted': convert_to_translatable_wikitext('Hello [[world]]')})
+        self.assertNotIn('original', self.post(json.dumps(body).encode(), include_original='0').get_json())
+
+class TestAsgi(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(app_module, 'last_updated_cache', LastUpdatedCache(None, static_value="June 2, 2025"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+
+    def assert_same_as_flask(self, method, path, body=b'', content_type=None):
+        headers = [('content-type', content_type)] if content_type else []
+        status, headers, data = asgi_request(method, path, body, headers)
+        resp = self.client.open(path, method=method, data=body, content_type=content_type)
+        self.assertEqual((status, data), (resp.status_code, resp.data))
+        self.assertEqual(headers[b'content-security-policy'], app_module.CSP_POLICY.encode())
+        self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+        return data
+
+    def test_routes_match_flask(self):
+        self.assertIn(b'June 2, 2025', self.assert_same_as_flask('GET', '/'))
+        self.assert_same_as_flask('GET', '/docs')
+        self.assert_same_as_flask('GET', '/convert')
+        self.assert_same_as_flask('GET', '/api/convert')
+        self.assert_same_as_flask('POST', '/convert', b'wikitext=Hello+%5B%5Bx%5D%5D&document=asgi', 'application/x-www-form-urlencoded')
+        for payload in ({'wikitext': 'Hello [[world]]'}, {'wikitext': '<div>never closed'}, {'text': 'x'},
+                        {'wikitext': 'Hi', 'document': ''}, {'wikitext': 'Hi', 'document': 'asgi-api'}):
+            self.assert_same_as_flask('POST', '/api/convert', json.dumps(payload).encode(), 'application/json')
+        self.assert_same_as_flask('POST', '/api/convert', b'{', 'application/json')
+
+    def test_profiled_conversion(self):
+        status, _, data = asgi_request('POST', '/api/convert', b'{"wikitext": "Hi [[x]]", "profile": true}',
+                                       [('content-type', 'application/json')])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(data)['profile']['conversions'], 1)
+
+    def test_other_routes_run_on_flask(self):
+        text = '\n\n'.join(TestIncrementalConversion.paragraphs)
+        status, _, data = asgi_request('POST', '/api/convert/stream', text.encode(), [('content-type', 'text/plain')],
+                                       chunk_size=1000)
+        self.assertEqual(status, 200)
+        self.assertEqual(data.decode(), convert_to_translatable_wikitext(text))
+        status, _, data = asgi_request('GET', '/api/stats')
+        self.assertEqual(status, 200)
+        self.assertIn('conversion_cache', json.loads(data))
+        self.assertEqual(asgi_request('GET', '/missing')[0], 404)
+
+    def test_disconnected_clients_get_no_response(self):
+        messages = [{'type': 'http.request', 'body': b'[{"id": "a", "wikitext": "cut', 'more_body': True},
+                    {'type': 'http.disconnect'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'POST', 'scheme': 'http', 'path': '/api/convert/batch',
+            'query_string': b'', 'root_path': '', 'headers': [(b'content-type', b'application/json')],
+        }
+        view = mock.Mock()
+        with mock.patch.dict(app.view_functions, {'api_convert_batch': view}):
+            asyncio.run(asgi.app(scope, receive, send))
+        self.assertEqual(sent, [])
+        view.assert_not_called()
+
+    def test_conversions_are_made_on_the_event_loop(self):
+        blocked = mock.Mock(side_effect=AssertionError('converted on the view thread'))
+        admission = AdmissionControl(2)
+        with mock.patch.object(app_module, '_convert_admitted', blocked), \
+                mock.patch.object(app_module, '_convert_incremental_admitted', blocked), \
+                mock.patch.object(app_module, 'admission', admission):
+            for payload in ({'wikitext': 'Loop [[x]] %f' % time.time()}, {'wikitext': 'Hi', 'document': 'asgi-loop'},
+                            {'wikitext': 'Hi [[x]]', 'units': True}):
+                status, _, data = asgi_request('POST', '/api/convert', json.dumps(payload).encode(),
+                                               [('content-type', 'application/json')])
+                self.assertEqual(status, 200, data)
+            status, _, data = asgi_request('POST', '/convert', b'wikitext=Loop+%5B%5By%5D%5D',
+                                           [('content-type', 'application/x-www-form-urlencoded')])
+            self.assertEqual(status, 200)
+            self.assertIn(b'Special:MyLanguage/Y', data)
+        blocked.assert_not_called()
+        self.assertEqual(admission.stats()['admitted'], 4)
+
+    def test_unread_bodies_are_not_received(self):
+        receive = mock.AsyncMock(side_effect=AssertionError('body read'))
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        for method, path in (('POST', '/missing'), ('POST', '/docs'), ('GET', '/docs')):
+            scope = {
+                'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+                'query_string': b'', 'root_path': '', 'headers': [(b'content-length', b'1000000000')],
+            }
+            asyncio.run(asgi.app(scope, receive, send))
+        self.assertEqual([m['status'] for m in sent if m['type'] == 'http.response.start'], [404, 405, 200])
+        receive.assert_not_called()
+
+class TestBenchmark(unittest.TestCase):
+
+    def results(self, throughput, p50, memory, calibration_ms=10.0):
+        return {'calibration_ms': calibration_ms, 'categories': {'prose': {
+            'throughput_kb_s': throughput,
+            'peak_memory_bytes': memory,
+            'sizes': {'2k': {'latency_ms': {'p50': p50}}},
+        }}}
+
+    def test_corpus_is_deterministic(self):
+        self.assertEqual(benchmark.generate_document('links', 2048), benchmark.generate_document('links', 2048))
+        self.assertNotEqual(benchmark.generate_document('links', 2048), benchmark.generate_document('lists', 2048))
+
+    def test_percentile(self):
+        self.assertEqual(benchmark.percentile([3, 1, 2, 4], 0.5), 2)
+        self.assertEqual(benchmark.percentile([3, 1, 2, 4], 0.99), 4)
+
+    def test_tail_percentiles_need_enough_runs(self):
+        self.assertEqual(benchmark.latency_summary([0.003, 0.001, 0.002]), {'p50': 2.0, 'max': 3.0})
+        summary = benchmark.latency_summary([i / 1000 for i in range(1, 11)])
+        self.assertEqual((summary['p90'], summary['max']), (9.0, 10.0))
+        self.assertNotIn('p99', summary)
+
+    def test_compare_flags_regressions_beyond_threshold(self):
+        baseline = self.results(100.0, 10.0, 1000)
+        self.assertEqual(benchmark.compare(self.results(80.0, 12.0, 1200), baseline, threshold=0.3), [])
+        self.assertEqual(len(benchmark.compare(self.results(50.0, 20.0, 2000), baseline, threshold=0.3)), 3)
+
+    def test_compare_scales_timings_by_calibration(self):
+        baseline = self.results(100.0, 10.0, 1000)
+        # A machine twice as slow, on the converter as on the calibration
+        self.assertEqual(benchmark.compare(self.results(50.0, 20.0, 1000, calibration_ms=20.0), baseline), [])
+        self.assertEqual(len(benchmark.compare(self.results(30.0, 30.0, 1000, calibration_ms=20.0), baseline)), 2)
+        # Without calibration, only memory is compared
+        del baseline['calibration_ms']
+        self.assertEqual(len(benchmark.compare(self.results(50.0, 20.0, 2000), baseline)), 1)
+
+    def test_run_reports_every_category(self):
+        corpus = {'prose': [('prose-tiny.wiki', benchmark.generate_document('prose', 512))]}
+        results = benchmark.run_benchmarks(convert_to_translatable_wikitext, corpus, repeat=1)
+        self.assertEqual(results['categories']['prose']['sizes']['tiny']['runs'], 1)
+        self.assertGreater(results['categories']['prose']['throughput_kb_s'], 0)
+
+    def test_reset_runs_before_every_conversion(self):
+        calls = []
+        corpus = {'prose': [('prose-tiny.wiki', 'Hello')]}
+        results = benchmark.run_benchmarks(lambda text: calls.append('convert'), corpus, repeat=2,
+                                           reset=lambda: calls.append('reset'))
+        self.assertEqual(calls, ['reset', 'convert'] * 4)  # Warm-up, 2 timed runs, memory
+        self.assertEqual(results['fragment_memo'], 'cleared')
+
+    def test_latency_is_reported_per_size(self):
+        corpus = {'prose': [
+            ('prose-2k.wiki', benchmark.generate_document('prose', 2048)),
+            ('prose-1k.wiki', benchmark.generate_document('prose', 1024)),
+        ]}
+        results = benchmark.run_benchmarks(convert_to_translatable_wikitext, corpus, repeat=2)
+        sizes = results['categories']['prose']['sizes']
+        self.assertEqual(list(sizes), ['1k', '2k'])  # Smallest first
+        self.assertEqual([r['runs'] for r in sizes.values()], [2, 2])
+        self.assertEqual(results['categories']['prose']['bytes'], sum(r['bytes'] for r in sizes.values()))
+        rows = benchmark.format_results(results).splitlines()[1:]
+        self.assertEqual([row.split()[:2] for row in rows], [['prose', '1k'], ['prose', '2k']])
+
 if __name__ == '__main__':
     unittest.main(exit=True, failfast=True)